@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Carpeta del almacén de resultados (se puede cambiar con la variable de entorno VDOM_ALMACEN)
+RUTA_ALMACEN = os.environ.get('VDOM_ALMACEN', os.path.join(os.path.expanduser('~'), '.vdom', 'almacen'))
+
+# Límites de la recolección: antigüedad desde el último uso y tamaño total
+EDAD_MAXIMA_ALMACEN_DIAS = 7
+TAMANO_MAX_ALMACEN_MB = 10240
+
+# Las carpetas temporales más antiguas que esto son de trabajos interrumpidos
+EDAD_MAXIMA_TEMPORALES_HORAS = 24
+
+# Archivo con la descripción de cada resultado
+NOMBRE_MANIFIESTO = 'manifiesto.json'
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS sesiones (
+    sesion TEXT NOT NULL,
+    nombre TEXT NOT NULL,
+    resultado TEXT NOT NULL,
+    actualizado REAL NOT NULL,
+    PRIMARY KEY (sesion, nombre)
+);
+CREATE INDEX IF NOT EXISTS sesiones_resultado ON sesiones (resultado);
+"""
+
+def nueva_sesion():
+    """Identificador aleatorio de una sesión del navegador."""
+    return uuid.uuid4().hex
+
+class AlmacenResultados:
+    """
+    Almacén de resultados inmutables, direccionados por contenido y compartido entre
+    procesos. El id de un resultado es la clave de su trabajo (tipo, parámetros y
+    contenido de las entradas), así que dos cálculos idénticos, de cualquier usuario,
+    comparten los archivos.
+
+    Cada resultado se escribe en una carpeta temporal (reservar) y se publica con un
+    renombrado atómico a objetos/<id[:2]>/<id> (publicar): nadie ve archivos a medio
+    escribir y una vez publicados no cambian. Una base SQLite asocia cada sesión del
+    navegador a sus resultados. recolectar elimina los resultados sin usar hace tiempo y,
+    si hace falta, los usados hace más tiempo hasta quedar bajo el tamaño máximo.
+    """
+
+    def __init__(self, raiz=RUTA_ALMACEN, edad_maxima_dias=EDAD_MAXIMA_ALMACEN_DIAS,
+                 tamano_max_mb=TAMANO_MAX_ALMACEN_MB):
+        self.raiz = raiz
+        self.edad_maxima = edad_maxima_dias * 86400
+        self.tamano_max = int(tamano_max_mb * 1024 * 1024)
+        self.ruta_objetos = os.path.join(raiz, 'objetos')
+        self.ruta_temporales = os.path.join(raiz, 'tmp')
+        self.ruta_bd = os.path.join(raiz, 'sesiones.sqlite')
+        self._bloqueo = threading.Lock()
+        os.makedirs(self.ruta_objetos, exist_ok=True)
+        os.makedirs(self.ruta_temporales, exist_ok=True)
+        with self._conexion() as con:
+            con.executescript(ESQUEMA)
+
+    @contextmanager
+    def _conexion(self):
+        con = sqlite3.connect(self.ruta_bd, timeout=30, isolation_level=None)
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            yield con
+        finally:
+            con.close()
+
+    def ruta_objeto(self, id_resultado):
+        """Carpeta (definitiva) de un resultado, exista o no todavía."""
+        return os.path.join(self.ruta_objetos, id_resultado[:2], id_resultado)
+
+    def obtener(self, id_resultado):
+        """Manifiesto de un resultado publicado (y lo marca como usado), o None si no existe."""
+        carpeta = self.ruta_objeto(id_resultado)
+        try:
+            with open(os.path.join(carpeta, NOMBRE_MANIFIESTO), encoding='utf-8') as f:
+                manifiesto = json.load(f)
+            os.utime(carpeta)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return manifiesto
+
+    def ruta_archivo(self, id_resultado, archivo):
+        """Ruta de un archivo de un resultado publicado, o None si no existe."""
+        ruta = os.path.join(self.ruta_objeto(id_resultado), archivo)
+        if self.obtener(id_resultado) is None or not os.path.exists(ruta):
+            return None
+        return ruta
+
+    def reservar(self, id_resultado):
+        """Crea una carpeta temporal, propia de este proceso, donde escribir un resultado."""
+        carpeta = os.path.join(self.ruta_temporales, f'{id_resultado}.{os.getpid()}.{uuid.uuid4().hex[:8]}')
+        os.makedirs(carpeta)
+        return carpeta
+
+    def publicar(self, id_resultado, carpeta, resultado=None, tipo=None):
+        """
+        Publica la carpeta temporal de un resultado con un renombrado atómico. Las rutas a
+        la carpeta temporal dentro de resultado (un diccionario serializable en JSON) se
+        cambian por las definitivas. Si otro proceso ya publicó el mismo id, se descarta
+        esta copia y se usa la publicada. Devuelve el manifiesto.
+        """
+        destino = self.ruta_objeto(id_resultado)
+        if resultado is not None:
+            # Las rutas se reemplazan en el JSON, con el mismo escape que tienen dentro de él
+            texto = json.dumps(resultado).replace(json.dumps(carpeta)[1:-1], json.dumps(destino)[1:-1])
+            resultado = json.loads(texto)
+        # Los archivos de bloqueo del cálculo (*.lock) no forman parte del resultado
+        for nombre in os.listdir(carpeta):
+            if nombre.endswith('.lock'):
+                os.remove(os.path.join(carpeta, nombre))
+        archivos = {nombre: os.path.getsize(os.path.join(carpeta, nombre)) for nombre in os.listdir(carpeta)}
+        manifiesto = {'id': id_resultado, 'tipo': tipo, 'creado': time.time(), 'archivos': archivos,
+                      'bytes': sum(archivos.values()), 'resultado': resultado}
+        with open(os.path.join(carpeta, NOMBRE_MANIFIESTO), 'w', encoding='utf-8') as f:
+            json.dump(manifiesto, f)
+
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        try:
+            os.rename(carpeta, destino)
+        except OSError:
+            publicado = self.obtener(id_resultado)
+            if publicado is None:
+                raise
+            shutil.rmtree(carpeta, ignore_errors=True)
+            logger.info(f"Resultado {id_resultado[:12]} ya publicado por otro proceso; se usa ese")
+            return publicado
+        logger.info(f"Resultado {id_resultado[:12]} publicado: {destino} ({manifiesto['bytes'] / 1e6:.1f} MB)")
+        self.recolectar()
+        return manifiesto
+
+    def descartar(self, carpeta):
+        """Elimina una carpeta temporal que no se va a publicar (trabajo con error o cancelado)."""
+        shutil.rmtree(carpeta, ignore_errors=True)
+
+    def asociar(self, sesion, nombre, id_resultado):
+        """Asocia a la sesión el resultado de un nombre ('susceptibilidad', 'amenaza'...)."""
+        with self._conexion() as con:
+            con.execute("INSERT OR REPLACE INTO sesiones (sesion, nombre, resultado, actualizado) VALUES (?, ?, ?, ?)",
+                        (sesion, nombre, id_resultado, time.time()))
+
+    def resultado_sesion(self, sesion, nombre):
+        """Id del último resultado de un nombre en la sesión, o None."""
+        if not sesion:
+            return None
+        with self._conexion() as con:
+            fila = con.execute("SELECT resultado FROM sesiones WHERE sesion = ? AND nombre = ?",
+                               (sesion, nombre)).fetchone()
+        return fila[0] if fila else None
+
+    def archivo_sesion(self, sesion, nombre, archivo):
+        """Ruta de un archivo del último resultado de un nombre en la sesión, o None."""
+        id_resultado = self.resultado_sesion(sesion, nombre)
+        return self.ruta_archivo(id_resultado, archivo) if id_resultado else None
+
+    def _objetos(self):
+        for prefijo in os.listdir(self.ruta_objetos):
+            carpeta_prefijo = os.path.join(self.ruta_objetos, prefijo)
+            for id_resultado in os.listdir(carpeta_prefijo):
+                yield id_resultado, os.path.join(carpeta_prefijo, id_resultado)
+
+    def recolectar(self):
+        """
+        Elimina los resultados sin usar en más de edad_maxima_dias y, si el almacén sigue
+        superando tamano_max_mb, los usados hace más tiempo. También elimina las carpetas
+        temporales abandonadas y las asociaciones de sesión de resultados eliminados o
+        antiguos. Devuelve el número de resultados eliminados.
+        """
+        with self._bloqueo:
+            ahora = time.time()
+            for nombre in os.listdir(self.ruta_temporales):
+                carpeta = os.path.join(self.ruta_temporales, nombre)
+                try:
+                    if ahora - os.stat(carpeta).st_mtime > EDAD_MAXIMA_TEMPORALES_HORAS * 3600:
+                        shutil.rmtree(carpeta, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+
+            objetos = []
+            for id_resultado, carpeta in self._objetos():
+                try:
+                    uso = os.stat(carpeta).st_mtime
+                    with open(os.path.join(carpeta, NOMBRE_MANIFIESTO), encoding='utf-8') as f:
+                        tamano = json.load(f)['bytes']
+                except (FileNotFoundError, json.JSONDecodeError, KeyError):
+                    continue
+                objetos.append((uso, id_resultado, carpeta, tamano))
+
+            eliminados = []
+            total = sum(objeto[3] for objeto in objetos)
+            for uso, id_resultado, carpeta, tamano in sorted(objetos):
+                if ahora - uso <= self.edad_maxima and total <= self.tamano_max:
+                    break
+                # Primero se retira de objetos/ con un renombrado atómico: nadie lo encuentra a
+                # medio borrar, y si el borrado falla, los restos se limpian como temporales
+                retirada = os.path.join(self.ruta_temporales,
+                                        f'{id_resultado}.borrar.{os.getpid()}.{uuid.uuid4().hex[:8]}')
+                try:
+                    os.replace(carpeta, retirada)
+                except FileNotFoundError:
+                    continue
+                shutil.rmtree(retirada, ignore_errors=True)
+                try:
+                    os.rmdir(os.path.dirname(carpeta))
+                except OSError:
+                    pass
+                total -= tamano
+                eliminados.append(id_resultado)
+                logger.info(f"Resultado {id_resultado[:12]} eliminado del almacén ({tamano / 1e6:.1f} MB)")
+
+            with self._conexion() as con:
+                con.executemany("DELETE FROM sesiones WHERE resultado = ?", [(i,) for i in eliminados])
+                con.execute("DELETE FROM sesiones WHERE actualizado < ?", (ahora - self.edad_maxima,))
+            return len(eliminados)
@@ -1,31 +1,59 @@
 import dash
 from dash import dcc, html, Input, Output, State, callback_context
-import base64
-import io
 import dash_bootstrap_components as dbc
-import plotly.express as px
-import geopandas as gpd
-import rasterio
-from rasterio.features import rasterize
-from rasterio.mask import mask
-import numpy as np
 import os
-from rasterio.crs import CRS
-from rasterio.enums import Resampling
-from rasterio.windows import Window
-from rasterio.warp import calculate_default_transform, reproject
+import json
 import logging
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Importar las funciones necesarias del script original
-from modelo_Vdom import asignar_parametros, vector_a_raster, mapeo_nombres_a_codigos, calificar_variable, calificar_y_rasterizar
+from reclasificacion import reclasificar
+from cache_rasters import CacheRasters
+from visualizacion import figura_clases, leer_banda_reducida
+from teselas import TESELAS_DISPONIBLES, registrar_capa, registrar_resolutor, registrar_rutas, figura_teselas, resumen_teselas
+from almacen import AlmacenResultados, nueva_sesion
+from descargas import registrar_descargas, url_descarga, url_exportacion
+from trabajos import GestorTrabajos, ESTADOS_FINALES, TERMINADO, ERROR, CANCELADO
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 
-app.layout = dbc.Container([
+# Servidor de teselas XYZ de los rasters de resultados (/tiles/<capa>/<z>/<x>/<y>.png)
+registrar_rutas(app.server)
+
+# Cola de trabajos en segundo plano: los cálculos largos no bloquean los callbacks
+gestor = GestorTrabajos()
+
+# Resultados compartidos entre procesos y sesiones: cada sesión del navegador guarda el id
+# de sus resultados, no una ruta fija que otro usuario podría sobrescribir
+almacen = AlmacenResultados()
+
+# Raster que se muestra y se descarga de cada tipo de resultado
+ARCHIVOS_RESULTADO = {'susceptibilidad': 'susceptibilidad.tif', 'amenaza': 'amenaza.tif'}
+
+def ruta_capa_almacen(capa):
+    """Ruta del raster de una capa '<tipo>-<id>' del almacén, para servirla desde cualquier proceso."""
+    tipo, _, id_resultado = capa.partition('-')
+    if tipo not in ARCHIVOS_RESULTADO or not id_resultado:
+        return None
+    return almacen.ruta_archivo(id_resultado, ARCHIVOS_RESULTADO[tipo])
+
+registrar_resolutor(ruta_capa_almacen)
+
+# Descargas por bloques y con rangos, y exportación en ZIP, servidas por Flask
+registrar_descargas(app.server, almacen)
+
+# Nombre de cada etapa en el registro de cálculo
+NOMBRES_ETAPAS = {
+    'lectura': "Leyendo datos",
+    'rasterizado': "Rasterizando",
+    'alineacion': "Alineando",
+    'superposicion': "Superponiendo",
+    'escritura': "Escribiendo resultados"
+}
+
+diseno = dbc.Container([
     html.H1("Cálculo de Susceptibilidad y Amenaza por Incendios Forestales", className="text-center my-4"),
     
     dbc.Row([
@@ -73,8 +101,49 @@ app.layout = dbc.Container([
                         dbc.InputGroupText("Radiación Solar"),
                         dbc.Input(id='peso-radiacion-solar', type='number', value=0.07, min=0, max=1, step=0.01)
                     ], className="mb-2"),
+                    html.H5("Opciones de cálculo", className="mt-3"),
+                    dbc.InputGroup([
+                        dbc.InputGroupText("Modo"),
+                        dbc.Select(id='modo-calculo', value='memoria', options=[
+                            {'label': 'En memoria', 'value': 'memoria'},
+                            {'label': 'Por bloques (memoria acotada)', 'value': 'bloques'},
+                            {'label': 'Paralelo por teselas', 'value': 'paralelo'},
+                            {'label': 'Pila alineada (ajuste rápido de pesos)', 'value': 'pila'},
+                            {'label': 'Compacto (calificaciones enteras, menos memoria)', 'value': 'compacto'},
+                            {'label': 'Rasterizado directo en rejilla común', 'value': 'directo'}
+                        ])
+                    ], className="mb-2"),
+                    dbc.Checkbox(id='guardar-intermedios', label="Guardar rasters intermedios (rasterizado directo)", value=False, className="mb-2"),
+                    dbc.InputGroup([
+                        dbc.InputGroupText("Trabajadores"),
+                        dbc.Input(id='num-trabajadores', type='number', value=os.cpu_count() or 1, min=1, step=1),
+                        dbc.Select(id='tipo-pool', value='hilos', options=[
+                            {'label': 'Hilos', 'value': 'hilos'},
+                            {'label': 'Procesos', 'value': 'procesos'}
+                        ])
+                    ], className="mb-2"),
+                    html.Small("El número de trabajadores y el tipo de pool se usan en el modo paralelo por teselas.", className="text-muted mb-3 d-block"),
+                    dbc.InputGroup([
+                        dbc.InputGroupText("Estadísticas"),
+                        dbc.Select(id='estadisticas', value='ninguna', options=[
+                            {'label': 'No calcular', 'value': 'ninguna'},
+                            {'label': 'Completas (una pasada)', 'value': 'completas'},
+                            {'label': 'Sobre una muestra', 'value': 'muestra'}
+                        ])
+                    ], className="mb-2"),
                     dbc.Button('Calcular Amenaza', id='calcular-amenaza-button', color="success", className="mt-3"),
-                    html.Div(id='log-calculo', className="mt-3")
+                    dbc.Button('Limpiar caché', id='limpiar-cache-button', color="secondary", outline=True, className="mt-3 ms-2"),
+                    html.Div(id='estado-cache', className="small text-muted mt-2"),
+                    html.Div([
+                        dbc.Button('Cancelar', id='cancelar-button', color="danger", outline=True, size="sm"),
+                        dbc.Button('Reintentar', id='reintentar-button', color="secondary", outline=True, size="sm", className="ms-2"),
+                    ], className="mt-3"),
+                    html.Div(id='estado-trabajos', className="small text-muted mt-2"),
+                    html.Div(id='log-calculo', className="mt-3"),
+                    dcc.Store(id='trabajo-susceptibilidad'),
+                    dcc.Store(id='trabajo-amenaza'),
+                    dcc.Store(id='trabajos-mostrados', data={}),
+                    dcc.Interval(id='intervalo-trabajos', interval=1000, disabled=True)
                 ])
             ], className="mb-4"),
             dbc.Card([
@@ -102,14 +171,40 @@ app.layout = dbc.Container([
             ], className="mt-3"),
             dbc.Row([
                 dbc.Col([
-                    html.Button("Descargar Raster de Susceptibilidad", id="btn-descargar-susceptibilidad", className="mt-3")
-                ], md=6),
+                    dbc.Button("Descargar Raster de Susceptibilidad", id="btn-descargar-susceptibilidad",
+                               color="secondary", outline=True, external_link=True, disabled=True, className="mt-3")
+                ], md=4),
                 dbc.Col([
-                    html.Button("Descargar Raster de Amenaza", id="btn-descargar-amenaza", className="mt-3")
-                ], md=6)
+                    dbc.Button("Descargar Raster de Amenaza", id="btn-descargar-amenaza",
+                               color="secondary", outline=True, external_link=True, disabled=True, className="mt-3")
+                ], md=4),
+                dbc.Col([
+                    dbc.Button("Exportar todo (ZIP)", id="btn-exportar", color="primary", outline=True,
+                               external_link=True, disabled=True, className="mt-3")
+                ], md=4)
             ]),
-            dcc.Download(id="descargar-susceptibilidad"),
-            dcc.Download(id="descargar-amenaza")
+            dbc.Card([
+                dbc.CardBody([
+                    html.H5("Estadísticas zonales", className="card-title"),
+                    dbc.Row([
+                        dbc.Col([
+                            dbc.Input(id='ruta-zonas', type='text', placeholder='Ruta a la capa de zonas (municipios, veredas, áreas protegidas...)')
+                        ], md=6),
+                        dbc.Col([
+                            dbc.Input(id='campo-zonas', type='text', placeholder='Campo con el nombre de la zona')
+                        ], md=3),
+                        dbc.Col([
+                            dbc.Button('Calcular', id='btn-calcular-zonal', color="primary", outline=True),
+                            dbc.Button('Descargar tabla (CSV)', id='btn-descargar-zonal', color="secondary", outline=True,
+                                       external_link=True, disabled=True, className="ms-2")
+                        ], md=3)
+                    ]),
+                    html.Small("Área de cada clase de amenaza (ha), media y percentiles P10, P50 y P90 por zona, calculados sobre el último raster de amenaza.", className="text-muted d-block mt-2"),
+                    html.Div(id='estado-zonal', className="small text-muted mt-2"),
+                    dcc.Store(id='trabajo-zonal'),
+                    dcc.Interval(id='intervalo-zonal', interval=1000, disabled=True)
+                ])
+            ], className="mt-4")
         ], md=9)
     ]),
     html.Footer([
@@ -122,6 +217,15 @@ app.layout = dbc.Container([
     ], className="mt-4")
 ], fluid=True)  # Usa fluid=True para un contenedor de ancho completo
 
+def servir_layout():
+    """
+    El layout se genera en cada carga de la página con un id de sesión nuevo; el
+    navegador conserva el suyo mientras la pestaña siga abierta (storage_type='session').
+    """
+    return html.Div([dcc.Store(id='sesion', storage_type='session', data=nueva_sesion()), diseno])
+
+app.layout = servir_layout
+
 def crear_leyenda(titulo, labels):
     return html.Div([
         html.H6(titulo, className="mt-2"),
@@ -139,138 +243,108 @@ def crear_leyenda(titulo, labels):
         ], style={"display": "flex", "justifyContent": "space-between", "flexWrap": "wrap"})
     ])
 
+def modo_estadisticas(valor):
+    """Valor del selector de estadísticas para el pipeline (None si no se calculan)."""
+    return valor if valor in ('completas', 'muestra') else None
+
 @app.callback(
-    [Output('mapa-susceptibilidad', 'figure'),
-     Output('leyenda-susceptibilidad', 'children')],
+    [Output('trabajo-susceptibilidad', 'data'),
+     Output('intervalo-trabajos', 'disabled', allow_duplicate=True)],
     [Input('calcular-susceptibilidad-button', 'n_clicks')],
     [State('ruta-cobertura', 'value'),
-     State('campo-cobertura', 'value')]
+     State('campo-cobertura', 'value'),
+     State('estadisticas', 'value')],
+    prevent_initial_call=True
 )
-def calcular_y_mostrar_susceptibilidad(n_clicks, ruta_cobertura, campo_cobertura):
-    if n_clicks == 0 or not ruta_cobertura or not campo_cobertura:
+def encolar_susceptibilidad(n_clicks, ruta_cobertura, campo_cobertura, estadisticas):
+    if not n_clicks or not ruta_cobertura or not campo_cobertura:
         return dash.no_update, dash.no_update
     
-    logger.info("Iniciando cálculo de susceptibilidad")
-    
-    # Cargar el archivo shapefile de vegetación
-    vegetacion = gpd.read_file(ruta_cobertura)
-    
-    # Crear la carpeta de resultados si no existe
-    ruta_base = os.path.dirname(ruta_cobertura)
-    ruta_resultados = os.path.join(ruta_base, 'resultados')
-    os.makedirs(ruta_resultados, exist_ok=True)
-
-    # Definir el tamaño del píxel deseado (en unidades del CRS del shapefile)
-    tamano_pixel = 2  
-
-    # Aplicar la función a cada fila del GeoDataFrame
-    vegetacion['parametros'] = vegetacion[campo_cobertura].apply(asignar_parametros)
-
-    # Extraer los valores de calificación de los parámetros
-    vegetacion['calific_tipoCombus'] = vegetacion['parametros'].apply(lambda x: x.get('calific_tipoCombus', 0))
-    vegetacion['calific_tiempoCombus'] = vegetacion['parametros'].apply(lambda x: x.get('calific_tiempoCombus', 0))
-    vegetacion['calific_carga'] = vegetacion['parametros'].apply(lambda x: x.get('calific_carga', 0))
-
-    # Calcular la susceptibilidad como el promedio de las tres variables
-    vegetacion['susceptibilidad'] = (
-        (vegetacion['calific_tipoCombus'] + 
-         vegetacion['calific_tiempoCombus'] + 
-         vegetacion['calific_carga']) / 3
-    )
-
-    # Convertir la columna de susceptibilidad a raster
-    raster_salida = os.path.join(ruta_resultados, 'susceptibilidad.tif')
-    vector_a_raster(vegetacion, 'susceptibilidad', raster_salida, tamano_pixel)
-
-    # Cargar el raster de susceptibilidad
-    with rasterio.open(raster_salida) as src:
-        susceptibilidad_data = src.read(1)
-
-    # Reclasificar la susceptibilidad
-    def reclasificar_susceptibilidad(valor):
-        if valor == 0:
-            return 0  # Sin riesgo
-        elif valor <= 1:
-            return 1  # Muy baja
-        elif valor <= 2:
-            return 2  # Baja
-        elif valor <= 3:
-            return 3  # Moderada
-        elif valor <= 4:
-            return 4  # Alta
-        else:
-            return 5  # Muy alta
-
-    susceptibilidad_reclasificada = np.vectorize(reclasificar_susceptibilidad)(susceptibilidad_data)
-
-    # Crear mapa con Plotly
-    fig_susceptibilidad = px.imshow(susceptibilidad_reclasificada,
-                                    color_continuous_scale=[
-                                        (0, "white"),     # Sin riesgo
-                                        (0.2, "green"),   # Muy baja
-                                        (0.4, "yellow"),  # Baja
-                                        (0.6, "orange"),  # Moderada
-                                        (0.8, "red"),     # Alta
-                                        (1, "darkred")    # Muy alta
-                                    ],
-                                    title='Mapa de Susceptibilidad',
-                                    labels={'color': 'Nivel de Susceptibilidad'},
-                                    zmin=0, zmax=5)
-
-    # Personalizar la barra de color
-    fig_susceptibilidad.update_coloraxes(
-        colorbar=dict(
-            tickvals=[0, 1, 2, 3, 4, 5],
-            ticktext=['Sin riesgo', 'Muy baja', 'Baja', 'Moderada', 'Alta', 'Muy alta']
-        )
-    )
-    fig_susceptibilidad.update_coloraxes(showscale=False)
-    fig_susceptibilidad.update_layout(height=600, width=800)
-    
-    leyenda = crear_leyenda("Niveles de Susceptibilidad:", [
-        ("Sin riesgo", "white"),
+    id_trabajo = gestor.encolar('susceptibilidad', {'ruta_cobertura': ruta_cobertura,
+                                                    'campo_cobertura': campo_cobertura,
+                                                    'estadisticas': modo_estadisticas(estadisticas)})
+    return id_trabajo, False
+
+
+def figura_resultado(nombre, ruta, titulo):
+    """Mapa de un raster de resultados: por teselas o, sin Pillow, como mapa de calor reducido."""
+    registrar_capa(nombre, ruta)
+    if TESELAS_DISPONIBLES:
+        # Mapa por teselas: el navegador solo pide las teselas visibles
+        return figura_teselas(nombre, titulo)
+    # Reclasificar (0 = sin datos, 1 = muy baja ... 5 = muy alta) la vista reducida
+    return figura_clases(reclasificar(leer_banda_reducida(ruta)), titulo)
+
+def leyenda_resultado(titulo, etiqueta_cero):
+    return crear_leyenda(titulo, [
+        (etiqueta_cero, "white"),
         ("Muy baja", "green"),
         ("Baja", "yellow"),
         ("Moderada", "orange"),
         ("Alta", "red"),
         ("Muy alta", "darkred")
     ])
-    
-    return fig_susceptibilidad, leyenda
-
-def reproyectar_y_alinear(src, dst_crs, dst_transform, dst_shape):
-    """Reproyecta y alinea un raster a un CRS, transformación y forma de destino."""
-    dst_array = np.zeros(dst_shape, dtype=rasterio.float32)
-    reproject(
-        source=rasterio.band(src, 1),
-        destination=dst_array,
-        src_transform=src.transform,
-        src_crs=src.crs,
-        dst_transform=dst_transform,
-        dst_crs=dst_crs,
-        resampling=Resampling.bilinear
-    )
-    return dst_array
-
-def eliminar_valores_atipicos(data, percentil_bajo=1, percentil_alto=99):
-    """Elimina valores atípicos reemplazándolos con NaN."""
-    data_finita = data[np.isfinite(data)]
-    if len(data_finita) == 0:
-        logger.warning("Todos los valores son infinitos o NaN.")
-        return np.full_like(data, np.nan)
-    
-    low = np.nanpercentile(data_finita, percentil_bajo)
-    high = np.nanpercentile(data_finita, percentil_alto)
-    logger.info(f"Umbral bajo: {low}, Umbral alto: {high}")
-    
-    data_limpia = np.where((data >= low) & (data <= high), data, np.nan)
-    return data_limpia
+
+def registro_trabajo(titulo, trabajo):
+    """Elementos del registro de cálculo que describen el estado de un trabajo."""
+    if trabajo['estado'] == ERROR:
+        return [html.Li(f"{titulo}: error. {trabajo['error']}")]
+    if trabajo['estado'] == CANCELADO:
+        return [html.Li(f"{titulo}: cancelado.")]
+    if trabajo['estado'] != TERMINADO:
+        etapa = NOMBRES_ETAPAS.get(trabajo['etapa'], "En cola")
+        porcentaje = int(round(100 * trabajo['progreso']))
+        return [html.Li([f"{titulo}: {etapa} ({porcentaje} %)",
+                         dbc.Progress(value=porcentaje, striped=True, animated=True, className="mt-1")])]
+
+    resultado = trabajo['resultado']
+    if trabajo['tipo'] == 'susceptibilidad':
+        elementos = [html.Li(f"{titulo}: completado en {resultado['segundos']:.1f} s. Raster guardado en: {resultado['ruta']}")]
+    else:
+        elementos = [
+            html.Li(f"Cálculo de amenaza completado en {resultado['segundos']:.1f} s y mapa generado."),
+            html.Li(f"Raster de amenaza guardado en: {resultado['ruta']}"),
+            html.Li(resultado['cache']),
+            html.Li(resumen_teselas()),
+            html.Li(f"Forma del array de amenaza: {tuple(resultado['forma'])}")
+        ]
+        alineacion = resultado.get('alineacion') or {}
+        if alineacion:
+            alineadas = sorted(nombre for nombre, modo in alineacion.items() if modo == 'ventana')
+            elementos.append(html.Li(f"Variables leídas sin reproyectar ({len(alineadas)} de {len(alineacion)}): "
+                                     f"{', '.join(alineadas) or 'ninguna'}"))
+    if resultado.get('almacen') == 'reutilizado':
+        elementos.append(html.Li("Resultado ya calculado con las mismas entradas; se reutiliza el del almacén."))
+    grafo = resultado.get('grafo')
+    if grafo:
+        elementos.append(html.Li(f"Etapas reutilizadas: {', '.join(grafo['reutilizadas']) or 'ninguna'}; "
+                                 f"reconstruidas: {', '.join(grafo['reconstruidas']) or 'ninguna'}"))
+    estadisticas = resultado.get('estadisticas')
+    if estadisticas and estadisticas['validos']:
+        elementos.append(html.Li(f"Valores de {titulo.lower()} - Min: {estadisticas['min']:.4f}, Max: {estadisticas['max']:.4f}, "
+                                 f"Media: {estadisticas['media']:.4f} ({estadisticas['validos']} píxeles válidos, "
+                                 f"{'muestra' if estadisticas['paso_muestra'] > 1 else 'completas'})"))
+    if 'clases' in (estadisticas or {}):
+        elementos.append(html.Li(f"Píxeles por clase (0-5): {estadisticas['clases']}"))
+    escritura = resultado.get('escritura')
+    for informe in ([escritura] if isinstance(escritura, dict) else escritura or []):
+        elementos.append(html.Li(f"{os.path.basename(informe['ruta'])}: {informe['mb_archivo']} MB "
+                                 f"({informe['compresion']}, {informe['relacion_compresion']}:1), "
+                                 f"escrito a {informe['mb_por_segundo']} MB/s"))
+    # Instrumentación y estadísticas completas en JSON, para localizar las etapas costosas
+    detalle = {clave: resultado[clave] for clave in ('instrumentacion', 'estadisticas') if clave in resultado}
+    if detalle:
+        elementos.append(html.Li(html.Details([
+            html.Summary(f"Instrumentación de {titulo.lower()} (JSON)"),
+            html.Pre(json.dumps(detalle, indent=2, ensure_ascii=False), className="small")
+        ])))
+    return elementos
 
 # Modifica la función de callback para incluir las nuevas variables
 @app.callback(
-    [Output('mapa-amenaza', 'figure'),
-     Output('leyenda-amenaza', 'children'),
-     Output('log-calculo', 'children')],
+    [Output('trabajo-amenaza', 'data'),
+     Output('trabajo-susceptibilidad', 'data', allow_duplicate=True),
+     Output('intervalo-trabajos', 'disabled', allow_duplicate=True)],
     [Input('calcular-amenaza-button', 'n_clicks')],
     [State('ruta-cobertura', 'value'),
      State('ruta-rasters-amenaza', 'value'),
@@ -281,234 +355,223 @@ def eliminar_valores_atipicos(data, percentil_bajo=1, percentil_alto=99):
      State('peso-accesibilidad', 'value'),
      State('peso-frecuencia', 'value'),
      State('peso-vientos', 'value'),
-     State('peso-radiacion-solar', 'value')]
+     State('peso-radiacion-solar', 'value'),
+     State('modo-calculo', 'value'),
+     State('num-trabajadores', 'value'),
+     State('tipo-pool', 'value'),
+     State('campo-cobertura', 'value'),
+     State('guardar-intermedios', 'value'),
+     State('estadisticas', 'value')],
+    prevent_initial_call=True
 )
-def calcular_y_mostrar_amenaza(n_clicks, ruta_cobertura, ruta_shps_amenaza, 
-                               peso_susceptibilidad, peso_precipitacion, peso_temperatura, 
-                               peso_pendiente, peso_accesibilidad, peso_frecuencia,
-                               peso_vientos, peso_radiacion_solar):
-    if n_clicks == 0 or not ruta_cobertura or not ruta_shps_amenaza:
-        return dash.no_update, dash.no_update, ""
+def encolar_amenaza(n_clicks, ruta_cobertura, ruta_shps_amenaza, 
+                    peso_susceptibilidad, peso_precipitacion, peso_temperatura, 
+                    peso_pendiente, peso_accesibilidad, peso_frecuencia,
+                    peso_vientos, peso_radiacion_solar, modo_calculo,
+                    num_trabajadores, tipo_pool, campo_cobertura, guardar_intermedios,
+                    estadisticas):
+    if not n_clicks or not ruta_cobertura or not ruta_shps_amenaza:
+        return dash.no_update, dash.no_update, dash.no_update
     
-    logger.info("Iniciando cálculo de amenaza")
-    ruta_base = os.path.dirname(ruta_cobertura)
-    ruta_resultados = os.path.join(ruta_base, 'resultados')
-    ruta_susceptibilidad = os.path.join(ruta_resultados, 'susceptibilidad.tif')
-    
-    variables = {
-        'susceptibilidad': {'ruta': ruta_susceptibilidad, 'peso': peso_susceptibilidad},
-        'precipitacion': {'ruta': os.path.join(ruta_shps_amenaza, 'precipitacion.shp'), 'peso': peso_precipitacion},
-        'temperatura': {'ruta': os.path.join(ruta_shps_amenaza, 'temperatura.shp'), 'peso': peso_temperatura},
-        'pendiente': {'ruta': os.path.join(ruta_shps_amenaza, 'pendiente.shp'), 'peso': peso_pendiente},
-        'accesibilidad': {'ruta': os.path.join(ruta_shps_amenaza, 'accesibilidad.shp'), 'peso': peso_accesibilidad},
-        'frecuencia': {'ruta': os.path.join(ruta_shps_amenaza, 'frecuencia.shp'), 'peso': peso_frecuencia},
-        'vientos': {'ruta': os.path.join(ruta_shps_amenaza, 'vientos.shp'), 'peso': peso_vientos},
-        'radiacion_solar': {'ruta': os.path.join(ruta_shps_amenaza, 'radiacion_solar.shp'), 'peso': peso_radiacion_solar}
+    pesos = {
+        'susceptibilidad': peso_susceptibilidad,
+        'precipitacion': peso_precipitacion,
+        'temperatura': peso_temperatura,
+        'pendiente': peso_pendiente,
+        'accesibilidad': peso_accesibilidad,
+        'frecuencia': peso_frecuencia,
+        'vientos': peso_vientos,
+        'radiacion_solar': peso_radiacion_solar
     }
+    parametros = {'ruta_cobertura': ruta_cobertura, 'ruta_shps_amenaza': ruta_shps_amenaza, 'pesos': pesos,
+                  'modo': modo_calculo or 'memoria', 'campo_cobertura': campo_cobertura,
+                  'num_trabajadores': num_trabajadores, 'tipo_pool': tipo_pool,
+                  'guardar_intermedios': bool(guardar_intermedios),
+                  'estadisticas': modo_estadisticas(estadisticas)}
+
+    # Salvo en el modo directo, la amenaza usa el raster de susceptibilidad del almacén
+    # calculado con la cobertura y el campo elegidos ahora: encolarla de nuevo devuelve el
+    # mismo trabajo si sigue vigente, y si no, la recalcula
+    depende_de = trabajo_susceptibilidad = None
+    if modo_calculo != 'directo' and campo_cobertura:
+        parametros_susceptibilidad = {'ruta_cobertura': ruta_cobertura, 'campo_cobertura': campo_cobertura,
+                                      'estadisticas': modo_estadisticas(estadisticas)}
+        trabajo_susceptibilidad = gestor.encolar('susceptibilidad', parametros_susceptibilidad)
+        trabajo = gestor.obtener(trabajo_susceptibilidad)
+        parametros['ruta_susceptibilidad'] = os.path.join(almacen.ruta_objeto(trabajo['clave']),
+                                                          ARCHIVOS_RESULTADO['susceptibilidad'])
+        if trabajo['estado'] not in ESTADOS_FINALES:
+            depende_de = trabajo_susceptibilidad
+
+    return gestor.encolar('amenaza', parametros, depende_de), trabajo_susceptibilidad or dash.no_update, False
 
-    
-    rasters_disponibles = {}
-    for nombre, info in variables.items():
-        if os.path.exists(info['ruta']):
-            if nombre == 'susceptibilidad':
-                rasters_disponibles[nombre] = rasterio.open(info['ruta'])
-            else:
-                gdf = gpd.read_file(info['ruta'])
-                if 'gridcode' not in gdf.columns:
-                    logger.warning(f"El campo 'gridcode' no existe en el shapefile de {nombre}. Buscando un campo numérico alternativo.")
-                    numeric_columns = gdf.select_dtypes(include=[np.number]).columns
-                    if len(numeric_columns) > 0:
-                        gdf['gridcode'] = gdf[numeric_columns[0]]
-                        logger.info(f"Usando el campo '{numeric_columns[0]}' como 'gridcode' para {nombre}")
-                    else:
-                        logger.error(f"No se encontró un campo numérico adecuado en el shapefile de {nombre}")
-                        continue
-                raster_salida = os.path.join(ruta_resultados, f'{nombre}_raster.tif')
-                calificar_y_rasterizar(gdf, nombre, raster_salida)
-                rasters_disponibles[nombre] = rasterio.open(raster_salida)
-        else:
-            logger.warning(f"El archivo {nombre} no está disponible.")
-    
-    if len(rasters_disponibles) < 2:
-        return dash.no_update, dash.no_update, "No hay suficientes variables disponibles para calcular la amenaza."
-    
-    try:
-        max_bounds = None
-        max_crs = None
-        for src in rasters_disponibles.values():
-            bounds = src.bounds
-            if max_bounds is None or (
-                bounds.left < max_bounds[0] or
-                bounds.bottom < max_bounds[1] or
-                bounds.right > max_bounds[2] or
-                bounds.top > max_bounds[3]
-            ):
-                max_bounds = (bounds.left, bounds.bottom, bounds.right, bounds.top)
-                max_crs = src.crs
-
-        dst_transform, width, height = calculate_default_transform(
-            max_crs, max_crs, max_bounds[2] - max_bounds[0], max_bounds[3] - max_bounds[1],
-            left=max_bounds[0], bottom=max_bounds[1], right=max_bounds[2], top=max_bounds[3]
-        )
-        dst_shape = (height, width)
-
-        logger.info(f"CRS de referencia: {max_crs}")
-        logger.info(f"Forma de referencia: {dst_shape}")
-
-        datos_raster = {}
-        for nombre, src in rasters_disponibles.items():
-            datos = reproyectar_y_alinear(src, max_crs, dst_transform, dst_shape)
-            datos_raster[nombre] = datos
-            logger.info(f"Raster {nombre} alineado. Forma: {datos.shape}")
-            logger.info(f"Valores de {nombre} - Min: {np.nanmin(datos)}, Max: {np.nanmax(datos)}, Media: {np.nanmean(datos)}")
-        
-        mascara = np.zeros(dst_shape, dtype=bool)
-        for datos in datos_raster.values():
-            mascara |= ~np.isnan(datos)
-        
-        logger.info(f"Número de píxeles válidos en la máscara: {np.sum(mascara)}")
-        
-        amenaza = np.zeros(dst_shape, dtype=np.float32)
-        peso_total = np.zeros(dst_shape, dtype=np.float32)
-        for nombre, datos in datos_raster.items():
-            peso = variables[nombre]['peso']
-            logger.info(f"Procesando {nombre} con peso {peso}")
-            logger.info(f"Datos de {nombre} - Min: {np.nanmin(datos)}, Max: {np.nanmax(datos)}, Media: {np.nanmean(datos)}")
-            amenaza += np.nan_to_num(datos * peso)
-            peso_total += np.where(~np.isnan(datos), peso, 0)
-
-        logger.info(f"Amenaza antes de dividir - Min: {np.nanmin(amenaza)}, Max: {np.nanmax(amenaza)}, Media: {np.nanmean(amenaza)}")
-        logger.info(f"Peso total - Min: {np.nanmin(peso_total)}, Max: {np.nanmax(peso_total)}, Media: {np.nanmean(peso_total)}")
-
-        # Evitar división por cero y reemplazar NaN por 0
-        amenaza = np.where(peso_total > 0, amenaza / peso_total, 0)
-        amenaza = np.nan_to_num(amenaza, nan=0)
-
-        logger.info(f"Amenaza después de dividir - Min: {np.min(amenaza)}, Max: {np.max(amenaza)}, Media: {np.mean(amenaza)}")
-
-        # Reclasificar la amenaza en 5 categorías
-        def reclasificar_amenaza(valor):
-            if valor == 0:
-                return 0  # Sin datos
-            elif valor <= 1:
-                return 1  # Muy baja
-            elif valor <= 2:
-                return 2  # Baja
-            elif valor <= 3:
-                return 3  # Moderada
-            elif valor <= 4:
-                return 4  # Alta
-            else:
-                return 5  # Muy alta
-
-        amenaza_reclasificada = np.vectorize(reclasificar_amenaza)(amenaza)
-
-        logger.info(f"Amenaza reclasificada - Min: {np.min(amenaza_reclasificada)}, Max: {np.max(amenaza_reclasificada)}")
-        logger.info(f"Valores únicos en amenaza reclasificada: {np.unique(amenaza_reclasificada)}")
-
-        # Después de calcular la amenaza, guardamos el raster
-        ruta_base = os.path.dirname(ruta_cobertura)
-        ruta_resultados = os.path.join(ruta_base, 'resultados')
-        os.makedirs(ruta_resultados, exist_ok=True)
-        ruta_amenaza = os.path.join(ruta_resultados, 'amenaza.tif')
-
-        # Usamos la misma transformación y CRS que usamos para alinear los rasters
-        with rasterio.open(ruta_amenaza, 'w', driver='GTiff',
-                        height=amenaza.shape[0], width=amenaza.shape[1],
-                        count=1, dtype=amenaza.dtype,
-                        crs=max_crs, transform=dst_transform) as dst:
-            dst.write(amenaza, 1)
-
-        logger.info(f"Raster de amenaza guardado en: {ruta_amenaza}")
-
-        # Crear el mapa de amenaza
-        fig_amenaza = px.imshow(amenaza_reclasificada,
-                                color_continuous_scale=[
-                                    (0, "white"),     # Sin datos
-                                    (0.2, "green"),   # Muy baja
-                                    (0.4, "yellow"),  # Baja
-                                    (0.6, "orange"),  # Moderada
-                                    (0.8, "red"),     # Alta
-                                    (1, "darkred")    # Muy alta
-                                ],
-                                title='Mapa de Amenaza',
-                                labels={'color': 'Nivel de Amenaza'},
-                                zmin=0, zmax=5)
-
-        # Personalizar la barra de color
-        fig_amenaza.update_coloraxes(
-            colorbar=dict(
-                tickvals=[0, 1, 2, 3, 4, 5],
-                ticktext=['Sin datos', 'Muy baja', 'Baja', 'Moderada', 'Alta', 'Muy alta']
-            )
-        )
-        fig_amenaza.update_coloraxes(showscale=False)
-        fig_amenaza.update_layout(height=600, width=800)
-
-        leyenda = crear_leyenda("Niveles de Amenaza:", [
-            ("Sin datos", "white"),
-            ("Muy baja", "green"),
-            ("Baja", "yellow"),
-            ("Moderada", "orange"),
-            ("Alta", "red"),
-            ("Muy alta", "darkred")
-        ])
-
-        log_calculo = html.Ul([
-            html.Li("Cálculo de amenaza completado y mapa generado."),
-            html.Li(f"Raster de amenaza guardado en: {ruta_amenaza}"),
-            html.Li(f"Forma del array de amenaza: {amenaza.shape}"),
-            html.Li(f"Valores de amenaza - Min: {np.min(amenaza):.4f}, Max: {np.max(amenaza):.4f}, Media: {np.mean(amenaza):.4f}"),
-            html.Li(f"Valores de amenaza reclasificada - Min: {np.min(amenaza_reclasificada)}, Max: {np.max(amenaza_reclasificada)}")
-        ])
-
-        return fig_amenaza, leyenda, log_calculo
-        
-    except Exception as e:
-        logger.error(f"Error en el cálculo de amenaza: {str(e)}")
-        return dash.no_update, dash.no_update, html.Ul([html.Li(f"Error: {str(e)}")])
-    
-    finally:
-        for src in rasters_disponibles.values():
-            src.close()
+@app.callback(
+    [Output('estado-trabajos', 'children'),
+     Output('intervalo-trabajos', 'disabled', allow_duplicate=True)],
+    [Input('cancelar-button', 'n_clicks'),
+     Input('reintentar-button', 'n_clicks')],
+    [State('trabajo-susceptibilidad', 'data'),
+     State('trabajo-amenaza', 'data')],
+    prevent_initial_call=True
+)
+def cancelar_o_reintentar(n_cancelar, n_reintentar, trabajo_susceptibilidad, trabajo_amenaza):
+    ids = [i for i in (trabajo_susceptibilidad, trabajo_amenaza) if i]
+    if not ids:
+        return "No hay trabajos.", dash.no_update
+
+    if callback_context.triggered_id == 'cancelar-button':
+        for id_trabajo in ids:
+            gestor.cancelar(id_trabajo)
+        return "Cancelación solicitada.", dash.no_update
+
+    # La susceptibilidad va primero para que la amenaza pueda usar su resultado
+    reintentados = [id_trabajo for id_trabajo in ids if gestor.reintentar(id_trabajo)]
+    if not reintentados:
+        return "No hay trabajos con error o cancelados.", dash.no_update
+    return f"{len(reintentados)} trabajo(s) en cola de nuevo.", False
 
 @app.callback(
-    Output("descargar-susceptibilidad", "data"),
-    [Input("btn-descargar-susceptibilidad", "n_clicks")],
+    [Output('mapa-susceptibilidad', 'figure'),
+     Output('leyenda-susceptibilidad', 'children'),
+     Output('mapa-amenaza', 'figure'),
+     Output('leyenda-amenaza', 'children'),
+     Output('log-calculo', 'children'),
+     Output('trabajos-mostrados', 'data'),
+     Output('intervalo-trabajos', 'disabled')],
+    [Input('intervalo-trabajos', 'n_intervals')],
+    [State('trabajo-susceptibilidad', 'data'),
+     State('trabajo-amenaza', 'data'),
+     State('trabajos-mostrados', 'data'),
+     State('sesion', 'data')],
+    prevent_initial_call=True
+)
+def mostrar_trabajos(n_intervals, trabajo_susceptibilidad, trabajo_amenaza, mostrados, sesion):
+    salidas = {'mapa-susceptibilidad': dash.no_update, 'leyenda-susceptibilidad': dash.no_update,
+               'mapa-amenaza': dash.no_update, 'leyenda-amenaza': dash.no_update}
+    mostrados = dict(mostrados or {})
+    registro = []
+    activos = False
+
+    for nombre, id_trabajo, titulo in (('susceptibilidad', trabajo_susceptibilidad, 'Susceptibilidad'),
+                                       ('amenaza', trabajo_amenaza, 'Amenaza')):
+        trabajo = gestor.obtener(id_trabajo) if id_trabajo else None
+        if trabajo is None:
+            continue
+        registro += registro_trabajo(titulo, trabajo)
+        activos = activos or trabajo['estado'] not in ESTADOS_FINALES
+
+        # Mostrar cada resultado una sola vez (un reintento termina con otra fecha)
+        marca = f"{trabajo['id']}-{trabajo['terminado']}"
+        if trabajo['estado'] == TERMINADO and mostrados.get(nombre) != marca:
+            # El resultado queda asociado a la sesión; la capa lleva su id para que
+            # cualquier proceso del servidor la encuentre en el almacén
+            almacen.asociar(sesion, nombre, trabajo['clave'])
+            try:
+                salidas[f'mapa-{nombre}'] = figura_resultado(f"{nombre}-{trabajo['clave']}", trabajo['resultado']['ruta'],
+                                                             f'Mapa de {titulo}')
+                salidas[f'leyenda-{nombre}'] = leyenda_resultado(f"Niveles de {titulo}:",
+                                                                 "Sin riesgo" if nombre == 'susceptibilidad' else "Sin datos")
+            except Exception as e:
+                logger.error(f"Error al mostrar el mapa de {nombre}: {str(e)}")
+                registro.append(html.Li(f"Error al mostrar el mapa: {str(e)}"))
+            mostrados[nombre] = marca
+
+    return (salidas['mapa-susceptibilidad'], salidas['leyenda-susceptibilidad'],
+            salidas['mapa-amenaza'], salidas['leyenda-amenaza'],
+            html.Ul(registro), mostrados, not activos)
+
+@app.callback(
+    Output('estado-cache', 'children'),
+    [Input('limpiar-cache-button', 'n_clicks')],
     [State('ruta-cobertura', 'value')],
     prevent_initial_call=True,
 )
-def descargar_susceptibilidad(n_clicks, ruta_cobertura):
-    if n_clicks is None or not ruta_cobertura:
+def limpiar_cache(n_clicks, ruta_cobertura):
+    if not n_clicks or not ruta_cobertura:
         return dash.no_update
     
-    ruta_base = os.path.dirname(ruta_cobertura)
-    ruta_resultados = os.path.join(ruta_base, 'resultados')
-    ruta_susceptibilidad = os.path.join(ruta_resultados, 'susceptibilidad.tif')
-    
-    if os.path.exists(ruta_susceptibilidad):
-        return dcc.send_file(ruta_susceptibilidad)
-    else:
-        return dash.no_update
+    ruta_cache = os.path.join(os.path.dirname(ruta_cobertura), 'resultados', 'cache')
+    if not os.path.isdir(ruta_cache):
+        return "La caché está vacía."
+    n = CacheRasters(ruta_cache).invalidar()
+    logger.info(f"Caché invalidada: {n} entradas eliminadas")
+    return f"Caché invalidada: {n} entradas eliminadas."
 
 @app.callback(
-    Output("descargar-amenaza", "data"),
-    [Input("btn-descargar-amenaza", "n_clicks")],
-    [State('ruta-cobertura', 'value')],
+    [Output("btn-descargar-susceptibilidad", "href"),
+     Output("btn-descargar-susceptibilidad", "disabled"),
+     Output("btn-descargar-amenaza", "href"),
+     Output("btn-descargar-amenaza", "disabled"),
+     Output("btn-exportar", "href"),
+     Output("btn-exportar", "disabled")],
+    [Input('trabajos-mostrados', 'data')],
+    [State('sesion', 'data')],
     prevent_initial_call=True,
 )
-def descargar_amenaza(n_clicks, ruta_cobertura):
+def enlaces_descarga(mostrados, sesion):
+    # Los enlaces apuntan al resultado concreto (inmutable), así una descarga
+    # interrumpida se reanuda con el mismo archivo aunque después se recalcule
+    salidas = []
+    for nombre in ('susceptibilidad', 'amenaza'):
+        id_resultado = almacen.resultado_sesion(sesion, nombre)
+        salidas += [url_descarga(id_resultado, ARCHIVOS_RESULTADO[nombre]) if id_resultado else None,
+                    id_resultado is None]
+    hay_resultados = not all(salidas[1::2])
+    return salidas + [url_exportacion(sesion) if hay_resultados else None, not hay_resultados]
+
+@app.callback(
+    [Output('trabajo-zonal', 'data'),
+     Output('estado-zonal', 'children', allow_duplicate=True),
+     Output('btn-descargar-zonal', 'disabled', allow_duplicate=True),
+     Output('intervalo-zonal', 'disabled', allow_duplicate=True)],
+    [Input('btn-calcular-zonal', 'n_clicks')],
+    [State('ruta-cobertura', 'value'),
+     State('ruta-zonas', 'value'),
+     State('campo-zonas', 'value'),
+     State('sesion', 'data')],
+    prevent_initial_call=True,
+)
+def encolar_zonal(n_clicks, ruta_cobertura, ruta_zonas, campo_zonas, sesion):
     if n_clicks is None or not ruta_cobertura:
-        return dash.no_update
-    
-    ruta_base = os.path.dirname(ruta_cobertura)
-    ruta_resultados = os.path.join(ruta_base, 'resultados')
-    ruta_amenaza = os.path.join(ruta_resultados, 'amenaza.tif')
-    
-    if os.path.exists(ruta_amenaza):
-        return dcc.send_file(ruta_amenaza)
-    else:
-        return dash.no_update
+        return dash.no_update, "Indique la ruta al archivo de coberturas.", dash.no_update, dash.no_update
+    if not ruta_zonas or not campo_zonas:
+        return (dash.no_update, "Indique la capa de zonas y el campo con el nombre de la zona.",
+                dash.no_update, dash.no_update)
+
+    ruta_amenaza = almacen.archivo_sesion(sesion, 'amenaza', ARCHIVOS_RESULTADO['amenaza'])
+    if not ruta_amenaza:
+        return dash.no_update, "Calcule primero la amenaza.", dash.no_update, dash.no_update
+
+    # La tabla se calcula en la cola, como la amenaza, y queda en el almacén para descargarla
+    id_trabajo = gestor.encolar('zonal', {'ruta_zonas': ruta_zonas, 'campo_zona': campo_zonas,
+                                          'ruta_resultados': os.path.join(os.path.dirname(ruta_cobertura), 'resultados'),
+                                          'ruta_amenaza': ruta_amenaza})
+    return id_trabajo, "En cola.", True, False
+
+@app.callback(
+    [Output('estado-zonal', 'children'),
+     Output('btn-descargar-zonal', 'href'),
+     Output('btn-descargar-zonal', 'disabled'),
+     Output('intervalo-zonal', 'disabled')],
+    [Input('intervalo-zonal', 'n_intervals')],
+    [State('trabajo-zonal', 'data')],
+    prevent_initial_call=True,
+)
+def mostrar_zonal(n_intervals, id_trabajo):
+    trabajo = gestor.obtener(id_trabajo) if id_trabajo else None
+    if trabajo is None:
+        return dash.no_update, dash.no_update, dash.no_update, True
+    if trabajo['estado'] == ERROR:
+        return f"Error: {trabajo['error']}", None, True, True
+    if trabajo['estado'] == CANCELADO:
+        return "Cancelado.", None, True, True
+    if trabajo['estado'] != TERMINADO:
+        etapa = NOMBRES_ETAPAS.get(trabajo['etapa'], "En cola")
+        return f"{etapa} ({int(round(100 * trabajo['progreso']))} %)", None, True, False
+
+    resultado = trabajo['resultado']
+    return (f"{resultado['zonas']} zonas en {resultado['instrumentacion']['segundos']:.1f} s.",
+            url_descarga(trabajo['clave'], os.path.basename(resultado['ruta'])), False, True)
 
 if __name__ == '__main__':
     logger.info("Iniciando la aplicación Dash")
@@ -0,0 +1,262 @@
+"""
+Recorte de valores atípicos de rasters grandes en dos pasadas por bloques: la primera
+acumula un bosquejo de cuantiles (memoria acotada, error relativo garantizado) del que
+salen los umbrales; la segunda reemplaza los valores fuera de los umbrales por nodata (o
+los limita a los umbrales), en el mismo archivo o en un raster nuevo.
+
+Uso:
+    python -m atipicos amenaza.tif --bajo 1 --alto 99 --salida amenaza_recortada.tif
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import time
+import numpy as np
+import rasterio
+
+from escritura import SalidaRaster
+from instrumentacion import PIXELES_FRANJA
+
+logger = logging.getLogger(__name__)
+
+# Error relativo máximo de los percentiles del bosquejo (0.1 %)
+ERROR_RELATIVO_ATIPICOS = 0.001
+
+# Los valores con magnitud menor se cuentan como 0 (el error de esos percentiles es absoluto)
+MAGNITUD_MINIMA = 1e-12
+
+# Percentiles por defecto de los umbrales
+PERCENTIL_BAJO = 1
+PERCENTIL_ALTO = 99
+
+class BosquejoCuantiles:
+    """
+    Bosquejo de cuantiles en una pasada con error relativo acotado: cada valor se cuenta
+    en un intervalo logarítmico de razón gamma = (1 + e) / (1 - e) según su magnitud
+    (positivos y negativos por separado, y los casi nulos aparte), así que el representante
+    de cada intervalo está a menos de e (relativo) de cualquier valor que contenga. La
+    memoria es fija (unos 6 MB con e = 0.001) sin importar el tamaño del raster. Además
+    lleva el mínimo, el máximo, la media y la desviación estándar exactos.
+    """
+
+    def __init__(self, error_relativo=ERROR_RELATIVO_ATIPICOS):
+        if not 0 < error_relativo < 1:
+            raise ValueError("El error relativo debe estar entre 0 y 1")
+        self.error_relativo = error_relativo
+        self.gamma = (1 + error_relativo) / (1 - error_relativo)
+        self._log_gamma = math.log(self.gamma)
+        self._desplazamiento = math.floor(math.log(MAGNITUD_MINIMA) / self._log_gamma)
+        intervalos = math.ceil(math.log(np.finfo(np.float64).max) / self._log_gamma) - self._desplazamiento + 1
+        self.positivos = np.zeros(intervalos, dtype=np.int64)
+        self.negativos = np.zeros(intervalos, dtype=np.int64)
+        self.ceros = 0
+        self.validos = 0
+        self.minimo = np.inf
+        self.maximo = -np.inf
+        self._media = 0.0
+        self._m2 = 0.0
+
+    def _contar(self, conteos, magnitudes):
+        if magnitudes.size == 0:
+            return
+        indices = np.ceil(np.log(magnitudes) / self._log_gamma).astype(np.intp)
+        indices -= self._desplazamiento
+        np.clip(indices, 0, len(conteos) - 1, out=indices)
+        # Solo se cuenta el tramo de intervalos que ocupan los valores de la franja
+        primero = indices.min()
+        por_intervalo = np.bincount(indices - primero)
+        conteos[primero:primero + len(por_intervalo)] += por_intervalo
+
+    def agregar(self, datos):
+        """Añade los valores finitos de datos, recorriéndolos por franjas."""
+        datos = np.asarray(datos).ravel()
+        for inicio in range(0, datos.size, PIXELES_FRANJA):
+            trozo = datos[inicio:inicio + PIXELES_FRANJA]
+            trozo = trozo[np.isfinite(trozo)].astype(np.float64)
+            n = trozo.size
+            if n == 0:
+                continue
+            self.minimo = min(self.minimo, float(trozo.min()))
+            self.maximo = max(self.maximo, float(trozo.max()))
+            # Media y varianza combinando la del trozo con la acumulada (sin cancelación)
+            media = float(trozo.mean())
+            m2 = float(((trozo - media) ** 2).sum())
+            total = self.validos + n
+            delta = media - self._media
+            self._media += delta * n / total
+            self._m2 += m2 + delta * delta * self.validos * n / total
+            self.validos = total
+
+            magnitudes = np.abs(trozo)
+            grandes = magnitudes >= MAGNITUD_MINIMA
+            self.ceros += int(n - grandes.sum())
+            positivos = grandes & (trozo > 0)
+            self._contar(self.positivos, magnitudes[positivos])
+            self._contar(self.negativos, magnitudes[grandes & ~positivos])
+
+    @property
+    def media(self):
+        return self._media if self.validos else None
+
+    @property
+    def desviacion(self):
+        return math.sqrt(self._m2 / self.validos) if self.validos else None
+
+    def percentiles(self, percentiles):
+        """
+        Percentiles (0-100) de los valores añadidos. Cada uno está a menos de
+        error_relativo (relativo, o MAGNITUD_MINIMA absoluto cerca de 0) del valor de orden
+        round(p / 100 * (n - 1)) de los datos. None si no hay valores.
+        """
+        if self.validos == 0:
+            return [None for _ in percentiles]
+        usados_neg = np.flatnonzero(self.negativos)[::-1]
+        usados_pos = np.flatnonzero(self.positivos)
+        representantes = 2 * self.gamma ** (np.concatenate([usados_neg, usados_pos]) + self._desplazamiento) \
+            / (self.gamma + 1)
+        valores = np.concatenate([-representantes[:len(usados_neg)], [0.0], representantes[len(usados_neg):]])
+        conteos = np.concatenate([self.negativos[usados_neg], [self.ceros], self.positivos[usados_pos]])
+        acumulado = np.cumsum(conteos)
+        resultado = []
+        for p in percentiles:
+            orden = int(round(p / 100.0 * (self.validos - 1)))
+            valor = valores[np.searchsorted(acumulado, orden + 1)]
+            resultado.append(float(min(max(valor, self.minimo), self.maximo)))
+        return resultado
+
+    def umbrales(self, percentil_bajo=PERCENTIL_BAJO, percentil_alto=PERCENTIL_ALTO, umbral_sigma=None):
+        """
+        Umbrales (bajo, alto) de los valores atípicos: los percentiles dados o, con
+        umbral_sigma, la media más/menos umbral_sigma desviaciones estándar.
+        """
+        if umbral_sigma is not None:
+            if self.validos == 0:
+                return None, None
+            return self.media - umbral_sigma * self.desviacion, self.media + umbral_sigma * self.desviacion
+        return tuple(self.percentiles([percentil_bajo, percentil_alto]))
+
+def eliminar_valores_atipicos(datos, percentil_bajo=PERCENTIL_BAJO, percentil_alto=PERCENTIL_ALTO,
+                              umbral_sigma=None, error_relativo=ERROR_RELATIVO_ATIPICOS):
+    """
+    Elimina valores atípicos de un array numpy reemplazándolos con NaN. Los umbrales son
+    los percentiles dados (estimados con BosquejoCuantiles, sin ordenar ni copiar los
+    datos) o, con umbral_sigma, la media más/menos umbral_sigma desviaciones estándar.
+    """
+    bosquejo = BosquejoCuantiles(error_relativo)
+    bosquejo.agregar(datos)
+    if bosquejo.validos == 0:
+        logger.warning("Todos los valores son infinitos o NaN.")
+        return np.full(np.shape(datos), np.nan)
+    bajo, alto = bosquejo.umbrales(percentil_bajo, percentil_alto, umbral_sigma)
+    logger.info(f"Umbral bajo: {bajo}, Umbral alto: {alto}")
+    return np.where((datos >= bajo) & (datos <= alto), datos, np.nan)
+
+def bosquejo_raster(ruta, banda=1, error_relativo=ERROR_RELATIVO_ATIPICOS):
+    """Bosquejo de cuantiles de una banda de un raster, leída por bloques (sin los píxeles nodata)."""
+    bosquejo = BosquejoCuantiles(error_relativo)
+    with rasterio.open(ruta) as src:
+        for _, ventana in src.block_windows(banda):
+            bloque = src.read(banda, window=ventana, masked=True)
+            bosquejo.agregar(bloque.compressed())
+    return bosquejo
+
+def _es_cog(src):
+    return src.tags(ns='IMAGE_STRUCTURE').get('LAYOUT', '').upper() == 'COG'
+
+def _recortar_bloque(bloque, bajo, alto, limitar, nodata):
+    """Aplica los umbrales a un bloque enmascarado; devuelve (bloque, píxeles recortados)."""
+    fuera = ~bloque.mask & ((bloque.data < bajo) | (bloque.data > alto))
+    datos = bloque.filled(nodata if nodata is not None else 0)
+    if limitar:
+        if np.issubdtype(datos.dtype, np.integer):
+            # Umbrales enteros dentro del intervalo y del rango del tipo del raster
+            info = np.iinfo(datos.dtype)
+            bajo = np.clip(np.ceil(bajo), info.min, info.max).astype(datos.dtype)
+            alto = np.clip(np.floor(alto), info.min, info.max).astype(datos.dtype)
+        np.clip(datos, bajo, alto, out=datos, where=fuera)
+    else:
+        datos[fuera] = nodata
+    return datos, int(fuera.sum())
+
+def recortar_raster(ruta_entrada, ruta_salida=None, percentil_bajo=PERCENTIL_BAJO, percentil_alto=PERCENTIL_ALTO,
+                    umbral_sigma=None, limitar=False, banda=1, error_relativo=ERROR_RELATIVO_ATIPICOS,
+                    compresion=None):
+    """
+    Recorta los valores atípicos de una banda de un raster en dos pasadas por bloques: los
+    umbrales salen del bosquejo de cuantiles (ver BosquejoCuantiles.umbrales) y después
+    los valores fuera de ellos se reemplazan por nodata (NaN en rasters de coma flotante
+    sin nodata) o, con limitar=True, se limitan a los umbrales.
+
+    Sin ruta_salida (o si es la misma) el raster se modifica en el lugar: los GeoTIFF
+    normales se reescriben por bloques; los COG se vuelven a escribir como COG, porque no
+    se pueden modificar sin romper su estructura. Con ruta_salida se escribe un COG nuevo
+    en teselas. Devuelve un resumen con los umbrales y el número de píxeles recortados.
+    Lanza ValueError si un raster entero sin nodata no se puede recortar sin limitar.
+    """
+    inicio = time.perf_counter()
+    ruta_salida = ruta_salida or ruta_entrada
+    bosquejo = bosquejo_raster(ruta_entrada, banda, error_relativo)
+    bajo, alto = bosquejo.umbrales(percentil_bajo, percentil_alto, umbral_sigma)
+    resumen = {'ruta': ruta_salida, 'bajo': bajo, 'alto': alto, 'validos': bosquejo.validos,
+               'recortados': 0, 'error_relativo': error_relativo, 'escritura': None}
+    if bosquejo.validos == 0:
+        logger.warning(f"{os.path.basename(ruta_entrada)} no tiene valores válidos; no se recorta.")
+        return resumen
+    segundos_umbrales = time.perf_counter() - inicio
+
+    with rasterio.open(ruta_entrada) as src:
+        nodata = src.nodata
+        if nodata is None and not limitar:
+            if not np.issubdtype(np.dtype(src.dtypes[banda - 1]), np.floating):
+                raise ValueError("El raster es entero y no tiene nodata: use limitar=True o defina nodata")
+            nodata = np.nan
+        en_el_lugar = os.path.abspath(ruta_salida) == os.path.abspath(ruta_entrada) and not _es_cog(src)
+        perfil = (src.shape, src.dtypes[banda - 1], src.crs, src.transform)
+
+    if en_el_lugar:
+        with rasterio.open(ruta_entrada, 'r+') as dst:
+            if dst.nodata is None and nodata is not None:
+                dst.nodata = nodata
+            for _, ventana in dst.block_windows(banda):
+                datos, n = _recortar_bloque(dst.read(banda, window=ventana, masked=True), bajo, alto, limitar, nodata)
+                dst.write(datos, banda, window=ventana)
+                resumen['recortados'] += n
+    else:
+        forma, dtype, crs, transform = perfil
+        salida = SalidaRaster(ruta_salida, forma, dtype, crs, transform, nodata=nodata, compresion=compresion)
+        with salida as dst:
+            # La entrada se cierra antes de convertir la salida, que puede reemplazarla
+            with rasterio.open(ruta_entrada) as src:
+                for _, ventana in dst.block_windows(1):
+                    datos, n = _recortar_bloque(src.read(banda, window=ventana, masked=True), bajo, alto,
+                                                limitar, nodata)
+                    dst.write(datos, 1, window=ventana)
+                    resumen['recortados'] += n
+        resumen['escritura'] = salida.informe
+
+    resumen['segundos_umbrales'] = round(segundos_umbrales, 3)
+    resumen['segundos'] = round(time.perf_counter() - inicio, 3)
+    logger.info(f"{resumen['recortados']} de {bosquejo.validos} píxeles fuera de [{bajo:.6g}, {alto:.6g}] "
+                f"{'limitados' if limitar else 'eliminados'} en {resumen['segundos']:.2f} s: {ruta_salida}")
+    return resumen
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recorta los valores atípicos de un raster por bloques.")
+    parser.add_argument('entrada', help="Raster de entrada")
+    parser.add_argument('--salida', default=None, help="Raster de salida (por defecto se modifica la entrada)")
+    parser.add_argument('--bajo', type=float, default=PERCENTIL_BAJO, help="Percentil del umbral bajo")
+    parser.add_argument('--alto', type=float, default=PERCENTIL_ALTO, help="Percentil del umbral alto")
+    parser.add_argument('--sigma', type=float, default=None,
+                        help="Umbrales a la media más/menos este número de desviaciones (en lugar de percentiles)")
+    parser.add_argument('--limitar', action='store_true', help="Limitar a los umbrales en lugar de eliminar")
+    parser.add_argument('--banda', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    resumen = recortar_raster(args.entrada, args.salida, args.bajo, args.alto, args.sigma, args.limitar, args.banda)
+    print(json.dumps(resumen, indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+"""Pruebas de rendimiento del proyecto (se ejecutan con python -m benchmarks.<nombre>)."""
@@ -0,0 +1,118 @@
+"""
+Micro-benchmark del núcleo de superposición ponderada.
+
+Compara el bucle anterior (temporales de tamaño completo por variable) con el núcleo por
+franjas de superposicion.combinar_ponderado y con el modo compacto uint8 / punto fijo.
+
+Uso:
+    python -m benchmarks.bench_superposicion --filas 4000 --columnas 4000 --variables 8 --json
+"""
+import argparse
+import json
+import time
+import tracemalloc
+import numpy as np
+
+from superposicion import combinar_ponderado, combinar_ponderado_compacto, cuantizar_calificaciones
+
+def combinar_ponderado_anterior(datos_raster, pesos):
+    """Implementación anterior de combinar_ponderado, como referencia."""
+    forma = next(iter(datos_raster.values())).shape
+    amenaza = np.zeros(forma, dtype=np.float32)
+    peso_total = np.zeros(forma, dtype=np.float32)
+    for nombre, datos in datos_raster.items():
+        peso = pesos[nombre]
+        amenaza += np.nan_to_num(datos * peso)
+        peso_total += np.where(~np.isnan(datos), peso, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        amenaza = np.where(peso_total > 0, amenaza / peso_total, 0)
+    amenaza = np.nan_to_num(amenaza, nan=0)
+    return amenaza
+
+# Bytes leídos + escritos en memoria principal por píxel: (por variable, fijos)
+# Anterior: cada operación recorre arreglos completos (multiplicación, nan_to_num, suma,
+# isnan, negación, where en float64, suma de pesos) y otras cinco pasadas al final.
+# Por franjas: cada variable se lee una vez; los acumuladores de la franja están en caché.
+TRAFICO_POR_PIXEL = {
+    'anterior': (56, 38),
+    'franjas': (4, 4),
+    'compacto': (1, 4),
+}
+
+def datos_sinteticos(filas, columnas, num_variables, fraccion_nan=0.2, semilla=0):
+    """Calificaciones enteras 0-5 en float32 con una fracción de NaN, y pesos aleatorios."""
+    rng = np.random.default_rng(semilla)
+    datos_raster, pesos = {}, {}
+    for i in range(num_variables):
+        datos = rng.integers(0, 6, (filas, columnas)).astype(np.float32)
+        datos[rng.random((filas, columnas)) < fraccion_nan] = np.nan
+        datos_raster[f'variable_{i}'] = datos
+        pesos[f'variable_{i}'] = float(rng.uniform(0.05, 0.3))
+    return datos_raster, pesos
+
+def medir(funcion, repeticiones):
+    """Mejor tiempo de varias repeticiones y pico de memoria temporal (tracemalloc)."""
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+    del resultado
+    tracemalloc.start()
+    resultado = funcion()
+    pico = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(tiempos), pico, resultado
+
+def ejecutar(filas, columnas, num_variables, repeticiones=3):
+    datos_raster, pesos = datos_sinteticos(filas, columnas, num_variables)
+    compactos = {nombre: cuantizar_calificaciones(datos) for nombre, datos in datos_raster.items()}
+    salida = np.empty((filas, columnas), dtype=np.float32)
+    pixeles = filas * columnas
+
+    casos = {
+        'anterior': lambda: combinar_ponderado_anterior(datos_raster, pesos),
+        'franjas': lambda: combinar_ponderado(datos_raster, pesos, out=salida),
+        'compacto': lambda: combinar_ponderado_compacto(compactos, pesos, out=salida),
+    }
+    resultados = {}
+    referencia = None
+    for nombre, funcion in casos.items():
+        segundos, pico, amenaza = medir(funcion, repeticiones)
+        por_variable, fijos = TRAFICO_POR_PIXEL[nombre]
+        trafico = (por_variable * num_variables + fijos) * pixeles
+        if referencia is None:
+            referencia = amenaza.copy()
+        resultados[nombre] = {
+            'segundos': round(segundos, 4),
+            'mpixeles_por_s': round(pixeles * num_variables / segundos / 1e6, 1),
+            'trafico_estimado_mb': round(trafico / 1e6, 1),
+            'pico_temporales_mb': round(pico / 1e6, 1),
+            'error_maximo': float(np.abs(amenaza - referencia).max()),
+        }
+    base = resultados['anterior']['segundos']
+    for resultado in resultados.values():
+        resultado['aceleracion'] = round(base / resultado['segundos'], 2)
+    return {'filas': filas, 'columnas': columnas, 'variables': num_variables, 'resultados': resultados}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara los núcleos de superposición ponderada.")
+    parser.add_argument('--filas', type=int, default=3000)
+    parser.add_argument('--columnas', type=int, default=3000)
+    parser.add_argument('--variables', type=int, default=8)
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help="Imprime el resultado como JSON")
+    args = parser.parse_args(argv)
+
+    informe = ejecutar(args.filas, args.columnas, args.variables, args.repeticiones)
+    if args.json:
+        print(json.dumps(informe, indent=2))
+        return
+    print(f"{args.filas} x {args.columnas} píxeles, {args.variables} variables")
+    print(f"{'núcleo':<10}{'s':>9}{'Mpx/s':>9}{'tráfico MB':>12}{'pico MB':>10}{'acel.':>8}{'error máx':>12}")
+    for nombre, r in informe['resultados'].items():
+        print(f"{nombre:<10}{r['segundos']:>9.3f}{r['mpixeles_por_s']:>9.1f}{r['trafico_estimado_mb']:>12.1f}"
+              f"{r['pico_temporales_mb']:>10.1f}{r['aceleracion']:>8.2f}{r['error_maximo']:>12.2g}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Mide el tiempo y la memoria de cada etapa del cálculo de susceptibilidad y amenaza.
+
+Etapas: lectura, calificación con asignar_parametros (fila a fila) y con las tablas
+compiladas, vector_a_raster, calificar_y_rasterizar, alineación, superposición,
+reclasificación, escritura de los COG (amenaza y clases) y construcción de la figura.
+Para cada etapa se guarda el tiempo de reloj, el tiempo de CPU y el pico de memoria
+residente (RSS); para la escritura, además, el tamaño y la velocidad de cada archivo.
+
+Uso:
+    python -m benchmarks.etapas --muestra --salida muestra.json
+    python -m benchmarks.etapas --poligonos 50000 --extension 20000 --salida grande.json
+    python -m benchmarks.etapas --muestra --comparar muestra_anterior.json
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import rasterio
+
+from carga import leer_capa
+from escritura import escribir_clases, escribir_raster
+from instrumentacion import Instrumentacion
+from modelo_Vdom import asignar_parametros, calificar_coberturas, vector_a_raster, calificar_y_rasterizar
+from pipeline import PESOS_POR_DEFECTO, VARIABLES_AMENAZA, TAMANO_PIXEL_SUSCEPTIBILIDAD, RESOLUCION_AMENAZA
+from reclasificacion import reclasificar
+from superposicion import calcular_rejilla_referencia, combinar_ponderado, reproyectar_y_alinear
+from visualizacion import figura_clases
+from benchmarks.sintetico import generar_area
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Área de ejemplo incluida en el repositorio (línea base de humo)
+MUESTRA = {
+    'ruta_cobertura': os.path.join(RAIZ, 'data', 'LandCover', 'cobertura.shp'),
+    'campo_cobertura': 'N3_COBERT',
+    'ruta_shps_amenaza': os.path.join(RAIZ, 'data', 'shp')
+}
+
+def medir_area(area, carpeta, tamano_pixel=TAMANO_PIXEL_SUSCEPTIBILIDAD, resolucion=RESOLUCION_AMENAZA):
+    """Ejecuta las etapas del cálculo sobre un área y devuelve las mediciones."""
+    medidor = Instrumentacion('benchmark')
+    capas = {nombre: os.path.join(area['ruta_shps_amenaza'], f'{nombre}.shp') for nombre in VARIABLES_AMENAZA}
+    capas = {nombre: ruta for nombre, ruta in capas.items() if os.path.exists(ruta)}
+
+    with medidor.etapa('lectura'):
+        cobertura = leer_capa(area['ruta_cobertura'], [area['campo_cobertura']])
+        variables = {nombre: leer_capa(ruta, ['gridcode']) for nombre, ruta in capas.items()}
+
+    # asignar_parametros imprime cada valor: se descarta la salida para medir solo el cálculo
+    with medidor.etapa('asignar_parametros'), contextlib.redirect_stdout(io.StringIO()):
+        cobertura[area['campo_cobertura']].map(asignar_parametros)
+
+    with medidor.etapa('calificacion_tablas'), contextlib.redirect_stdout(io.StringIO()):
+        calificaciones, _ = calificar_coberturas(cobertura[area['campo_cobertura']])
+        cobertura['susceptibilidad'] = calificaciones['susceptibilidad']
+
+    ruta_susceptibilidad = os.path.join(carpeta, 'susceptibilidad.tif')
+    with medidor.etapa('vector_a_raster'), contextlib.redirect_stdout(io.StringIO()):
+        vector_a_raster(cobertura, 'susceptibilidad', ruta_susceptibilidad, tamano_pixel)
+
+    rutas = {'susceptibilidad': ruta_susceptibilidad}
+    with medidor.etapa('calificar_y_rasterizar'), contextlib.redirect_stdout(io.StringIO()):
+        for nombre, gdf in variables.items():
+            rutas[nombre] = os.path.join(carpeta, f'{nombre}_raster.tif')
+            calificar_y_rasterizar(gdf, nombre, rutas[nombre], resolucion=resolucion)
+
+    fuentes = {nombre: rasterio.open(ruta) for nombre, ruta in rutas.items()}
+    try:
+        with medidor.etapa('alineacion'):
+            crs, transform, forma = calcular_rejilla_referencia(fuentes)
+            datos = {nombre: reproyectar_y_alinear(src, crs, transform, forma) for nombre, src in fuentes.items()}
+    finally:
+        for src in fuentes.values():
+            src.close()
+
+    with medidor.etapa('superposicion'):
+        amenaza = combinar_ponderado(datos, {nombre: PESOS_POR_DEFECTO[nombre] for nombre in datos})
+    del datos
+
+    with medidor.etapa('reclasificacion'):
+        clases = reclasificar(amenaza)
+
+    with medidor.etapa('escritura_geotiff'):
+        escritura = [escribir_raster(os.path.join(carpeta, 'amenaza.tif'), amenaza, crs, transform),
+                     escribir_clases(os.path.join(carpeta, 'amenaza_clases.tif'), clases, crs, transform)]
+
+    with medidor.etapa('figura'):
+        figura_clases(clases, "Amenaza").to_json()
+
+    medicion = medidor.terminar()
+    for nombre, etapa in medicion['etapas'].items():
+        print(f"  {nombre:<28}{etapa['segundos']:>9.3f} s{etapa['rss_pico_mb']:>10.1f} MB", file=sys.stderr)
+    return {
+        'poligonos_cobertura': len(cobertura),
+        'poligonos_amenaza': sum(len(gdf) for gdf in variables.values()),
+        'forma_rejilla': list(forma),
+        'pico_por_etapa': medicion['pico_por_etapa'],
+        'escritura': escritura,
+        'etapas': medicion['etapas'],
+        'segundos_total': round(sum(e['segundos'] for e in medicion['etapas'].values()), 4)
+    }
+
+def _commit():
+    """Commit actual del repositorio (None si no es un repositorio git)."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def comparar(actual, anterior):
+    """Imprime el tiempo de cada etapa frente a una medición anterior."""
+    print(f"{'etapa':<28}{'anterior s':>12}{'actual s':>12}{'relación':>10}")
+    for nombre, etapa in actual['etapas'].items():
+        previa = anterior['etapas'].get(nombre)
+        if previa is None:
+            print(f"{nombre:<28}{'-':>12}{etapa['segundos']:>12.3f}{'-':>10}")
+            continue
+        relacion = etapa['segundos'] / previa['segundos'] if previa['segundos'] else float('nan')
+        print(f"{nombre:<28}{previa['segundos']:>12.3f}{etapa['segundos']:>12.3f}{relacion:>10.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mide el rendimiento de las etapas del cálculo.")
+    parser.add_argument('--muestra', action='store_true', help="Usa los datos de ejemplo de data/")
+    parser.add_argument('--poligonos', type=int, default=10000, help="Polígonos de cobertura del área sintética")
+    parser.add_argument('--poligonos-amenaza', type=int, default=None, help="Polígonos por variable de amenaza")
+    parser.add_argument('--extension', type=float, default=5000.0, help="Lado del área sintética, en metros")
+    parser.add_argument('--pixel', type=float, default=TAMANO_PIXEL_SUSCEPTIBILIDAD,
+                        help="Tamaño de píxel de la susceptibilidad")
+    parser.add_argument('--resolucion', type=float, default=RESOLUCION_AMENAZA,
+                        help="Resolución de las variables de amenaza")
+    parser.add_argument('--salida', default=None, help="Archivo JSON de resultados (por defecto, salida estándar)")
+    parser.add_argument('--comparar', default=None, help="JSON de una medición anterior para comparar")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix='vdom_bench_') as carpeta:
+        if args.muestra:
+            area, parametros = MUESTRA, {'muestra': True}
+        else:
+            inicio = time.perf_counter()
+            area = generar_area(os.path.join(carpeta, 'area'), args.poligonos, args.extension, args.poligonos_amenaza)
+            parametros = {'muestra': False, 'poligonos': args.poligonos, 'poligonos_amenaza': args.poligonos_amenaza,
+                          'extension': args.extension, 'generacion_segundos': round(time.perf_counter() - inicio, 3)}
+        parametros.update(pixel=args.pixel, resolucion=args.resolucion)
+        resultado = {
+            'commit': _commit(),
+            'fecha': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'rasterio': rasterio.__version__,
+            'plataforma': platform.platform(),
+            'parametros': parametros
+        }
+        resultado.update(medir_area(area, carpeta, args.pixel, args.resolucion))
+
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            f.write(texto)
+    else:
+        print(texto)
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(resultado, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Generador de áreas de estudio sintéticas para las pruebas de rendimiento.
+
+Crea una carpeta con el shapefile de coberturas (campo N3_COBERT con nombres reales de
+mapeo_nombres_a_codigos) y los shapefiles de las variables de amenaza (campo gridcode),
+con el número de polígonos y la extensión que se indiquen.
+
+Uso:
+    python -m benchmarks.sintetico carpeta --poligonos 20000 --extension 10000
+"""
+import argparse
+import math
+import os
+import geopandas as gpd
+import numpy as np
+from shapely import polygons
+
+from modelo_Vdom import mapeo_nombres_a_codigos
+from pipeline import VARIABLES_AMENAZA
+
+# MAGNA-SIRGAS Origen Nacional, el sistema de los datos de ejemplo
+CRS_SINTETICO = 'EPSG:9377'
+ORIGEN_SINTETICO = (4800000.0, 2260000.0)
+
+def rejilla_poligonos(num_poligonos, extension, origen=ORIGEN_SINTETICO, deformacion=0.3, semilla=0):
+    """
+    Cubre un cuadrado de lado extension (metros) con unos num_poligonos cuadriláteros
+    contiguos, moviendo al azar los vértices interiores para que no queden alineados con
+    los píxeles. Devuelve un arreglo de geometrías shapely.
+    """
+    rng = np.random.default_rng(semilla)
+    lado = max(int(math.ceil(math.sqrt(num_poligonos))), 1)
+    paso = extension / lado
+    xs, ys = np.meshgrid(np.arange(lado + 1) * paso, np.arange(lado + 1) * paso)
+    interiores = (slice(1, -1), slice(1, -1))
+    xs[interiores] += rng.uniform(-deformacion, deformacion, xs[interiores].shape) * paso
+    ys[interiores] += rng.uniform(-deformacion, deformacion, ys[interiores].shape) * paso
+    xs += origen[0]
+    ys += origen[1]
+
+    # Vértices de cada celda en orden (i, j), (i, j+1), (i+1, j+1), (i+1, j)
+    esquinas = [(slice(None, -1), slice(None, -1)), (slice(None, -1), slice(1, None)),
+                (slice(1, None), slice(1, None)), (slice(1, None), slice(None, -1))]
+    anillos = np.stack([np.stack([xs[e].ravel(), ys[e].ravel()], axis=-1) for e in esquinas], axis=1)
+    anillos = np.concatenate([anillos, anillos[:, :1]], axis=1)
+    return polygons(anillos[:num_poligonos])
+
+def generar_area(carpeta, num_poligonos=10000, extension=5000.0, poligonos_amenaza=None, semilla=0):
+    """
+    Escribe un área de estudio sintética en carpeta: cobertura.shp y shp/<variable>.shp.
+    Devuelve {'ruta_cobertura', 'campo_cobertura', 'ruta_shps_amenaza'}.
+    """
+    rng = np.random.default_rng(semilla)
+    os.makedirs(os.path.join(carpeta, 'shp'), exist_ok=True)
+    nombres = np.array(list(mapeo_nombres_a_codigos))
+
+    geometrias = rejilla_poligonos(num_poligonos, extension, semilla=semilla)
+    cobertura = gpd.GeoDataFrame({'N3_COBERT': rng.choice(nombres, len(geometrias))},
+                                 geometry=geometrias, crs=CRS_SINTETICO)
+    ruta_cobertura = os.path.join(carpeta, 'cobertura.shp')
+    cobertura.to_file(ruta_cobertura, encoding='utf-8')
+
+    poligonos_amenaza = poligonos_amenaza or max(num_poligonos // 10, 1)
+    for i, nombre in enumerate(VARIABLES_AMENAZA):
+        geometrias = rejilla_poligonos(poligonos_amenaza, extension, semilla=semilla + i + 1)
+        variable = gpd.GeoDataFrame({'gridcode': rng.integers(1, 6, len(geometrias))},
+                                    geometry=geometrias, crs=CRS_SINTETICO)
+        variable.to_file(os.path.join(carpeta, 'shp', f'{nombre}.shp'))
+
+    return {'ruta_cobertura': ruta_cobertura, 'campo_cobertura': 'N3_COBERT',
+            'ruta_shps_amenaza': os.path.join(carpeta, 'shp')}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera un área de estudio sintética.")
+    parser.add_argument('carpeta')
+    parser.add_argument('--poligonos', type=int, default=10000, help="Polígonos de cobertura")
+    parser.add_argument('--poligonos-amenaza', type=int, default=None,
+                        help="Polígonos por variable de amenaza (por defecto, una décima parte)")
+    parser.add_argument('--extension', type=float, default=5000.0, help="Lado del área, en metros")
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args(argv)
+    area = generar_area(args.carpeta, args.poligonos, args.extension, args.poligonos_amenaza, args.semilla)
+    print(area['ruta_cobertura'])
+
+if __name__ == '__main__':
+    main()
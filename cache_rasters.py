@@ -0,0 +1,237 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo por defecto de la caché en disco
+TAMANO_MAX_CACHE_MB = 2048
+
+# Se incrementa cuando cambia la forma de calificar o rasterizar, para invalidar entradas antiguas
+VERSION_RASTERIZADO = 1
+
+# Archivos que componen un shapefile y que afectan el resultado
+EXTENSIONES_SHAPEFILE = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+def archivos_componentes(ruta):
+    """Devuelve la lista de archivos que componen una capa (todos los del shapefile o solo el archivo)."""
+    base, extension = os.path.splitext(ruta)
+    if extension.lower() != '.shp':
+        return [ruta]
+    componentes = []
+    for ext in EXTENSIONES_SHAPEFILE:
+        for candidato in (base + ext, base + ext.upper()):
+            if os.path.exists(candidato):
+                componentes.append(candidato)
+                break
+    return componentes
+
+def _hash_archivo(ruta, tamano_bloque=1 << 20):
+    """Calcula el SHA-256 del contenido de un archivo leyendo por bloques."""
+    h = hashlib.sha256()
+    with open(ruta, 'rb') as f:
+        for bloque in iter(lambda: f.read(tamano_bloque), b''):
+            h.update(bloque)
+    return h.hexdigest()
+
+@contextmanager
+def bloqueo_archivo(ruta):
+    """
+    Bloqueo exclusivo entre procesos (y entre hilos que lo pidan por separado) sobre el
+    archivo ruta, que se crea si no existe. Se libera al salir del bloque o si el
+    proceso termina.
+    """
+    with open(ruta, 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK se rinde tras unos segundos: seguir esperando
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def escribir_json_atomico(ruta, datos, **opciones):
+    """Escribe datos como JSON en un temporal único del mismo directorio y lo mueve a ruta."""
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta) or '.', prefix=os.path.basename(ruta) + '.',
+                                            suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as f:
+            json.dump(datos, f, **opciones)
+        os.replace(temporal, ruta)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+def _enlazar_o_copiar(origen, destino):
+    """
+    Crea un enlace duro de origen en destino (o una copia si no es posible). El enlace se
+    crea con un nombre temporal y reemplaza destino de una vez, así que quien lo lea en
+    ese momento ve el archivo anterior o el nuevo, nunca ninguno.
+    """
+    temporal = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(origen, temporal)
+    except OSError:
+        shutil.copyfile(origen, temporal)
+    os.replace(temporal, destino)
+
+class CacheRasters:
+    """
+    Caché persistente de rasters calificados, indexada por el contenido de las entradas.
+
+    La clave combina el hash de los archivos de entrada con los parámetros que afectan el
+    resultado (esquema de calificación, resolución y rejilla de destino). Las entradas se
+    desalojan por antigüedad de uso (LRU) cuando se supera el tamaño máximo.
+
+    La caché se comparte entre procesos (trabajadores de la cola, pools, servidores): cada
+    lectura-modificación-escritura del índice se hace bajo un bloqueo de archivo.
+    """
+
+    def __init__(self, directorio, tamano_max_mb=TAMANO_MAX_CACHE_MB):
+        self.directorio = directorio
+        self.tamano_max = int(tamano_max_mb * 1024 * 1024)
+        self.ruta_indice = os.path.join(directorio, 'indice.json')
+        self.ruta_bloqueo = os.path.join(directorio, 'indice.lock')
+        self.aciertos = 0
+        self.fallos = 0
+        self._bloqueo = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+
+    def _leer_indice(self):
+        try:
+            with open(self.ruta_indice, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'entradas': {}, 'firmas': {}}
+
+    def _escribir_indice(self, indice):
+        escribir_json_atomico(self.ruta_indice, indice)
+
+    @contextmanager
+    def _indice_bloqueado(self):
+        """Bloqueo del índice entre hilos de este objeto y entre procesos."""
+        with self._bloqueo, bloqueo_archivo(self.ruta_bloqueo):
+            yield
+
+    def hash_contenido(self, rutas):
+        """
+        Calcula el hash del contenido de las capas de entrada. Los hashes por archivo se
+        recuerdan en el índice junto con su tamaño y fecha de modificación, para no releer
+        archivos que no han cambiado.
+        """
+        # Los archivos se leen sin bloquear el índice; solo se bloquea para guardar las firmas nuevas
+        firmas = self._leer_indice().get('firmas', {})
+        nuevas = {}
+        h = hashlib.sha256()
+        for ruta in rutas:
+            for archivo in archivos_componentes(ruta):
+                estado = os.stat(archivo)
+                clave_archivo = os.path.abspath(archivo)
+                firma = firmas.get(clave_archivo)
+                if not firma or firma['tamano'] != estado.st_size or firma['mtime_ns'] != estado.st_mtime_ns:
+                    firma = {'tamano': estado.st_size, 'mtime_ns': estado.st_mtime_ns,
+                             'sha256': _hash_archivo(archivo)}
+                    nuevas[clave_archivo] = firma
+                h.update(os.path.splitext(archivo)[1].lower().encode())
+                h.update(firma['sha256'].encode())
+        if nuevas:
+            with self._indice_bloqueado():
+                indice = self._leer_indice()
+                indice.setdefault('firmas', {}).update(nuevas)
+                self._escribir_indice(indice)
+        return h.hexdigest()
+
+    def clave(self, rutas, **parametros):
+        """
+        Calcula la clave de caché a partir del contenido de las entradas y de los parámetros
+        (por ejemplo esquema de calificación, resolución y rejilla de destino).
+        """
+        h = hashlib.sha256()
+        h.update(self.hash_contenido(rutas).encode())
+        parametros = dict(parametros, version=VERSION_RASTERIZADO)
+        h.update(json.dumps(parametros, sort_keys=True, default=str).encode())
+        return h.hexdigest()
+
+    def obtener(self, clave, ruta_destino):
+        """
+        Si la clave está en la caché, deja el raster en ruta_destino y devuelve True.
+        """
+        with self._indice_bloqueado():
+            indice = self._leer_indice()
+            entrada = indice['entradas'].get(clave)
+            ruta_cache = os.path.join(self.directorio, entrada['archivo']) if entrada else None
+            if ruta_cache is None or not os.path.exists(ruta_cache):
+                self.fallos += 1
+                return False
+            _enlazar_o_copiar(ruta_cache, ruta_destino)
+            entrada['ultimo_uso'] = time.time()
+            self._escribir_indice(indice)
+            self.aciertos += 1
+            return True
+
+    def guardar(self, clave, ruta_origen):
+        """Guarda un raster recién generado en la caché y desaloja entradas si hace falta."""
+        with self._indice_bloqueado():
+            indice = self._leer_indice()
+            archivo = f"{clave}{os.path.splitext(ruta_origen)[1]}"
+            _enlazar_o_copiar(ruta_origen, os.path.join(self.directorio, archivo))
+            indice['entradas'][clave] = {'archivo': archivo, 'bytes': os.path.getsize(ruta_origen),
+                                         'ultimo_uso': time.time()}
+            self._desalojar(indice)
+            self._escribir_indice(indice)
+
+    def claves(self):
+        """Conjunto de claves con entrada en la caché."""
+        return set(self._leer_indice()['entradas'])
+
+    def _desalojar(self, indice):
+        """Elimina las entradas usadas hace más tiempo hasta quedar bajo el tamaño máximo."""
+        entradas = indice['entradas']
+        total = sum(e['bytes'] for e in entradas.values())
+        for clave, entrada in sorted(entradas.items(), key=lambda item: item[1]['ultimo_uso']):
+            if total <= self.tamano_max:
+                break
+            ruta = os.path.join(self.directorio, entrada['archivo'])
+            if os.path.exists(ruta):
+                os.remove(ruta)
+            total -= entrada['bytes']
+            del entradas[clave]
+            logger.info(f"Entrada de caché desalojada: {clave[:12]} ({entrada['bytes']} bytes)")
+
+    def invalidar(self):
+        """Elimina todas las entradas de la caché. Devuelve el número de entradas eliminadas."""
+        with self._indice_bloqueado():
+            indice = self._leer_indice()
+            n = len(indice['entradas'])
+            for entrada in indice['entradas'].values():
+                ruta = os.path.join(self.directorio, entrada['archivo'])
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+            self._escribir_indice({'entradas': {}, 'firmas': {}})
+            return n
+
+    def resumen(self):
+        """Texto con los aciertos y fallos de esta ejecución."""
+        return f"Caché de rasters: {self.aciertos} aciertos, {self.fallos} fallos"
@@ -0,0 +1,117 @@
+import glob
+import hashlib
+import logging
+import os
+import time
+import geopandas as gpd
+import numpy as np
+
+from cache_rasters import archivos_componentes
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyogrio
+    LECTURA_COLUMNAR = True
+except ImportError:
+    LECTURA_COLUMNAR = False
+
+try:
+    import pyarrow  # noqa: F401 (necesario para GeoParquet y para la lectura por Arrow)
+    ARROW_DISPONIBLE = True
+except ImportError:
+    ARROW_DISPONIBLE = False
+
+# Formato de las copias de lectura rápida: GeoParquet si hay pyarrow, si no FlatGeobuf
+FORMATO_AUXILIAR = 'parquet' if ARROW_DISPONIBLE else 'fgb'
+
+# Carpeta (junto al shapefile) donde se guardan las copias de lectura rápida
+CARPETA_AUXILIAR = '.carga'
+
+def firma_capa(ruta):
+    """
+    Firma corta de una capa a partir del tamaño y la fecha de modificación de sus
+    archivos: cambia cuando se reemplaza el shapefile y con ella la copia auxiliar.
+    """
+    h = hashlib.sha256()
+    for componente in archivos_componentes(ruta):
+        estado = os.stat(componente)
+        h.update(f"{os.path.basename(componente)}:{estado.st_size}:{estado.st_mtime_ns}|".encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def ruta_auxiliar(ruta):
+    """Ruta de la copia de lectura rápida de una capa (depende de su firma)."""
+    base = os.path.splitext(os.path.basename(ruta))[0]
+    return os.path.join(os.path.dirname(os.path.abspath(ruta)), CARPETA_AUXILIAR,
+                        f"{base}-{firma_capa(ruta)}.{FORMATO_AUXILIAR}")
+
+def campos_capa(ruta):
+    """Campos de atributos de una capa y su tipo (dtype de NumPy), sin leer los registros."""
+    if LECTURA_COLUMNAR:
+        info = pyogrio.read_info(ruta)
+        return dict(zip(info['fields'], (np.dtype(t) for t in info['dtypes'])))
+    gdf = gpd.read_file(ruta, rows=1)
+    return {c: gdf[c].dtype for c in gdf.columns if c != gdf.geometry.name}
+
+def _crear_auxiliar(ruta, destino):
+    """
+    Convierte la capa completa (todos los campos) en la copia auxiliar. Se escribe en un
+    archivo temporal que se renombra al final, y se borran las copias de versiones anteriores.
+    """
+    inicio = time.perf_counter()
+    gdf = pyogrio.read_dataframe(ruta, use_arrow=ARROW_DISPONIBLE)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporal = f"{destino}.{os.getpid()}.tmp"
+    if FORMATO_AUXILIAR == 'parquet':
+        gdf.to_parquet(temporal, write_covering_bbox=True)
+    else:
+        pyogrio.write_dataframe(gdf, temporal, driver='FlatGeobuf')
+    os.replace(temporal, destino)
+
+    base = os.path.splitext(os.path.basename(ruta))[0]
+    for anterior in glob.glob(os.path.join(os.path.dirname(destino), f"{glob.escape(base)}-*.{FORMATO_AUXILIAR}")):
+        if anterior != destino:
+            os.remove(anterior)
+    logger.info(f"Copia {FORMATO_AUXILIAR} de {os.path.basename(ruta)} creada en {time.perf_counter() - inicio:.2f} s")
+
+def _auxiliar(ruta):
+    """
+    Devuelve la ruta de la copia auxiliar de un shapefile, creándola si no existe. Devuelve
+    None si no se puede usar (otro formato, sin pyogrio o carpeta sin permiso de escritura).
+    """
+    if not LECTURA_COLUMNAR or os.path.splitext(ruta)[1].lower() != '.shp':
+        return None
+    destino = ruta_auxiliar(ruta)
+    if not os.path.exists(destino):
+        try:
+            _crear_auxiliar(ruta, destino)
+        except OSError as e:
+            logger.warning(f"No se pudo crear la copia auxiliar de {os.path.basename(ruta)} ({e}); se lee el shapefile")
+            return None
+    return destino
+
+def leer_capa(ruta, columnas=None, bbox=None, usar_auxiliar=True):
+    """
+    Lee una capa vectorial con solo las columnas indicadas (además de la geometría) y,
+    opcionalmente, solo las geometrías que tocan bbox = (minx, miny, maxx, maxy) en el CRS
+    de la capa. Con pyogrio la lectura es por columnas (Arrow) y, para los shapefiles, se
+    hace desde una copia GeoParquet/FlatGeobuf que se crea en el primer uso. Las filas se
+    devuelven en el orden del archivo.
+    """
+    inicio = time.perf_counter()
+    columnas = list(columnas) if columnas is not None else None
+    auxiliar = _auxiliar(ruta) if usar_auxiliar else None
+    if auxiliar and FORMATO_AUXILIAR == 'parquet':
+        origen = 'geoparquet'
+        gdf = gpd.read_parquet(auxiliar, columns=None if columnas is None else columnas + ['geometry'], bbox=bbox)
+    elif LECTURA_COLUMNAR:
+        origen = 'flatgeobuf' if auxiliar else 'ogr'
+        gdf = pyogrio.read_dataframe(auxiliar or ruta, columns=columnas, bbox=bbox, use_arrow=ARROW_DISPONIBLE)
+    else:
+        origen = 'read_file'
+        gdf = gpd.read_file(ruta, bbox=bbox)
+        if columnas is not None:
+            gdf = gdf[columnas + [gdf.geometry.name]]
+    logger.info(f"Capa {os.path.basename(ruta)} leída ({origen}) en {time.perf_counter() - inicio:.3f} s: "
+                f"{len(gdf)} geometrías, columnas {columnas if columnas is not None else 'todas'}")
+    return gdf
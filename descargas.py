@@ -0,0 +1,125 @@
+"""
+Descargas de resultados del almacén servidas directamente por Flask, sin pasar por un
+callback de Dash: los archivos se envían por bloques y admiten peticiones de rango (HTTP
+Range), y la exportación en ZIP se genera mientras se envía, sin escribirla en disco.
+"""
+import json
+import logging
+import os
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de los bloques leídos de cada archivo al generar el ZIP
+TAMANO_BLOQUE_ZIP = 1024 * 1024
+
+# Los GeoTIFF ya van comprimidos: se guardan en el ZIP sin recomprimir
+EXTENSIONES_SIN_COMPRIMIR = ('.tif', '.tiff', '.zip')
+
+# Resultados de una sesión que se incluyen en la exportación, en este orden
+RESULTADOS_EXPORTACION = ('susceptibilidad', 'amenaza')
+
+def url_descarga(id_resultado, archivo):
+    """URL de descarga de un archivo de un resultado del almacén."""
+    return f'/descargas/{id_resultado}/{archivo}'
+
+def url_exportacion(sesion):
+    """URL de la exportación en ZIP de los resultados de una sesión."""
+    return f'/exportar/{sesion}.zip'
+
+class _SalidaZip:
+    """
+    Destino de escritura del ZIP que acumula lo escrito hasta que se entrega. No tiene
+    seek ni tell, así que zipfile escribe los tamaños tras cada archivo (descriptores de
+    datos) y no necesita volver atrás.
+    """
+
+    def __init__(self):
+        self.partes = []
+
+    def write(self, datos):
+        self.partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self.partes)
+        self.partes = []
+        return datos
+
+def generar_zip(archivos, metadatos=None):
+    """
+    Genera por bloques un ZIP con archivos (lista de pares nombre en el ZIP, ruta) y, si
+    se da, metadatos.json. Nunca tiene en memoria más de un bloque de cada archivo.
+    """
+    salida = _SalidaZip()
+    with zipfile.ZipFile(salida, 'w', allowZip64=True) as zip_salida:
+        for nombre, ruta in archivos:
+            info = zipfile.ZipInfo.from_file(ruta, nombre)
+            info.compress_type = (zipfile.ZIP_STORED if nombre.lower().endswith(EXTENSIONES_SIN_COMPRIMIR)
+                                  else zipfile.ZIP_DEFLATED)
+            with open(ruta, 'rb') as origen, zip_salida.open(info, 'w', force_zip64=True) as destino:
+                while True:
+                    bloque = origen.read(TAMANO_BLOQUE_ZIP)
+                    if not bloque:
+                        break
+                    destino.write(bloque)
+                    yield salida.vaciar()
+            yield salida.vaciar()
+        if metadatos is not None:
+            zip_salida.writestr('metadatos.json', json.dumps(metadatos, indent=2, ensure_ascii=False, default=str),
+                                compress_type=zipfile.ZIP_DEFLATED)
+    yield salida.vaciar()
+
+def archivos_exportacion(almacen, sesion):
+    """
+    Archivos y metadatos de la exportación de una sesión: los de su último resultado de
+    cada tipo de RESULTADOS_EXPORTACION (rasters, clases, variables y manifiesto).
+    """
+    archivos, metadatos = [], {'sesion': sesion, 'exportado': time.strftime('%Y-%m-%dT%H:%M:%S'), 'resultados': {}}
+    for tipo in RESULTADOS_EXPORTACION:
+        id_resultado = almacen.resultado_sesion(sesion, tipo)
+        manifiesto = almacen.obtener(id_resultado) if id_resultado else None
+        if manifiesto is None:
+            continue
+        metadatos['resultados'][tipo] = manifiesto
+        carpeta = almacen.ruta_objeto(id_resultado)
+        archivos += [(nombre, os.path.join(carpeta, nombre)) for nombre in sorted(manifiesto['archivos'])
+                     if nombre not in dict(archivos)]
+    return archivos, metadatos
+
+def registrar_descargas(servidor, almacen):
+    """
+    Añade al servidor Flask de la aplicación las rutas /descargas/<id>/<archivo> (un
+    archivo de un resultado, con soporte de rangos) y /exportar/<sesion>.zip (todos los
+    resultados de la sesión en un ZIP generado al vuelo).
+    """
+    import flask
+
+    def descarga(id_resultado, archivo):
+        # Solo los archivos que figuran en el manifiesto: el nombre no puede salir de la carpeta
+        manifiesto = almacen.obtener(id_resultado) if id_resultado.isalnum() else None
+        if manifiesto is None or archivo not in manifiesto['archivos']:
+            flask.abort(404)
+        # Los resultados publicados no cambian: el navegador puede reanudar y guardar la descarga
+        respuesta = flask.send_file(os.path.join(almacen.ruta_objeto(id_resultado), archivo),
+                                    as_attachment=True, download_name=archivo, conditional=True)
+        respuesta.headers['Cache-Control'] = 'private, max-age=86400, immutable'
+        return respuesta
+
+    def exportar(sesion):
+        archivos, metadatos = archivos_exportacion(almacen, sesion)
+        if not archivos:
+            flask.abort(404)
+        logger.info(f"Exportando {len(archivos)} archivos de la sesión {sesion[:8]}")
+        respuesta = flask.Response(flask.stream_with_context(generar_zip(archivos, metadatos)),
+                                   mimetype='application/zip')
+        respuesta.headers['Content-Disposition'] = 'attachment; filename=resultados_vdom.zip'
+        respuesta.headers['Cache-Control'] = 'no-store'
+        return respuesta
+
+    servidor.add_url_rule('/descargas/<id_resultado>/<archivo>', 'descarga_resultado', descarga)
+    servidor.add_url_rule('/exportar/<sesion>.zip', 'exportar_resultados', exportar)
@@ -0,0 +1,197 @@
+"""
+Sensibilidad de la amenaza a los pesos: evalúa muchos juegos de pesos (una matriz de
+escenarios o un muestreo de Monte Carlo alrededor de los pesos del protocolo) sobre la
+pila de bandas alineadas y resume, píxel a píxel, cuánto cambia la clase de amenaza.
+
+Uso:
+    python -m escenarios resultados/pila/pila_<clave>.npy --montecarlo 500 --sigma 0.2 --salida resultados
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from contextlib import ExitStack
+import numpy as np
+from rasterio import windows
+
+from escritura import SalidaRaster, salida_clases
+from reclasificacion import CORTES_CLASES, reclasificar
+
+logger = logging.getLogger(__name__)
+
+# Memoria aproximada (MB) para los escenarios de un bloque: el bloque se ajusta al número de escenarios
+MEMORIA_BLOQUE_ESCENARIOS_MB = 256
+
+# Bytes por escenario y píxel en un bloque: amenaza, peso total y diferencias (float32) y clase (uint8)
+BYTES_ESCENARIO_PIXEL = 13
+
+# Rasters de resumen: nombre -> descripción
+RESUMENES_ESCENARIOS = {
+    'clase_media': "Clase media de amenaza entre los escenarios (0-5)",
+    'clase_modal': "Clase más frecuente entre los escenarios",
+    'acuerdo': "Fracción de escenarios que dan la clase más frecuente (1 = todos coinciden)",
+    'desviacion': "Desviación estándar de la amenaza entre los escenarios"
+}
+
+def matriz_pesos(escenarios, nombres):
+    """
+    Convierte una lista de juegos de pesos (diccionarios variable -> peso) en una matriz
+    escenarios x variables en el orden de nombres. Las variables que falten en un escenario
+    tienen peso 0.
+    """
+    matriz = np.array([[float(escenario.get(nombre, 0.0)) for nombre in nombres] for escenario in escenarios],
+                      dtype=np.float32)
+    if matriz.ndim != 2 or len(matriz) == 0:
+        raise ValueError("Se necesita al menos un escenario de pesos")
+    if (matriz < 0).any():
+        raise ValueError("Los pesos de los escenarios no pueden ser negativos")
+    return matriz
+
+def pesos_monte_carlo(pesos_base, nombres, num_escenarios, sigma=0.2, semilla=0):
+    """
+    Genera num_escenarios juegos de pesos perturbando cada peso base con un factor
+    multiplicativo 1 + sigma * N(0, 1), recortado a 0 (un peso no puede ser negativo).
+    El primer escenario es el de los pesos base sin perturbar.
+    """
+    rng = np.random.default_rng(semilla)
+    base = np.array([pesos_base[nombre] for nombre in nombres], dtype=np.float64)
+    factores = 1.0 + sigma * rng.standard_normal((num_escenarios, len(nombres)))
+    factores[0] = 1.0
+    return np.clip(base * factores, 0.0, None).astype(np.float32)
+
+def filas_por_bloque(num_escenarios, ancho, memoria_mb=MEMORIA_BLOQUE_ESCENARIOS_MB):
+    """Filas de la rejilla por bloque para que los escenarios de un bloque quepan en memoria_mb."""
+    pixeles = memoria_mb * 1024 * 1024 // (BYTES_ESCENARIO_PIXEL * max(num_escenarios, 1))
+    return max(1, pixeles // max(ancho, 1))
+
+def evaluar_bloque(datos, matriz):
+    """
+    Evalúa todos los escenarios sobre un bloque de la pila (variables x píxeles, NaN = sin
+    datos) como dos productos de matrices: la suma ponderada de las calificaciones válidas
+    y el peso total válido de cada escenario en cada píxel. Devuelve la amenaza
+    (escenarios x píxeles, float32), 0 donde ningún peso es válido, igual que
+    combinar_ponderado.
+    """
+    validos = ~np.isnan(datos)
+    calificaciones = np.where(validos, datos, 0)
+    amenaza = matriz @ calificaciones
+    peso_total = matriz @ validos.astype(np.float32)
+    np.divide(amenaza, peso_total, out=amenaza, where=peso_total > 0)
+    amenaza[peso_total <= 0] = 0
+    return np.nan_to_num(amenaza, copy=False)
+
+def resumir_bloque(amenaza, num_clases=len(CORTES_CLASES) + 2):
+    """
+    Resume los escenarios de un bloque: clase media, clase modal, acuerdo (fracción de
+    escenarios con la clase modal) y desviación estándar de la amenaza, por píxel.
+    La clase media sale de los conteos por clase y la desviación de la suma y la suma de
+    cuadrados de las diferencias con el primer escenario, que evitan la cancelación.
+    """
+    num_escenarios = amenaza.shape[0]
+    clases = reclasificar(amenaza)
+    conteos = np.stack([(clases == c).sum(axis=0, dtype=np.int32) for c in range(num_clases)])
+    modal = conteos.argmax(axis=0).astype(np.uint8)
+
+    diferencias = amenaza - amenaza[0]
+    suma = np.ones(num_escenarios, dtype=np.float32) @ diferencias
+    suma_cuadrados = np.einsum('ij,ij->j', diferencias, diferencias)
+    media = suma.astype(np.float64) / num_escenarios
+    varianza = np.maximum(suma_cuadrados / num_escenarios - media * media, 0)
+    return {
+        'clase_media': (np.arange(num_clases, dtype=np.float32) @ conteos.astype(np.float32)) / num_escenarios,
+        'clase_modal': modal,
+        'acuerdo': (conteos.max(axis=0) / np.float32(num_escenarios)).astype(np.float32),
+        'desviacion': np.sqrt(varianza).astype(np.float32)
+    }
+
+def evaluar_escenarios(pila, matriz, nombres, ruta_resultados, compresion=None,
+                       memoria_mb=MEMORIA_BLOQUE_ESCENARIOS_MB, progreso=None):
+    """
+    Evalúa una matriz de pesos (escenarios x variables, variables en el orden de nombres)
+    sobre una PilaBandas, por bloques de filas, y escribe los rasters de resumen
+    escenarios_<resumen>.tif (ver RESUMENES_ESCENARIOS) en ruta_resultados. Solo se tiene
+    en memoria la amenaza de todos los escenarios para un bloque, nunca la rejilla completa.
+    Si se da progreso, se llama con la fracción de filas evaluadas. Devuelve un resumen
+    con las rutas y el rendimiento en escenarios-píxel por segundo.
+    """
+    faltan = [nombre for nombre in nombres if nombre not in pila.nombres]
+    if faltan:
+        raise ValueError(f"La pila no tiene las variables: {', '.join(faltan)}")
+    matriz = np.asarray(matriz, dtype=np.float32)
+    indices = [pila.nombres.index(nombre) for nombre in nombres]
+    alto, ancho = pila.forma
+    filas = filas_por_bloque(len(matriz), ancho, memoria_mb)
+
+    os.makedirs(ruta_resultados, exist_ok=True)
+    rutas = {nombre: os.path.join(ruta_resultados, f'escenarios_{nombre}.tif') for nombre in RESUMENES_ESCENARIOS}
+    salidas = {nombre: SalidaRaster(ruta, pila.forma, np.float32, pila.crs, pila.transform, compresion=compresion)
+               for nombre, ruta in rutas.items() if nombre != 'clase_modal'}
+    salidas['clase_modal'] = salida_clases(rutas['clase_modal'], pila.forma, pila.crs, pila.transform,
+                                           compresion=compresion)
+
+    inicio = time.perf_counter()
+    segundos_calculo = 0.0
+    # ExitStack pasa la excepción a cada salida: ante un error se descartan sin publicar el COG
+    with ExitStack() as pila_salidas:
+        abiertos = {nombre: pila_salidas.enter_context(salida) for nombre, salida in salidas.items()}
+        for fila in range(0, alto, filas):
+            ventana = windows.Window(0, fila, ancho, min(filas, alto - fila))
+            inicio_bloque = time.perf_counter()
+            datos = pila.bandas[indices, fila:fila + int(ventana.height)].reshape(len(indices), -1)
+            resumen_bloque = resumir_bloque(evaluar_bloque(datos, matriz))
+            segundos_calculo += time.perf_counter() - inicio_bloque
+            forma_ventana = (int(ventana.height), int(ventana.width))
+            for nombre, dst in abiertos.items():
+                dst.write(resumen_bloque[nombre].reshape(forma_ventana), 1, window=ventana)
+            if progreso is not None:
+                progreso(min(fila + filas, alto) / alto)
+
+    segundos = time.perf_counter() - inicio
+    pixeles_escenario = len(matriz) * alto * ancho
+    resumen = {
+        'escenarios': len(matriz),
+        'variables': list(nombres),
+        'rutas': rutas,
+        'filas_por_bloque': filas,
+        'segundos': round(segundos, 3),
+        'segundos_calculo': round(segundos_calculo, 3),
+        'escenarios_pixel_por_segundo': round(pixeles_escenario / max(segundos_calculo, 1e-9)),
+        'escritura': [salida.informe for salida in salidas.values()]
+    }
+    logger.info(f"{len(matriz)} escenarios evaluados sobre {alto} x {ancho} píxeles en {segundos:.2f} s "
+                f"({resumen['escenarios_pixel_por_segundo'] / 1e6:.1f} M escenarios-píxel/s de cálculo)")
+    return resumen
+
+def main(argv=None):
+    from pila_bandas import PilaBandas
+    from pipeline import PESOS_POR_DEFECTO
+
+    parser = argparse.ArgumentParser(description="Sensibilidad de la amenaza a los pesos sobre una pila alineada.")
+    parser.add_argument('pila', help="Archivo .npy de la pila alineada (resultados/pila/pila_<clave>.npy)")
+    parser.add_argument('--escenarios', default=None, help="Archivo JSON con una lista de juegos de pesos")
+    parser.add_argument('--montecarlo', type=int, default=100, help="Número de escenarios de Monte Carlo")
+    parser.add_argument('--sigma', type=float, default=0.2, help="Desviación relativa de los pesos")
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--salida', default='.', help="Carpeta de los rasters de resumen")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    ruta_meta = os.path.splitext(args.pila)[0] + '.json'
+    if not os.path.exists(ruta_meta):
+        parser.error(f"No hay una pila en {args.pila}")
+    with open(ruta_meta, encoding='utf-8') as f:
+        clave = json.load(f)['clave']
+    pila = PilaBandas.abrir(os.path.dirname(os.path.abspath(args.pila)), clave)
+    if pila is None:
+        parser.error(f"La pila {args.pila} está incompleta")
+    nombres = [nombre for nombre in pila.nombres if nombre in PESOS_POR_DEFECTO]
+    if args.escenarios:
+        with open(args.escenarios, encoding='utf-8') as f:
+            matriz = matriz_pesos(json.load(f), nombres)
+    else:
+        matriz = pesos_monte_carlo(PESOS_POR_DEFECTO, nombres, args.montecarlo, args.sigma, args.semilla)
+    print(json.dumps(evaluar_escenarios(pila, matriz, nombres, args.salida), indent=2, ensure_ascii=False))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import functools
+import logging
+import os
+import time
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+logger = logging.getLogger(__name__)
+
+# Compresión de los rasters de salida (se puede cambiar con la variable de entorno VDOM_COMPRESION)
+COMPRESIONES = ('zstd', 'deflate', 'lzw', 'none')
+COMPRESION_POR_DEFECTO = os.environ.get('VDOM_COMPRESION', 'zstd').lower()
+
+# Nivel de compresión de ZSTD y DEFLATE en los archivos finales
+NIVEL_COMPRESION = {'zstd': 9, 'deflate': 6}
+
+# Tamaño de las teselas internas de los COG
+TAMANO_BLOQUE_COG = 512
+
+# Las vistas generales se generan hasta que el lado mayor queda por debajo de este tamaño
+LADO_MINIMO_VISTAS = 256
+
+def construir_vistas_generales(ruta, lado_minimo=LADO_MINIMO_VISTAS):
+    """
+    Genera las vistas generales (overviews) internas de un raster por vecino más cercano,
+    con factores 2, 4, 8... hasta que el lado mayor queda por debajo de lado_minimo. Así
+    las teselas de zoom bajo se leen de una vista reducida y no de la resolución completa.
+    """
+    inicio = time.perf_counter()
+    with rasterio.open(ruta, 'r+') as dst:
+        factores = []
+        factor = 2
+        while max(dst.height, dst.width) / factor >= lado_minimo:
+            factores.append(factor)
+            factor *= 2
+        if not factores:
+            return []
+        dst.build_overviews(factores, Resampling.nearest)
+        dst.update_tags(ns='rio_overview', resampling='nearest')
+    logger.info(f"Vistas generales {factores} creadas para {os.path.basename(ruta)} "
+                f"en {time.perf_counter() - inicio:.2f} s")
+    return factores
+
+@functools.lru_cache(maxsize=None)
+def compresion_disponible(compresion):
+    """Indica si la versión de GDAL instalada admite la compresión (se prueba una sola vez)."""
+    if compresion == 'none':
+        return True
+    try:
+        with MemoryFile() as memoria:
+            with memoria.open(driver='GTiff', width=16, height=16, count=1, dtype='uint8',
+                              transform=from_origin(0, 16, 1, 1), compress=compresion) as dst:
+                dst.write(np.zeros((1, 16, 16), dtype=np.uint8))
+        return True
+    except Exception:
+        return False
+
+def _elegir_compresion(compresion):
+    compresion = (compresion or COMPRESION_POR_DEFECTO).lower()
+    if compresion not in COMPRESIONES:
+        raise ValueError(f"Compresión desconocida: {compresion} (opciones: {', '.join(COMPRESIONES)})")
+    if not compresion_disponible(compresion):
+        logger.warning(f"GDAL no admite la compresión {compresion}; se usa deflate")
+        compresion = 'deflate'
+    return compresion
+
+class SalidaRaster:
+    """
+    Escribe un raster de una banda como COG (GeoTIFF optimizado para la nube): en teselas,
+    con vistas generales internas por vecino más cercano y compresión ZSTD o DEFLATE con
+    predictor (horizontal para enteros, de coma flotante para float32).
+
+    Se usa como contexto: devuelve un dataset en el que se escribe (completo o por
+    ventanas); al salir se generan las vistas generales y se copia al COG final. Los datos
+    se escriben primero en un GeoTIFF temporal junto al destino porque el formato COG solo
+    se puede crear por copia. Después de salir, informe tiene el tamaño del archivo y la
+    velocidad de escritura (desde que se abre, incluidas las escrituras por ventanas, y la
+    de la conversión por separado).
+    """
+
+    def __init__(self, ruta, forma, dtype, crs, transform, nodata=None, colormap=None,
+                 compresion=None, vistas=True, tamano_bloque=TAMANO_BLOQUE_COG):
+        self.ruta = ruta
+        self.forma = forma
+        self.dtype = np.dtype(dtype)
+        self.crs = crs
+        self.transform = transform
+        self.nodata = nodata
+        self.colormap = colormap
+        self.compresion = _elegir_compresion(compresion)
+        self.vistas = vistas
+        self.tamano_bloque = tamano_bloque
+        self.informe = None
+        self._temporal = f"{ruta}.{os.getpid()}.tmp.tif"
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        # El temporal usa compresión rápida: solo existe hasta la copia al COG
+        rapida = {'compress': 'zstd', 'zstd_level': 1} if compresion_disponible('zstd') else {}
+        self._dst = rasterio.open(self._temporal, 'w', driver='GTiff', height=self.forma[0], width=self.forma[1],
+                                  count=1, dtype=self.dtype.name, crs=self.crs, transform=self.transform,
+                                  nodata=self.nodata, tiled=True, blockxsize=self.tamano_bloque,
+                                  blockysize=self.tamano_bloque, BIGTIFF='IF_SAFER', **rapida)
+        # La paleta se escribe antes que los datos: después GDAL ya no puede cambiar la interpretación
+        if self.colormap is not None:
+            self._dst.write_colormap(1, self.colormap)
+        return self._dst
+
+    def __exit__(self, tipo, valor, traza):
+        try:
+            self._dst.close()
+            if tipo is None:
+                self._convertir()
+        finally:
+            if os.path.exists(self._temporal):
+                os.remove(self._temporal)
+        return False
+
+    def _convertir(self):
+        inicio_conversion = time.perf_counter()
+        factores = construir_vistas_generales(self._temporal) if self.vistas else []
+        opciones = {'BLOCKSIZE': self.tamano_bloque, 'BIGTIFF': 'IF_SAFER',
+                    'OVERVIEWS': 'FORCE_USE_EXISTING' if factores else 'NONE',
+                    'COMPRESS': self.compresion.upper()}
+        if self.compresion in ('zstd', 'deflate', 'lzw'):
+            opciones['PREDICTOR'] = 'YES'
+        if self.compresion in NIVEL_COMPRESION:
+            opciones['LEVEL'] = NIVEL_COMPRESION[self.compresion]
+        # La ruta final puede ser un enlace a una entrada de la caché de rasters, y otro
+        # proceso puede estar leyéndola: escribir el COG aparte y reemplazarla de una vez
+        ruta_cog = f'{self.ruta}.{os.getpid()}.cog'
+        try:
+            rasterio.shutil.copy(self._temporal, ruta_cog, driver='COG', **opciones)
+            os.replace(ruta_cog, self.ruta)
+        finally:
+            if os.path.exists(ruta_cog):
+                os.remove(ruta_cog)
+
+        fin = time.perf_counter()
+        segundos = fin - self._inicio
+        bytes_datos = self.forma[0] * self.forma[1] * self.dtype.itemsize
+        bytes_archivo = os.path.getsize(self.ruta)
+        self.informe = {
+            'ruta': self.ruta,
+            'compresion': self.compresion,
+            'vistas_generales': factores,
+            'segundos': round(segundos, 3),
+            'segundos_conversion': round(fin - inicio_conversion, 3),
+            'mb_datos': round(bytes_datos / 1e6, 2),
+            'mb_archivo': round(bytes_archivo / 1e6, 2),
+            'relacion_compresion': round(bytes_datos / max(bytes_archivo, 1), 2),
+            'mb_por_segundo': round(bytes_datos / 1e6 / max(segundos, 1e-9), 1)
+        }
+        logger.info(f"COG {os.path.basename(self.ruta)} escrito: {self.informe['mb_archivo']} MB "
+                    f"({self.compresion}, {self.informe['relacion_compresion']}:1) en {self.informe['segundos']:.2f} s "
+                    f"({self.informe['mb_por_segundo']} MB/s de datos)")
+
+def escribir_raster(ruta, datos, crs, transform, nodata=None, colormap=None, compresion=None, vistas=True):
+    """Escribe un arreglo 2D como COG y devuelve el informe de escritura."""
+    salida = SalidaRaster(ruta, datos.shape, datos.dtype, crs, transform, nodata=nodata,
+                          colormap=colormap, compresion=compresion, vistas=vistas)
+    with salida as dst:
+        dst.write(datos, 1)
+    return salida.informe
+
+def paleta_clases():
+    """Tabla de colores de las clases 0-5 para los rasters uint8 de clases."""
+    from visualizacion import PALETA_CLASES
+
+    return {i: color + (255,) for i, color in enumerate(PALETA_CLASES)}
+
+def salida_clases(ruta, forma, crs, transform, compresion=None, vistas=True):
+    """SalidaRaster para un raster de clases: uint8, paleta de clases y 0 (sin datos) como nodata."""
+    return SalidaRaster(ruta, forma, np.uint8, crs, transform, nodata=0, colormap=paleta_clases(),
+                        compresion=compresion, vistas=vistas)
+
+def escribir_clases(ruta, clases, crs, transform, compresion=None, vistas=True):
+    """Escribe un raster de clases (uint8) como COG y devuelve el informe de escritura."""
+    salida = salida_clases(ruta, clases.shape, crs, transform, compresion=compresion, vistas=vistas)
+    with salida as dst:
+        dst.write(clases, 1)
+    return salida.informe
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from cache_rasters import VERSION_RASTERIZADO, bloqueo_archivo, escribir_json_atomico
+
+logger = logging.getLogger(__name__)
+
+# Archivo del registro de etapas dentro de la carpeta de resultados
+NOMBRE_REGISTRO = 'grafo.json'
+
+def _hash_parametros(parametros):
+    parametros = dict(parametros, version=VERSION_RASTERIZADO)
+    return hashlib.sha256(json.dumps(parametros, sort_keys=True, default=str).encode()).hexdigest()
+
+def _clave_etapa(nombre, hashes_entradas, hash_parametros):
+    descripcion = {'etapa': nombre, 'entradas': sorted(hashes_entradas.items()), 'parametros': hash_parametros}
+    return hashlib.sha256(json.dumps(descripcion, sort_keys=True).encode()).hexdigest()
+
+def _clave_salida(clave_etapa, ruta):
+    """Clave de la caché de rasters bajo la que se guarda una salida de la etapa."""
+    return hashlib.sha256(f'{clave_etapa}/{os.path.basename(ruta)}'.encode()).hexdigest()
+
+class GrafoCalculo:
+    """
+    Grafo de las etapas de cálculo de una carpeta de resultados. Cada etapa (calificación
+    de coberturas, rasterizado de cada variable, superposición y reclasificación) se
+    guarda en grafo.json bajo una clave que combina el hash del contenido de sus entradas y
+    el de sus parámetros; sus salidas se guardan en la caché de rasters. Las entradas de
+    una etapa pueden ser salidas de otra (la amenaza depende de susceptibilidad.tif y de
+    los rasters de las variables), así que al cambiar una capa solo se reconstruyen las
+    etapas que dependen de ella.
+
+    El registro y la caché se comparten entre los trabajos de la carpeta de resultados,
+    aunque cada uno escriba sus salidas en su propia carpeta: una etapa ya calculada por
+    otro trabajo se reutiliza enlazando sus salidas desde la caché. El registro se
+    actualiza bajo un bloqueo de archivo, porque varios procesos pueden compartir la carpeta.
+    """
+
+    def __init__(self, ruta_resultados, cache):
+        self.ruta = os.path.join(ruta_resultados, NOMBRE_REGISTRO)
+        self.ruta_bloqueo = self.ruta + '.lock'
+        self.cache = cache
+        self.reutilizadas = []
+        self.reconstruidas = []
+        self._bloqueo = threading.Lock()
+
+    def _leer(self):
+        try:
+            with open(self.ruta, encoding='utf-8') as f:
+                return json.load(f).get('etapas', {})
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _escribir(self, etapas):
+        escribir_json_atomico(self.ruta, {'etapas': etapas}, indent=1)
+
+    def _hashes_entradas(self, entradas):
+        # Por nombre de archivo y no por ruta: cada trabajo tiene sus rasters intermedios en su carpeta
+        return {os.path.basename(ruta): self.cache.hash_contenido([ruta]) for ruta in entradas}
+
+    def _motivo(self, etapas, nombre, hashes, hash_parametros):
+        """Explica, comparando con el último cálculo de la etapa, por qué no hay uno vigente."""
+        anteriores = [etapa for etapa in etapas.values() if etapa['nombre'] == nombre]
+        if not anteriores:
+            return "sin cálculo anterior"
+        ultima = max(anteriores, key=lambda etapa: etapa['fecha'])
+        if ultima['parametros'] != hash_parametros:
+            return "cambiaron los parámetros"
+        cambiadas = sorted(archivo for archivo in set(hashes) | set(ultima['entradas'])
+                           if hashes.get(archivo) != ultima['entradas'].get(archivo))
+        return f"cambiaron las entradas {', '.join(cambiadas)}"
+
+    def vigente(self, nombre, entradas, parametros, salidas):
+        """
+        Si la etapa ya se calculó con las mismas entradas (por contenido) y parámetros y
+        sus salidas siguen en la caché, las deja en las rutas de salidas y devuelve los
+        datos guardados; si no, None. Anota en el registro de la ejecución si la etapa se
+        reutiliza o el motivo por el que hay que reconstruirla.
+        """
+        etapas = self._leer()
+        hashes = self._hashes_entradas(entradas)
+        hash_parametros = _hash_parametros(parametros)
+        etapa = etapas.get(_clave_etapa(nombre, hashes, hash_parametros))
+        if etapa is None:
+            motivo = self._motivo(etapas, nombre, hashes, hash_parametros)
+        else:
+            faltantes = [os.path.basename(ruta) for ruta in salidas
+                         if not self.cache.obtener(etapa['salidas'][os.path.basename(ruta)], ruta)]
+            if not faltantes:
+                self.reutilizadas.append(nombre)
+                logger.info(f"Etapa {nombre} reutilizada: entradas y parámetros sin cambios")
+                return etapa['datos']
+            motivo = f"faltan en la caché las salidas {', '.join(faltantes)}"
+        logger.info(f"Etapa {nombre} por reconstruir: {motivo}")
+        return None
+
+    def registrar(self, nombre, entradas, parametros, salidas, datos=None, reconstruida=True, claves_cache=None):
+        """
+        Guarda la etapa tras calcularla: sus salidas en la caché de rasters y, en el
+        registro, los hashes de las entradas y de los parámetros y los datos que se
+        quieran recuperar al reutilizarla (por ejemplo, la forma de la rejilla). Si las
+        salidas ya están en la caché, claves_cache da su clave (ruta -> clave). Con
+        reconstruida=False la etapa cuenta como reutilizada (su salida salió de la caché).
+        Las etapas cuyas salidas ya no están en la caché se eliminan del registro.
+        """
+        hashes = self._hashes_entradas(entradas)
+        hash_parametros = _hash_parametros(parametros)
+        clave = _clave_etapa(nombre, hashes, hash_parametros)
+        claves_salidas = {}
+        for ruta in salidas:
+            clave_salida = (claves_cache or {}).get(ruta)
+            if clave_salida is None:
+                clave_salida = _clave_salida(clave, ruta)
+                self.cache.guardar(clave_salida, ruta)
+            claves_salidas[os.path.basename(ruta)] = clave_salida
+        etapa = {'nombre': nombre, 'entradas': hashes, 'parametros': hash_parametros,
+                 'salidas': claves_salidas, 'datos': datos or {}, 'fecha': time.time()}
+        with self._bloqueo, bloqueo_archivo(self.ruta_bloqueo):
+            en_cache = self.cache.claves()
+            etapas = {clave_etapa: anterior for clave_etapa, anterior in self._leer().items()
+                      if set(anterior['salidas'].values()) <= en_cache}
+            etapas[clave] = etapa
+            self._escribir(etapas)
+        (self.reconstruidas if reconstruida else self.reutilizadas).append(nombre)
+
+    def resumen(self):
+        """Etapas reutilizadas y reconstruidas en esta ejecución."""
+        return {'reutilizadas': list(self.reutilizadas), 'reconstruidas': list(self.reconstruidas)}
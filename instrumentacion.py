@@ -0,0 +1,232 @@
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+logger = logging.getLogger(__name__)
+
+# Archivo (JSON por líneas) donde se registra la instrumentación de cada cálculo
+# (se puede cambiar con la variable de entorno VDOM_INSTRUMENTACION)
+RUTA_LOG_INSTRUMENTACION = os.environ.get('VDOM_INSTRUMENTACION',
+                                          os.path.join(os.path.expanduser('~'), '.vdom', 'instrumentacion.jsonl'))
+
+# Estadísticas de los resultados: None (no se calculan), 'completas' o 'muestra'
+MODOS_ESTADISTICAS = ('completas', 'muestra')
+
+# En modo 'muestra' se usa una de cada PASO_MUESTRA filas y columnas
+PASO_MUESTRA = 8
+
+# Histograma de la amenaza: intervalos iguales en el rango de las calificaciones
+RANGO_HISTOGRAMA = (0.0, 5.0)
+INTERVALOS_HISTOGRAMA = 50
+
+# Píxeles por franja al recorrer un arreglo: la franja cabe en caché y se recorre una sola vez
+PIXELES_FRANJA = 65536
+
+_bloqueo_log = threading.Lock()
+
+def reiniciar_pico_rss():
+    """Reinicia el pico de RSS del proceso (solo Linux). Devuelve False si no es posible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def memoria_rss_mb():
+    """RSS actual y pico de RSS del proceso en MB. El pico es desde el inicio o el último reinicio."""
+    try:
+        with open('/proc/self/status') as f:
+            campos = dict(linea.split(':', 1) for linea in f if linea.startswith(('VmRSS', 'VmHWM')))
+        return (round(int(campos['VmRSS'].split()[0]) / 1024, 1),
+                round(int(campos['VmHWM'].split()[0]) / 1024, 1))
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # Sin /proc solo se conoce el pico desde el inicio del proceso (KB en Linux, bytes en macOS)
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None, round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+class Instrumentacion:
+    """
+    Mide el tiempo de reloj, el tiempo de CPU y el pico de memoria de cada etapa de un
+    cálculo. Las etapas se abren con iniciar_etapa (o con el contexto etapa) y se cierran
+    al empezar la siguiente; si una etapa se repite, sus tiempos se acumulan.
+    """
+
+    def __init__(self, calculo):
+        self.calculo = calculo
+        self.etapas = {}
+        self.pico_por_etapa = True
+        self._actual = None
+        self._inicio = time.perf_counter()
+        self._inicio_cpu = time.process_time()
+        self._fecha = datetime.datetime.now().isoformat(timespec='seconds')
+
+    def iniciar_etapa(self, etapa):
+        if etapa == self._actual:
+            return
+        self._cerrar_etapa()
+        self.pico_por_etapa = reiniciar_pico_rss() and self.pico_por_etapa
+        self._actual = etapa
+        self._inicio_etapa = (time.perf_counter(), time.process_time())
+
+    def _cerrar_etapa(self):
+        if self._actual is None:
+            return
+        rss, pico = memoria_rss_mb()
+        medida = self.etapas.setdefault(self._actual, {'segundos': 0.0, 'cpu_segundos': 0.0, 'rss_pico_mb': None})
+        medida['segundos'] = round(medida['segundos'] + time.perf_counter() - self._inicio_etapa[0], 4)
+        medida['cpu_segundos'] = round(medida['cpu_segundos'] + time.process_time() - self._inicio_etapa[1], 4)
+        if pico is not None:
+            medida['rss_pico_mb'] = max(medida['rss_pico_mb'] or 0, pico)
+        medida['rss_final_mb'] = rss
+        self._actual = None
+
+    @contextmanager
+    def etapa(self, nombre):
+        self.iniciar_etapa(nombre)
+        try:
+            yield
+        finally:
+            self._cerrar_etapa()
+
+    def envolver(self, progreso):
+        """
+        Devuelve una función de progreso(etapa, fraccion) que abre la etapa al cambiar y
+        después llama a progreso (si se dio).
+        """
+        def progreso_medido(etapa, fraccion=None):
+            self.iniciar_etapa(etapa)
+            if progreso is not None:
+                progreso(etapa, fraccion)
+        return progreso_medido
+
+    def terminar(self, **contexto):
+        """
+        Cierra la etapa en curso y devuelve el resumen (serializable en JSON), con los datos
+        de contexto que se indiquen (modo, forma de la rejilla...).
+        """
+        self._cerrar_etapa()
+        _, pico = memoria_rss_mb()
+        return dict({
+            'calculo': self.calculo,
+            'fecha': self._fecha,
+            'pid': os.getpid(),
+            'segundos': round(time.perf_counter() - self._inicio, 4),
+            'cpu_segundos': round(time.process_time() - self._inicio_cpu, 4),
+            'rss_pico_mb': max([e['rss_pico_mb'] for e in self.etapas.values() if e['rss_pico_mb']] + [pico or 0]),
+            'pico_por_etapa': self.pico_por_etapa,
+            'etapas': self.etapas
+        }, **contexto)
+
+def registrar_en_archivo(resumen, ruta=None):
+    """Añade el resumen como una línea JSON al archivo de instrumentación."""
+    ruta = ruta or RUTA_LOG_INSTRUMENTACION
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        linea = json.dumps(resumen, ensure_ascii=False) + '\n'
+        with _bloqueo_log, open(ruta, 'a', encoding='utf-8') as f:
+            f.write(linea)
+    except OSError as e:
+        logger.warning(f"No se pudo escribir la instrumentación en {ruta}: {e}")
+
+class AcumuladorEstadisticas:
+    """
+    Mínimo, máximo, media, número de valores válidos (finitos) e histograma de un raster
+    que se recorre por partes: cada parte se procesa por franjas que caben en caché, de
+    modo que todas las estadísticas salen de una sola lectura de memoria. Los valores fuera
+    de rango cuentan en el primer o el último intervalo del histograma.
+    """
+
+    def __init__(self, rango=RANGO_HISTOGRAMA, intervalos=INTERVALOS_HISTOGRAMA):
+        self.rango = rango
+        self.intervalos = intervalos
+        self.minimo = np.inf
+        self.maximo = -np.inf
+        self.suma = 0.0
+        self.validos = 0
+        self.total = 0
+        self.conteos = np.zeros(intervalos, dtype=np.int64)
+
+    def agregar(self, datos):
+        filas = max(1, PIXELES_FRANJA // max(1, int(np.prod(datos.shape[1:]))))
+        escala = self.intervalos / (self.rango[1] - self.rango[0])
+        for inicio in range(0, datos.shape[0], filas):
+            trozo = datos[inicio:inicio + filas]
+            self.total += trozo.size
+            finitos = np.isfinite(trozo)
+            if not finitos.all():
+                trozo = trozo[finitos]
+            if trozo.size == 0:
+                continue
+            self.validos += trozo.size
+            self.minimo = min(self.minimo, float(trozo.min()))
+            self.maximo = max(self.maximo, float(trozo.max()))
+            self.suma += float(trozo.sum(dtype=np.float64))
+            indices = ((trozo - self.rango[0]) * escala).astype(np.intp).ravel()
+            np.clip(indices, 0, self.intervalos - 1, out=indices)
+            self.conteos += np.bincount(indices, minlength=self.intervalos)
+
+    def resultado(self):
+        hay_datos = self.validos > 0
+        return {
+            'min': self.minimo if hay_datos else None,
+            'max': self.maximo if hay_datos else None,
+            'media': self.suma / self.validos if hay_datos else None,
+            'validos': self.validos,
+            'total': self.total,
+            'histograma': {'limites': np.linspace(*self.rango, self.intervalos + 1).round(6).tolist(),
+                           'conteos': self.conteos.tolist()}
+        }
+
+def _paso(modo):
+    if modo not in MODOS_ESTADISTICAS:
+        raise ValueError(f"Modo de estadísticas desconocido: {modo}")
+    return PASO_MUESTRA if modo == 'muestra' else 1
+
+def conteo_clases(clases, num_clases=6):
+    """Número de píxeles de cada clase (0 = sin datos) de un raster reclasificado."""
+    return np.bincount(np.ravel(clases), minlength=num_clases).tolist()
+
+def estadisticas_raster(datos, modo='completas', clases=None):
+    """
+    Estadísticas de un arreglo en memoria en una sola pasada ('completas') o sobre una de
+    cada PASO_MUESTRA filas y columnas ('muestra'). Si se dan las clases, incluye su conteo.
+    """
+    paso = _paso(modo)
+    acumulador = AcumuladorEstadisticas()
+    acumulador.agregar(datos[::paso, ::paso])
+    resultado = dict(acumulador.resultado(), modo=modo, paso_muestra=paso)
+    if clases is not None:
+        resultado['clases'] = conteo_clases(clases[::paso, ::paso])
+    return resultado
+
+def estadisticas_archivo(ruta, modo='completas', banda=1):
+    """
+    Estadísticas de un raster en disco. En modo 'completas' se lee por bloques; en modo
+    'muestra' se lee una versión reducida (de las vistas generales, si las hay). Los
+    píxeles con el valor nodata del archivo no cuentan como válidos.
+    """
+    paso = _paso(modo)
+    acumulador = AcumuladorEstadisticas()
+    with rasterio.open(ruta) as src:
+        if paso > 1:
+            forma = (max(src.height // paso, 1), max(src.width // paso, 1))
+            bloques = [src.read(banda, out_shape=forma, resampling=Resampling.nearest, masked=True)]
+        else:
+            bloques = (src.read(banda, window=ventana, masked=True) for _, ventana in src.block_windows(banda))
+        for datos in bloques:
+            acumulador.agregar(datos.astype(np.float32).filled(np.nan))
+    return dict(acumulador.resultado(), modo=modo, paso_muestra=paso)
@@ -0,0 +1,175 @@
+"""
+Procesamiento por lotes de varias áreas de estudio sin la interfaz.
+
+Uso:
+    python lote.py manifiesto.json --trabajadores 4 --memoria-mb 4096 --salida resumen.json
+
+El manifiesto es un JSON con una lista de áreas (o un objeto con la clave 'areas' y,
+opcionalmente, valores por defecto en 'por_defecto'):
+
+    {
+        "por_defecto": {"campo_cobertura": "N3_COBERT", "modo": "bloques"},
+        "areas": [
+            {"nombre": "Abejorral", "ruta_cobertura": ".../cobertura.shp",
+             "ruta_shps_amenaza": ".../shp", "pesos": {"precipitacion": 0.25}}
+        ]
+    }
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pipeline import procesar_area
+
+logger = logging.getLogger(__name__)
+
+# Campos que acepta cada área del manifiesto (además de 'nombre')
+CAMPOS_AREA = ('ruta_cobertura', 'campo_cobertura', 'ruta_shps_amenaza', 'pesos', 'modo',
+               'ruta_resultados', 'num_trabajadores', 'tipo_pool', 'estadisticas', 'compresion')
+
+def leer_manifiesto(ruta):
+    """
+    Lee el manifiesto y devuelve la lista de áreas con los valores por defecto aplicados.
+    Las rutas relativas se interpretan respecto a la carpeta del manifiesto.
+    """
+    with open(ruta, encoding='utf-8') as f:
+        manifiesto = json.load(f)
+    if isinstance(manifiesto, list):
+        manifiesto = {'areas': manifiesto}
+
+    base = os.path.dirname(os.path.abspath(ruta))
+    por_defecto = manifiesto.get('por_defecto') or {}
+    areas = []
+    for i, area in enumerate(manifiesto['areas']):
+        area = dict(por_defecto, **area)
+        area['pesos'] = dict(por_defecto.get('pesos') or {}, **(area.get('pesos') or {}))
+        desconocidos = set(area) - set(CAMPOS_AREA) - {'nombre'}
+        if desconocidos:
+            raise ValueError(f"Campos desconocidos en el área {i}: {sorted(desconocidos)}")
+        for campo in ('ruta_cobertura', 'campo_cobertura', 'ruta_shps_amenaza'):
+            if not area.get(campo):
+                raise ValueError(f"Falta '{campo}' en el área {i}")
+        for campo in ('ruta_cobertura', 'ruta_shps_amenaza', 'ruta_resultados'):
+            if area.get(campo):
+                area[campo] = os.path.join(base, area[campo])
+        area.setdefault('nombre', os.path.basename(os.path.dirname(area['ruta_cobertura'])) or f'area_{i}')
+        areas.append(area)
+    return areas
+
+def limitar_memoria(memoria_mb):
+    """
+    Limita el espacio de direcciones del proceso actual a memoria_mb. Si se supera, las
+    reservas fallan con MemoryError y solo falla el área que se está procesando. No
+    disponible en Windows (módulo resource).
+    """
+    try:
+        import resource
+    except ImportError:
+        logger.warning("No se puede limitar la memoria en esta plataforma; se ejecuta sin límite.")
+        return
+    limite = int(memoria_mb * 1024 * 1024)
+    resource.setrlimit(resource.RLIMIT_AS, (limite, limite))
+
+def _iniciar_trabajador(memoria_mb, nivel_log):
+    logging.basicConfig(level=nivel_log, format='%(asctime)s %(processName)s %(name)s: %(message)s')
+    if memoria_mb:
+        limitar_memoria(memoria_mb)
+
+def _memoria_maxima_mb():
+    """Memoria residente máxima del proceso actual en MB (None si no se puede medir)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def ejecutar_area(area):
+    """Procesa un área en el proceso trabajador y devuelve su resumen (sin lanzar excepciones)."""
+    inicio = time.perf_counter()
+    parametros = {campo: area[campo] for campo in CAMPOS_AREA if campo in area}
+    resultado = {'nombre': area['nombre'], 'pid': os.getpid()}
+    try:
+        resultado.update(procesar_area(**parametros))
+        resultado['estado'] = 'ok'
+    except MemoryError:
+        resultado.update(estado='error', error="Se superó el límite de memoria por trabajo")
+    except Exception as e:
+        resultado.update(estado='error', error=f"{type(e).__name__}: {e}",
+                         traza=traceback.format_exc())
+    resultado.setdefault('segundos', {})['total'] = round(time.perf_counter() - inicio, 3)
+    resultado['memoria_maxima_mb'] = _memoria_maxima_mb()
+    logger.info(f"Área {area['nombre']}: {resultado['estado']} en {resultado['segundos']['total']:.1f} s")
+    return resultado
+
+def ejecutar_lote(areas, num_trabajadores=None, memoria_mb=None, nivel_log=logging.INFO):
+    """
+    Procesa las áreas en paralelo en un pool de procesos (un área por proceso a la vez),
+    con un límite de memoria por proceso. Devuelve el resumen del lote. Lanza ValueError
+    si hay nombres de área repetidos: el resumen se ordena e identifica por nombre.
+    """
+    nombres = [area['nombre'] for area in areas]
+    if len(set(nombres)) != len(nombres):
+        raise ValueError("Los nombres de las áreas deben ser únicos")
+    num_trabajadores = num_trabajadores or os.cpu_count() or 1
+    inicio = time.perf_counter()
+    resultados = []
+    # max_tasks_per_child=1: cada área empieza en un proceso nuevo y libera su memoria al terminar
+    with ProcessPoolExecutor(max_workers=num_trabajadores, max_tasks_per_child=1,
+                             initializer=_iniciar_trabajador, initargs=(memoria_mb, nivel_log)) as pool:
+        futuros = {pool.submit(ejecutar_area, area): area for area in areas}
+        for futuro in as_completed(futuros):
+            try:
+                resultados.append(futuro.result())
+            except Exception as e:
+                # El proceso trabajador terminó de forma anormal (por ejemplo, sin memoria)
+                resultados.append({'nombre': futuros[futuro]['nombre'], 'estado': 'error',
+                                   'error': f"{type(e).__name__}: {e}"})
+
+    orden = {area['nombre']: i for i, area in enumerate(areas)}
+    resultados.sort(key=lambda r: orden[r['nombre']])
+    return {
+        'areas': resultados,
+        'correctas': sum(r['estado'] == 'ok' for r in resultados),
+        'con_error': sum(r['estado'] != 'ok' for r in resultados),
+        'trabajadores': num_trabajadores,
+        'memoria_mb_por_trabajo': memoria_mb,
+        'segundos': round(time.perf_counter() - inicio, 3)
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Calcula susceptibilidad y amenaza para varias áreas de estudio.")
+    parser.add_argument('manifiesto', help="Archivo JSON con las áreas de estudio")
+    parser.add_argument('--trabajadores', type=int, default=None,
+                        help="Número de áreas que se procesan a la vez (por defecto, número de CPU)")
+    parser.add_argument('--memoria-mb', type=int, default=None,
+                        help="Límite de memoria por trabajo, en MB (sin límite por defecto)")
+    parser.add_argument('--salida', default=None, help="Archivo JSON de resumen (por defecto, salida estándar)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(name)s: %(message)s')
+    areas = leer_manifiesto(args.manifiesto)
+    logger.info(f"Procesando {len(areas)} áreas")
+
+    try:
+        resumen = ejecutar_lote(areas, args.trabajadores, args.memoria_mb)
+    except ValueError as e:
+        parser.error(str(e))
+    texto = json.dumps(resumen, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            f.write(texto)
+        logger.info(f"Resumen guardado en {args.salida}")
+    else:
+        print(texto)
+    logger.info(f"{resumen['correctas']} áreas correctas, {resumen['con_error']} con error en {resumen['segundos']:.1f} s")
+    return 0 if resumen['con_error'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
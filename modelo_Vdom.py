@@ -8,6 +8,49 @@ import pandas as pd
 from rasterio.crs import CRS
 from rasterio.warp import reproject, Resampling
 
+import atipicos
+from escritura import SalidaRaster, escribir_raster
+
+# Diccionario con los parámetros para cada tipo de cobertura
+parametros_cobertura = {
+    111: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    112: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    121: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    122: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    124: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    125: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    131: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    211: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
+    221: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
+    222: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
+    223: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
+    231: {'tipo_combustion': 'Pastos - Zonas verdes urbanas', 'calific_tipoCombus': 5, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
+    232: {'tipo_combustion': 'Arbustos / hierbas - aroles / hierbas', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50 ton/ha', 'calific_carga': 2},
+    233: {'tipo_combustion': 'Hierbas / pastos', 'calific_tipoCombus': 5, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
+    241: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
+    242: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
+    243: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
+    244: {'tipo_combustion': 'Pastos - Zonas verdes urbanas', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '<10 ton/ha', 'calific_carga': 1},
+    245: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
+    311: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
+    312: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
+    313: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
+    314: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
+    315: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 3, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 2, 'carga_total': '>100 ton/ha', 'calific_carga': 3},
+    321: {'tipo_combustion': 'Hierbas / pastos', 'calific_tipoCombus': 5, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
+    322: {'tipo_combustion': 'Arbustos / hierbas - aroles / hierbas', 'calific_tipoCombus': 3, 'tiempo_combustible': '10 horas', 'calific_tiempoCombus': 2, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
+    323: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
+    331: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    332: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    333: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    334: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    411: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 4, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 1, 'carga_total': 'No combustibles', 'calific_carga': 2},
+    413: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    511: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    512: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
+    514: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0}
+}
+
 def asignar_parametros(valor_cobertura):
     # Imprimir el valor recibido para depuración
     print(f"Valor de cobertura recibido: {valor_cobertura}")
@@ -27,55 +70,22 @@ def asignar_parametros(valor_cobertura):
         print(f"Error al convertir el valor de cobertura: {e}")
         return {}
 
-    # Diccionario con los parámetros para cada tipo de cobertura
-    parametros = {
-        111: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        112: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        121: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        122: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        124: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        125: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        131: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        211: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
-        221: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
-        222: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
-        223: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 4, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 2, 'carga_total': '1-50ton/ha', 'calific_carga': 3},
-        231: {'tipo_combustion': 'Pastos - Zonas verdes urbanas', 'calific_tipoCombus': 5, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
-        232: {'tipo_combustion': 'Arbustos / hierbas - aroles / hierbas', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50 ton/ha', 'calific_carga': 2},
-        233: {'tipo_combustion': 'Hierbas / pastos', 'calific_tipoCombus': 5, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
-        241: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
-        242: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
-        243: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
-        244: {'tipo_combustion': 'Pastos - Zonas verdes urbanas', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '<10 ton/ha', 'calific_carga': 1},
-        245: {'tipo_combustion': 'Hierbas / cultivos herbaceos', 'calific_tipoCombus': 3, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '1-50ton/ha', 'calific_carga': 2},
-        311: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
-        312: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
-        313: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
-        314: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '>100 ton/ha', 'calific_carga': 4},
-        315: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 3, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 2, 'carga_total': '>100 ton/ha', 'calific_carga': 3},
-        321: {'tipo_combustion': 'Hierbas / pastos', 'calific_tipoCombus': 5, 'tiempo_combustible': '1 hora', 'calific_tiempoCombus': 1, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
-        322: {'tipo_combustion': 'Arbustos / hierbas - aroles / hierbas', 'calific_tipoCombus': 3, 'tiempo_combustible': '10 horas', 'calific_tiempoCombus': 2, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
-        323: {'tipo_combustion': 'Arboles / atbustos', 'calific_tipoCombus': 2, 'tiempo_combustible': '100 horas', 'calific_tiempoCombus': 3, 'carga_total': '50-100 ton/ha', 'calific_carga': 3},
-        331: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        332: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        333: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        334: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        411: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 4, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 1, 'carga_total': 'No combustibles', 'calific_carga': 2},
-        413: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        511: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        512: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0},
-        514: {'tipo_combustion': 'No combustibles', 'calific_tipoCombus': 0, 'tiempo_combustible': 'No combustibles', 'calific_tiempoCombus': 0, 'carga_total': 'No combustibles', 'calific_carga': 0}
-    }
-    
-    if codigo_cobertura not in parametros:
+    if codigo_cobertura not in parametros_cobertura:
         print(f"Advertencia: No se encontraron parámetros para el tipo de cobertura con código '{codigo_cobertura}'")
         return {}
     
-    return parametros[codigo_cobertura]
+    return parametros_cobertura[codigo_cobertura]
 
 
 
-def vector_a_raster(gdf, columna, raster_salida, resolucion):
+def vector_a_raster(gdf, columna, raster_salida, resolucion, por_teselas=False, num_trabajadores=1,
+                    compresion=None):
+    """
+    Rasteriza una columna del GeoDataFrame en un GeoTIFF uint8 (COG, ver escritura.py)
+    sobre su extensión y devuelve el informe de escritura.
+    Con por_teselas=True se rasteriza ventana por ventana (ver rasterizado.py), con el
+    mismo resultado pero sin tener todo el raster ni todas las geometrías a la vez.
+    """
     # Obtener la extensión del GeoDataFrame
     minx, miny, maxx, maxy = gdf.total_bounds
     
@@ -86,6 +96,10 @@ def vector_a_raster(gdf, columna, raster_salida, resolucion):
     # Crear la transformación afín
     transform = rasterio.transform.from_origin(minx, maxy, resolucion, resolucion)
     
+    if por_teselas:
+        return _vector_a_raster_por_teselas(gdf, columna, raster_salida, transform, (height, width),
+                                            num_trabajadores, compresion)
+
     # Rasterizar el GeoDataFrame
     raster = rasterize(
         [(geom, value) for geom, value in zip(gdf.geometry, gdf[columna])],
@@ -102,29 +116,54 @@ def vector_a_raster(gdf, columna, raster_salida, resolucion):
     # Redondear los valores a enteros y convertir a uint8
     raster_uint8 = np.where(np.isnan(raster), 0, np.round(raster)).astype(np.uint8)
     
+    # Crear una rampa de color
+    colormap = {
+        i: (255, int(255 * (1 - i/5)), 0, 255) for i in range(6)
+    }
+
     # Guardar el raster
-    with rasterio.open(
-        raster_salida, 
-        'w', 
-        driver='GTiff', 
-        height=height, 
-        width=width,
-        count=1, 
-        dtype=rasterio.uint8,
-        crs=crs, 
-        transform=transform,
-        tiled=True,
-        compress='lzw'
-    ) as dst:
-        dst.write(raster_uint8, 1)
-        
-        # Crear una rampa de color
-        colormap = {
-            i: (255, int(255 * (1 - i/5)), 0, 255) for i in range(6)
-        }
-        dst.write_colormap(1, colormap)
+    informe = escribir_raster(raster_salida, raster_uint8, crs, transform, colormap=colormap,
+                              compresion=compresion)
     
     print(f"Se ha creado el raster en {raster_salida}")
+    return informe
+
+def _vector_a_raster_por_teselas(gdf, columna, raster_salida, transform, forma, num_trabajadores, compresion=None):
+    """Escribe el mismo GeoTIFF que vector_a_raster rasterizando por ventanas."""
+    from rasterizado import rasterizar_por_teselas
+
+    colormap = {
+        i: (255, int(255 * (1 - i/5)), 0, 255) for i in range(6)
+    }
+    salida = SalidaRaster(raster_salida, forma, np.uint8, gdf.crs, transform, colormap=colormap,
+                          compresion=compresion)
+    with salida as dst:
+        rasterizar_por_teselas(gdf, columna, dst, num_trabajadores=num_trabajadores)
+
+    print(f"Se ha creado el raster en {raster_salida} (por teselas)")
+    return salida.informe
+
+def rasterizar_en_rejilla(gdf, columna, crs, transform, forma, out=None):
+    """
+    Rasteriza una columna directamente sobre una rejilla dada (por ejemplo, una banda de la
+    pila alineada), sin escribir archivos intermedios ni remuestrear.
+
+    Igual que vector_a_raster, los valores se redondean a enteros, pero los píxeles sin
+    geometría quedan en NaN en lugar de 0.
+    """
+    if out is None:
+        out = np.empty(forma, dtype=np.float32)
+    out.fill(np.nan)
+
+    if gdf.crs is not None and CRS.from_user_input(gdf.crs) != crs:
+        gdf = gdf.to_crs(crs)
+
+    formas = [(geom, value) for geom, value in zip(gdf.geometry, gdf[columna])
+              if geom is not None and not geom.is_empty]
+    if formas:
+        rasterize(formas, out=out, transform=transform, all_touched=True)
+    np.round(out, out=out)
+    return out
 
 # Diccionario para mapear nombres de cobertura a códigos
 mapeo_nombres_a_codigos = {
@@ -166,6 +205,86 @@ mapeo_nombres_a_codigos = {
     'Cuerpos de agua artificiales': 514
 }
 
+# Campos de calificación que se extraen de parametros_cobertura
+campos_calificacion = ['calific_tipoCombus', 'calific_tiempoCombus', 'calific_carga']
+
+def _compilar_tabla_calificaciones(parametros):
+    """
+    Construye una tabla de consulta indexada por código de cobertura con las calificaciones.
+    """
+    codigo_max = max(parametros)
+    tabla = np.zeros((codigo_max + 1, len(campos_calificacion)), dtype=np.int64)
+    conocidos = np.zeros(codigo_max + 1, dtype=bool)
+    for codigo, params in parametros.items():
+        tabla[codigo] = [params[campo] for campo in campos_calificacion]
+        conocidos[codigo] = True
+    return tabla, conocidos
+
+# Tablas compiladas una sola vez al importar el módulo
+tabla_calificaciones, codigos_conocidos = _compilar_tabla_calificaciones(parametros_cobertura)
+
+def _convertir_codigo_cobertura(valor):
+    """
+    Convierte un valor de cobertura (código, cadena numérica o nombre) a código entero.
+    Devuelve -1 si el valor no se puede interpretar.
+    """
+    if isinstance(valor, str):
+        nombre = valor.strip()
+        if nombre in mapeo_nombres_a_codigos:
+            return mapeo_nombres_a_codigos[nombre]
+        try:
+            return int(float(nombre))
+        except ValueError:
+            return -1
+    if isinstance(valor, (int, float, np.integer, np.floating)) and not isinstance(valor, (bool, np.bool_)):
+        try:
+            return int(valor)
+        except (ValueError, OverflowError):
+            return -1
+    return -1
+
+def calificar_coberturas(valores):
+    """
+    Califica una columna completa de coberturas con las tablas compiladas.
+
+    Acepta códigos numéricos, cadenas numéricas y nombres de cobertura. Devuelve un
+    DataFrame con calific_tipoCombus, calific_tiempoCombus, calific_carga y susceptibilidad,
+    y una Serie con el conteo de valores sin parámetros (calificados con 0).
+    """
+    valores = pd.Series(valores)
+
+    # Resolver solo los valores únicos y expandir con los índices inversos
+    indices, unicos = pd.factorize(valores, use_na_sentinel=True)
+    codigos_unicos = np.array([_convertir_codigo_cobertura(v) for v in unicos], dtype=np.int64)
+    validos_unicos = (codigos_unicos >= 0) & (codigos_unicos < len(codigos_conocidos))
+    validos_unicos[validos_unicos] = codigos_conocidos[codigos_unicos[validos_unicos]]
+    # El código 0 no existe en la tabla, por lo que su fila es cero
+    filas_unicas = np.where(validos_unicos, codigos_unicos, 0)
+
+    # Los valores nulos (índice -1) se tratan como desconocidos
+    filas_unicas = np.append(filas_unicas, 0)
+    validos_unicos = np.append(validos_unicos, False)
+    calificaciones = tabla_calificaciones[filas_unicas[indices]]
+    validos = validos_unicos[indices]
+
+    resultado = pd.DataFrame(calificaciones, columns=campos_calificacion, index=valores.index)
+    resultado['susceptibilidad'] = calificaciones.sum(axis=1) / 3
+
+    # Quien llama decide cómo avisar de las coberturas sin parámetros (ver pipeline)
+    desconocidos = valores[~validos].value_counts(dropna=False)
+    return resultado, desconocidos
+
+# Esquemas de calificación de las variables de amenaza (intervalos de gridcode -> calificación)
+esquemas_calificacion = {
+    'precipitacion': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5]},
+    'temperatura': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5]},
+    'pendiente': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5]},
+    'accesibilidad': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [5, 4, 3, 2, 1]},
+    'frecuencia': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5]},
+    'vientos': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5]},
+    'radiacion_solar': {'bins': [0, 1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5]}
+}
+
 def calificar_variable(gdf, nombre_variable):
     """
     Califica una variable según su tipo y rango de valores.
@@ -177,50 +296,21 @@ def calificar_variable(gdf, nombre_variable):
     # Imprimir los valores únicos de gridcode para depuración
     print(f"Valores únicos en gridcode para {nombre_variable}: {gdf['gridcode'].unique()}")
 
-    if nombre_variable == 'precipitacion':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[1, 2, 3, 4, 5],
-                                     include_lowest=True)
-    elif nombre_variable == 'temperatura':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[1, 2, 3, 4, 5],
-                                     include_lowest=True)
-    elif nombre_variable == 'pendiente':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[1, 2, 3, 4, 5],
-                                     include_lowest=True)
-    elif nombre_variable == 'accesibilidad':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[5, 4, 3, 2, 1],
-                                     include_lowest=True)
-    elif nombre_variable == 'frecuencia':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[1, 2, 3, 4, 5],
-                                     include_lowest=True)
-    elif nombre_variable == 'vientos':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[1, 2, 3, 4, 5],
-                                     include_lowest=True)
-    elif nombre_variable == 'radiacion_solar':
-        gdf['calificacion'] = pd.cut(gdf['gridcode'], 
-                                     bins=[0, 1, 2, 3, 4, 5],
-                                     labels=[1, 2, 3, 4, 5],
-                                     include_lowest=True)
-    else:
+    if nombre_variable not in esquemas_calificacion:
         raise ValueError(f"Variable desconocida: {nombre_variable}")
+
+    esquema = esquemas_calificacion[nombre_variable]
+    gdf['calificacion'] = pd.cut(gdf['gridcode'], 
+                                 bins=esquema['bins'],
+                                 labels=esquema['labels'],
+                                 include_lowest=True)
     
     # Convertir la calificación a tipo entero
     gdf['calificacion'] = gdf['calificacion'].astype(int)
     
     return gdf
 
-def calificar_y_rasterizar(gdf, nombre_variable, raster_salida, resolucion=30):
+def calificar_y_rasterizar(gdf, nombre_variable, raster_salida, resolucion=30, compresion=None):
     """
     Califica una variable y la convierte a raster.
     """
@@ -231,7 +321,7 @@ def calificar_y_rasterizar(gdf, nombre_variable, raster_salida, resolucion=30):
         print(f"Valores únicos en gridcode para {nombre_variable}: {gdf['gridcode'].unique()}")
         raise
 
-    vector_a_raster(gdf_calificado, 'calificacion', raster_salida, resolucion)
+    return vector_a_raster(gdf_calificado, 'calificacion', raster_salida, resolucion, compresion=compresion)
 
 def reproyectar_y_alinear(src, dst_crs, dst_transform, dst_shape):
     """
@@ -251,10 +341,7 @@ def reproyectar_y_alinear(src, dst_crs, dst_transform, dst_shape):
 
 def eliminar_valores_atipicos(datos, umbral=3):
     """
-    Elimina valores atípicos de un array numpy.
+    Elimina valores atípicos de un array numpy: los que se alejan de la media más de
+    umbral desviaciones estándar se reemplazan con NaN (ver atipicos.eliminar_valores_atipicos).
     """
-    datos_validos = datos[~np.isnan(datos)]
-    media = np.mean(datos_validos)
-    desv_est = np.std(datos_validos)
-    datos_limpios = np.where(np.abs(datos - media) > umbral * desv_est, np.nan, datos)
-    return datos_limpios
\ No newline at end of file
+    return atipicos.eliminar_valores_atipicos(datos, umbral_sigma=umbral)
\ No newline at end of file
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+
+from escritura import escribir_raster
+from modelo_Vdom import rasterizar_en_rejilla
+from superposicion import combinar_ponderado, reproyectar_y_alinear
+
+logger = logging.getLogger(__name__)
+
+# Número de filas que se procesan a la vez al combinar la pila
+FILAS_POR_BLOQUE = 256
+
+def clave_pila(hashes_fuentes, dst_crs, dst_transform, dst_shape):
+    """
+    Calcula la clave de una pila a partir del hash de contenido de cada variable, de la
+    rejilla de destino y del remuestreo.
+    """
+    descripcion = {
+        'fuentes': sorted(hashes_fuentes.items()),
+        'crs': dst_crs.to_wkt(),
+        'transform': list(dst_transform)[:6],
+        'forma': list(dst_shape),
+        'remuestreo': 'vecino',
+        'sin_datos': 'nan'
+    }
+    return hashlib.sha256(json.dumps(descripcion, sort_keys=True).encode()).hexdigest()
+
+class PilaBandas:
+    """
+    Pila de variables alineadas sobre una rejilla común, guardada como un único archivo
+    .npy (bandas x filas x columnas, float32) que se abre como mapa de memoria.
+
+    Todas las bandas comparten la transformación, el CRS y la máscara de datos (NaN),
+    que se describen en un archivo JSON junto a la pila. Los píxeles fuera de una variable
+    o nodata en ella quedan en NaN y no cuentan en el promedio ponderado. Cambiar los pesos solo requiere
+    recorrer el mapa de memoria, sin reproyectar ni llamar a GDAL.
+    """
+
+    def __init__(self, ruta, nombres, crs, transform, forma):
+        self.ruta = ruta
+        self.nombres = list(nombres)
+        self.crs = crs
+        self.transform = transform
+        self.forma = tuple(forma)
+        self.bandas = np.load(ruta, mmap_mode='r')
+
+    @staticmethod
+    def _rutas(directorio, clave):
+        base = os.path.join(directorio, f'pila_{clave[:16]}')
+        return base + '.npy', base + '.json'
+
+    @classmethod
+    def abrir(cls, directorio, clave):
+        """Abre la pila con la clave dada, o devuelve None si no existe."""
+        ruta_datos, ruta_meta = cls._rutas(directorio, clave)
+        if not (os.path.exists(ruta_datos) and os.path.exists(ruta_meta)):
+            return None
+        with open(ruta_meta, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('clave') != clave:
+            return None
+        return cls(ruta_datos, meta['nombres'], CRS.from_wkt(meta['crs']),
+                   Affine(*meta['transform']), meta['forma'])
+
+    @classmethod
+    def _crear(cls, directorio, clave, nombres, dst_crs, dst_transform, dst_shape, llenar_banda):
+        """
+        Crea una pila nueva llamando a llenar_banda(nombre, banda) para cada variable, donde
+        banda es la porción del mapa de memoria que le corresponde. Solo se reemplazan los
+        archivos de esta clave: otros procesos pueden estar leyendo las demás pilas.
+        """
+        os.makedirs(directorio, exist_ok=True)
+        ruta_datos, ruta_meta = cls._rutas(directorio, clave)
+        sufijo = f'{os.getpid()}.{uuid.uuid4().hex[:8]}'
+        temporal = os.path.join(directorio, f'.tmp_{clave[:16]}.{sufijo}.npy')
+        inicio = time.perf_counter()
+
+        nombres = list(nombres)
+        pila = np.lib.format.open_memmap(temporal, mode='w+', dtype=np.float32,
+                                         shape=(len(nombres),) + tuple(dst_shape))
+        for i, nombre in enumerate(nombres):
+            llenar_banda(nombre, pila[i])
+            logger.info(f"Banda {nombre} guardada en la pila")
+        pila.flush()
+        del pila
+
+        # Datos y descripción se reemplazan de una vez; quien tenga abierta la pila anterior
+        # de esta clave conserva su mapa de memoria
+        os.replace(temporal, ruta_datos)
+        temporal_meta = f'{ruta_meta}.{sufijo}.tmp'
+        with open(temporal_meta, 'w', encoding='utf-8') as f:
+            json.dump({'clave': clave, 'nombres': nombres, 'crs': dst_crs.to_wkt(),
+                       'transform': list(dst_transform)[:6], 'forma': list(dst_shape)}, f)
+        os.replace(temporal_meta, ruta_meta)
+
+        logger.info(f"Pila de {len(nombres)} bandas creada en {time.perf_counter() - inicio:.2f} s: {ruta_datos}")
+        return cls(ruta_datos, nombres, dst_crs, dst_transform, dst_shape)
+
+    @classmethod
+    def crear(cls, directorio, clave, fuentes, dst_crs, dst_transform, dst_shape):
+        """
+        Alinea cada raster de fuentes sobre la rejilla de destino y lo guarda en una pila
+        nueva. Las bandas se alinean de una en una, así que en memoria solo hay una a la vez.
+        Los píxeles fuera de cada raster y sus nodata quedan en NaN.
+        """
+        def llenar_banda(nombre, banda):
+            reproyectar_y_alinear(fuentes[nombre], dst_crs, dst_transform, dst_shape, out=banda)
+
+        return cls._crear(directorio, clave, fuentes, dst_crs, dst_transform, dst_shape, llenar_banda)
+
+    @classmethod
+    def crear_desde_vectores(cls, directorio, clave, capas, dst_crs, dst_transform, dst_shape,
+                             ruta_intermedios=None):
+        """
+        Rasteriza cada capa vectorial directamente en su banda de la pila, sobre la rejilla
+        de destino, sin archivos intermedios ni remuestreo.
+
+        capas es un diccionario nombre -> función que devuelve (GeoDataFrame, columna); las
+        capas se cargan de una en una. Si se da ruta_intermedios, cada banda se guarda además
+        como <nombre>_raster.tif (uint8, 0 = sin datos) en ese directorio.
+        """
+        def llenar_banda(nombre, banda):
+            gdf, columna = capas[nombre]()
+            rasterizar_en_rejilla(gdf, columna, dst_crs, dst_transform, dst_shape, out=banda)
+            if ruta_intermedios:
+                ruta_raster = os.path.join(ruta_intermedios, f'{nombre}_raster.tif')
+                # Puede ser un enlace a una entrada de la caché de rasters: reemplazarlo, no sobrescribirlo
+                if os.path.exists(ruta_raster):
+                    os.remove(ruta_raster)
+                escribir_raster(ruta_raster, np.nan_to_num(banda, nan=0).astype(np.uint8), dst_crs, dst_transform)
+
+        return cls._crear(directorio, clave, capas, dst_crs, dst_transform, dst_shape, llenar_banda)
+
+    def combinar(self, pesos, out=None, filas_por_bloque=FILAS_POR_BLOQUE):
+        """
+        Calcula la amenaza (promedio ponderado) recorriendo la pila por bloques de filas.
+        Solo se usan las bandas con peso en pesos. El resultado es idéntico al cálculo en
+        memoria con las mismas bandas.
+        """
+        indices = {nombre: i for i, nombre in enumerate(self.nombres) if nombre in pesos}
+        if out is None:
+            out = np.empty(self.forma, dtype=np.float32)
+        for fila in range(0, self.forma[0], filas_por_bloque):
+            filas = slice(fila, min(fila + filas_por_bloque, self.forma[0]))
+            datos_raster = {nombre: self.bandas[i, filas] for nombre, i in indices.items()}
+            combinar_ponderado(datos_raster, pesos, out=out[filas])
+        return out
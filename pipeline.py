@@ -0,0 +1,604 @@
+import logging
+import os
+import time
+import numpy as np
+import rasterio
+
+from carga import campos_capa, leer_capa
+from modelo_Vdom import calificar_coberturas, vector_a_raster, calificar_variable, calificar_y_rasterizar, esquemas_calificacion
+from reclasificacion import reclasificar
+from cache_rasters import CacheRasters
+from escenarios import evaluar_escenarios, matriz_pesos, pesos_monte_carlo
+from escritura import COMPRESION_POR_DEFECTO, escribir_clases, escribir_raster
+from grafo import GrafoCalculo
+from instrumentacion import Instrumentacion, MODOS_ESTADISTICAS, estadisticas_archivo, estadisticas_raster, registrar_en_archivo
+from pila_bandas import PilaBandas, clave_pila
+from rejilla import plan_alineacion, rejilla_union_vectorial
+from superposicion import calcular_rejilla_referencia, superponer_compacto, superponer_en_memoria, superponer_por_bloques
+from temporada import VARIABLES_DINAMICAS, ParteEstatica, clave_estatica, entradas_fechas
+from zonal import PERCENTILES_ZONALES, estadisticas_zonales, nombre_archivo, rasterizar_zonas
+
+logger = logging.getLogger(__name__)
+
+# Variables de amenaza (además de la susceptibilidad), en el orden de superposición
+VARIABLES_AMENAZA = ['precipitacion', 'temperatura', 'pendiente', 'accesibilidad',
+                     'frecuencia', 'vientos', 'radiacion_solar']
+
+# Pesos por defecto de la metodología (los mismos que propone la interfaz)
+PESOS_POR_DEFECTO = {
+    'susceptibilidad': 0.17,
+    'precipitacion': 0.20,
+    'temperatura': 0.20,
+    'pendiente': 0.07,
+    'accesibilidad': 0.20,
+    'frecuencia': 0.10,
+    'vientos': 0.10,
+    'radiacion_solar': 0.07
+}
+
+# Modos de cálculo de la amenaza
+MODOS_CALCULO = ('memoria', 'bloques', 'paralelo', 'pila', 'directo', 'compacto')
+
+# Etapas de cálculo que se informan a la función de progreso
+ETAPAS = ('lectura', 'rasterizado', 'alineacion', 'superposicion', 'escritura')
+
+# Resolución de la susceptibilidad y de la rejilla común del modo directo (unidades del CRS)
+TAMANO_PIXEL_SUSCEPTIBILIDAD = 2
+# Resolución de los rasters de las variables de amenaza (unidades del CRS)
+RESOLUCION_AMENAZA = 30
+
+def carpeta_resultados(ruta_cobertura):
+    """Carpeta de resultados por defecto: 'resultados' junto al archivo de coberturas."""
+    return os.path.join(os.path.dirname(ruta_cobertura), 'resultados')
+
+def _avisar(progreso, etapa, fraccion=None):
+    """Informa el avance de una etapa (fracción entre 0 y 1, o None si no se conoce)."""
+    if progreso is not None:
+        progreso(etapa, fraccion)
+
+def calcular_susceptibilidad(ruta_cobertura, campo_cobertura, ruta_resultados=None,
+                             tamano_pixel=TAMANO_PIXEL_SUSCEPTIBILIDAD, por_teselas=True, num_trabajadores=1,
+                             progreso=None, estadisticas=None, compresion=None, ruta_salida=None):
+    """
+    Califica las coberturas y guarda el raster de susceptibilidad (susceptibilidad.tif, COG
+    con vistas generales) en ruta_salida, o en la carpeta de resultados si no se da. Devuelve un resumen con la ruta, el
+    informe de escritura y la instrumentación por etapa (también se añade al archivo de
+    instrumentación). compresion elige la del COG (ver escritura.COMPRESIONES).
+    Con por_teselas=True la capa se rasteriza por ventanas (mismo resultado, menos memoria).
+    Si se da progreso, se llama como progreso(etapa, fraccion) al avanzar (ver ETAPAS).
+    Con estadisticas ('completas' o 'muestra') el resumen incluye las del raster.
+    Si ya se calculó con las mismas coberturas y parámetros (ver grafo.GrafoCalculo), se
+    reutiliza ese raster aunque lo haya calculado otro trabajo.
+    """
+    if estadisticas and estadisticas not in MODOS_ESTADISTICAS:
+        raise ValueError(f"Modo de estadísticas desconocido: {estadisticas}")
+    medicion = Instrumentacion('susceptibilidad')
+    progreso = medicion.envolver(progreso)
+    logger.info("Iniciando cálculo de susceptibilidad")
+    ruta_resultados = ruta_resultados or carpeta_resultados(ruta_cobertura)
+    os.makedirs(ruta_resultados, exist_ok=True)
+    raster_salida = os.path.join(ruta_salida or ruta_resultados, 'susceptibilidad.tif')
+
+    # El registro de etapas y la caché se comparten en la carpeta de resultados; las salidas
+    # reutilizadas se enlazan en la carpeta de salida de este trabajo
+    grafo = GrafoCalculo(ruta_resultados, CacheRasters(os.path.join(ruta_resultados, 'cache')))
+    parametros = {'campo': campo_cobertura, 'tamano_pixel': tamano_pixel,
+                  'compresion': compresion or COMPRESION_POR_DEFECTO}
+    _avisar(progreso, 'lectura')
+    datos = grafo.vigente('susceptibilidad', [ruta_cobertura], parametros, [raster_salida])
+    if datos is not None:
+        resumen = dict(datos, ruta=raster_salida, escritura=None, grafo=grafo.resumen())
+        return _terminar_susceptibilidad(resumen, medicion, estadisticas)
+
+    # Cargar del shapefile de vegetación solo el campo de cobertura y la geometría
+    vegetacion = leer_capa(ruta_cobertura, [campo_cobertura])
+
+    # Calificar todas las coberturas en un solo paso con las tablas compiladas
+    calificaciones, desconocidos = calificar_coberturas(vegetacion[campo_cobertura])
+    if len(desconocidos) > 0:
+        logger.warning(f"{int(desconocidos.sum())} polígonos con {len(desconocidos)} valores de cobertura sin parámetros, "
+                       f"calificados con 0: {({k: int(v) for k, v in desconocidos.head(10).items()})}")
+    for columna in calificaciones.columns:
+        vegetacion[columna] = calificaciones[columna]
+
+    # Convertir la columna de susceptibilidad a raster
+    _avisar(progreso, 'rasterizado')
+    # El COG incluye las vistas generales para servir el raster por teselas a cualquier zoom
+    escritura = vector_a_raster(vegetacion, 'susceptibilidad', raster_salida, tamano_pixel,
+                                por_teselas=por_teselas, num_trabajadores=max(int(num_trabajadores or 1), 1),
+                                compresion=compresion)
+
+    datos = {'poligonos': len(vegetacion), 'poligonos_sin_parametros': int(desconocidos.sum())}
+    grafo.registrar('susceptibilidad', [ruta_cobertura], parametros, [raster_salida], datos)
+    resumen = dict(datos, ruta=raster_salida, escritura=escritura, grafo=grafo.resumen())
+    return _terminar_susceptibilidad(resumen, medicion, estadisticas)
+
+def _terminar_susceptibilidad(resumen, medicion, estadisticas):
+    """Añade al resumen las estadísticas (si se piden) y la instrumentación, y la registra."""
+    if estadisticas:
+        medicion.iniciar_etapa('estadisticas')
+        resumen['estadisticas'] = estadisticas_archivo(resumen['ruta'], estadisticas)
+    resumen['instrumentacion'] = medicion.terminar(ruta=resumen['ruta'], poligonos=resumen['poligonos'])
+    registrar_en_archivo(resumen['instrumentacion'])
+    return resumen
+
+def leer_variable_amenaza(nombre, ruta):
+    """
+    Lee el shapefile de una variable de amenaza, solo con el campo 'gridcode' y la
+    geometría. Si no tiene 'gridcode' se usa el primer campo numérico; si no hay ninguno
+    devuelve None.
+    """
+    campos = campos_capa(ruta)
+    if 'gridcode' in campos:
+        return leer_capa(ruta, ['gridcode'])
+    logger.warning(f"El campo 'gridcode' no existe en el shapefile de {nombre}. Buscando un campo numérico alternativo.")
+    numeric_columns = [campo for campo, tipo in campos.items() if np.issubdtype(tipo, np.number)]
+    if len(numeric_columns) == 0:
+        logger.error(f"No se encontró un campo numérico adecuado en el shapefile de {nombre}")
+        return None
+    gdf = leer_capa(ruta, [numeric_columns[0]])
+    gdf['gridcode'] = gdf[numeric_columns[0]]
+    logger.info(f"Usando el campo '{numeric_columns[0]}' como 'gridcode' para {nombre}")
+    return gdf
+
+def cargadores_vectoriales(capas, campo_cobertura):
+    """
+    Devuelve, para cada capa, una función que la lee y la califica, y que entrega el
+    GeoDataFrame y la columna a rasterizar (para PilaBandas.crear_desde_vectores).
+    """
+    def cargar_susceptibilidad():
+        gdf = leer_capa(capas['susceptibilidad'], [campo_cobertura])
+        calificaciones, _ = calificar_coberturas(gdf[campo_cobertura])
+        gdf['susceptibilidad'] = calificaciones['susceptibilidad']
+        return gdf, 'susceptibilidad'
+
+    def cargador_variable(nombre):
+        def cargar():
+            gdf = leer_variable_amenaza(nombre, capas[nombre])
+            if gdf is None:
+                raise ValueError(f"No se encontró un campo numérico adecuado en el shapefile de {nombre}")
+            return calificar_variable(gdf, nombre), 'calificacion'
+        return cargar
+
+    return {nombre: cargar_susceptibilidad if nombre == 'susceptibilidad' else cargador_variable(nombre)
+            for nombre in capas}
+
+def rasterizar_variables(variables, ruta_resultados, cache, resolucion=RESOLUCION_AMENAZA, progreso=None,
+                         compresion=None, grafo=None):
+    """
+    Rasteriza las variables de amenaza disponibles (reutilizando la caché de rasters) y
+    abre la susceptibilidad. Devuelve un diccionario nombre -> dataset abierto. Con grafo,
+    cada variable es una etapa raster_<nombre>: si su capa y sus parámetros no han cambiado
+    se abre el raster existente sin consultar la caché.
+    """
+    rasters_disponibles = {}
+    for i, (nombre, ruta) in enumerate(variables.items()):
+        _avisar(progreso, 'rasterizado', i / len(variables))
+        if not os.path.exists(ruta):
+            logger.warning(f"El archivo {nombre} no está disponible.")
+            continue
+        if nombre == 'susceptibilidad':
+            rasters_disponibles[nombre] = rasterio.open(ruta)
+            continue
+        raster_salida = os.path.join(ruta_resultados, f'{nombre}_raster.tif')
+        etapa = f'raster_{nombre}'
+        parametros = {'esquema': esquemas_calificacion.get(nombre), 'resolucion': resolucion,
+                      'compresion': compresion or COMPRESION_POR_DEFECTO}
+        if grafo is not None and grafo.vigente(etapa, [ruta], parametros, [raster_salida]) is not None:
+            rasters_disponibles[nombre] = rasterio.open(raster_salida)
+            continue
+        clave = cache.clave([ruta], variable=nombre, esquema=esquemas_calificacion.get(nombre),
+                            resolucion=resolucion, rejilla='extension_capa')
+        reutilizado = cache.obtener(clave, raster_salida)
+        if reutilizado:
+            logger.info(f"Raster de {nombre} reutilizado desde la caché")
+        else:
+            gdf = leer_variable_amenaza(nombre, ruta)
+            if gdf is None:
+                continue
+            # El raster anterior puede ser un enlace a una entrada de la caché: no sobrescribirlo
+            if os.path.exists(raster_salida):
+                os.remove(raster_salida)
+            calificar_y_rasterizar(gdf, nombre, raster_salida, resolucion=resolucion, compresion=compresion)
+            cache.guardar(clave, raster_salida)
+        if grafo is not None:
+            grafo.registrar(etapa, [ruta], parametros, [raster_salida], reconstruida=not reutilizado,
+                            claves_cache={raster_salida: clave})
+        rasters_disponibles[nombre] = rasterio.open(raster_salida)
+    return rasters_disponibles
+
+def abrir_pila_alineada(rasters_disponibles, crs, transform, forma, ruta_resultados, cache, progreso=None):
+    """
+    Abre la pila de bandas alineadas de la carpeta de resultados si las entradas (por su
+    contenido) y la rejilla no han cambiado; si no, la crea.
+    """
+    hashes = {nombre: cache.hash_contenido([src.name]) for nombre, src in rasters_disponibles.items()}
+    clave = clave_pila(hashes, crs, transform, forma)
+    ruta_pila = os.path.join(ruta_resultados, 'pila')
+    pila = PilaBandas.abrir(ruta_pila, clave)
+    if pila is None:
+        _avisar(progreso, 'alineacion')
+        pila = PilaBandas.crear(ruta_pila, clave, rasters_disponibles, crs, transform, forma)
+    else:
+        logger.info(f"Pila alineada reutilizada: {pila.ruta}")
+    return pila
+
+def calcular_amenaza(ruta_cobertura, ruta_shps_amenaza, pesos=None, modo='memoria', ruta_resultados=None,
+                     campo_cobertura=None, num_trabajadores=1, tipo_pool='hilos', guardar_intermedios=False,
+                     progreso=None, estadisticas=None, compresion=None, ruta_susceptibilidad=None,
+                     ruta_salida=None):
+    """
+    Calcula la amenaza como promedio ponderado de la susceptibilidad y las variables de
+    amenaza, y guarda amenaza.tif y sus clases en amenaza_clases.tif (COG con vistas
+    generales, compresión según compresion) en ruta_salida, o en la carpeta de resultados
+    si no se da. Los rasters de las variables van con la salida, así que dos trabajos con
+    distinta ruta_salida no comparten archivos intermedios; el registro de etapas, la
+    caché de rasters y las pilas alineadas, direccionadas por contenido, se comparten en
+    la carpeta de resultados.
+
+    pesos es un diccionario variable -> peso (por defecto PESOS_POR_DEFECTO). El modo
+    'directo' rasteriza desde las capas vectoriales y requiere campo_cobertura; los demás
+    usan la susceptibilidad ya calculada (ruta_susceptibilidad, por defecto
+    susceptibilidad.tif de la carpeta de resultados). El modo 'compacto' redondea las
+    calificaciones a enteros 0-5 y combina en punto fijo con un byte por variable y píxel
+    (ver superposicion.superponer_compacto). Si se da progreso, se llama como
+    progreso(etapa, fraccion) al avanzar (ver ETAPAS). Devuelve un resumen con la ruta, los
+    informes de escritura y la instrumentación por etapa (también se añade al archivo de
+    instrumentación); con estadisticas ('completas' o 'muestra') incluye las de la amenaza
+    y el conteo de clases.
+    Las etapas ya calculadas con las mismas entradas y parámetros, por este u otro
+    trabajo, se reutilizan (ver grafo.GrafoCalculo): si solo cambia una variable, solo se
+    rasteriza esa y se repite la superposición; si no cambia nada, se enlazan en la
+    salida los rasters ya calculados.
+    Lanza ValueError si el modo no es válido o si hay menos de dos variables disponibles.
+    """
+    if modo not in MODOS_CALCULO:
+        raise ValueError(f"Modo de cálculo desconocido: {modo}")
+    if estadisticas and estadisticas not in MODOS_ESTADISTICAS:
+        raise ValueError(f"Modo de estadísticas desconocido: {estadisticas}")
+    if modo == 'directo' and not campo_cobertura:
+        raise ValueError("Indique el campo de cobertura para el modo de rasterizado directo.")
+
+    medicion = Instrumentacion('amenaza')
+    progreso = medicion.envolver(progreso)
+    logger.info("Iniciando cálculo de amenaza")
+    pesos = dict(PESOS_POR_DEFECTO, **(pesos or {}))
+    ruta_resultados = ruta_resultados or carpeta_resultados(ruta_cobertura)
+    os.makedirs(ruta_resultados, exist_ok=True)
+    carpeta_salida = ruta_salida or ruta_resultados
+    ruta_amenaza = os.path.join(carpeta_salida, 'amenaza.tif')
+    ruta_clases = os.path.join(carpeta_salida, 'amenaza_clases.tif')
+
+    variables = {'susceptibilidad': ruta_cobertura if modo == 'directo'
+                 else ruta_susceptibilidad or os.path.join(ruta_resultados, 'susceptibilidad.tif')}
+    for nombre in VARIABLES_AMENAZA:
+        variables[nombre] = os.path.join(ruta_shps_amenaza, f'{nombre}.shp')
+
+    cache = CacheRasters(os.path.join(ruta_resultados, 'cache'))
+    grafo = GrafoCalculo(ruta_resultados, cache)
+
+    rasters_disponibles = {}
+    capas_vectoriales = {}
+    try:
+        _avisar(progreso, 'lectura')
+        if modo == 'directo':
+            # Rasterizar directamente desde las capas vectoriales (la susceptibilidad desde las coberturas)
+            for nombre, ruta in variables.items():
+                if os.path.exists(ruta):
+                    capas_vectoriales[nombre] = ruta
+                else:
+                    logger.warning(f"El archivo {nombre} no está disponible.")
+        else:
+            rasters_disponibles = rasterizar_variables(variables, carpeta_salida, cache, progreso=progreso,
+                                                       compresion=compresion, grafo=grafo)
+        logger.info(cache.resumen())
+
+        if len(rasters_disponibles) + len(capas_vectoriales) < 2:
+            raise ValueError("No hay suficientes variables disponibles para calcular la amenaza.")
+
+        # Alineación, superposición y reclasificación forman una etapa con dos salidas
+        entradas = list(capas_vectoriales.values()) or [src.name for src in rasters_disponibles.values()]
+        parametros = {'modo': modo, 'campo': campo_cobertura if modo == 'directo' else None, 'sin_datos': 'nan',
+                      'pesos': {nombre: pesos[nombre] for nombre in (capas_vectoriales or rasters_disponibles)},
+                      'compresion': compresion or COMPRESION_POR_DEFECTO}
+        datos = grafo.vigente('amenaza', entradas, parametros, [ruta_amenaza, ruta_clases])
+        if datos is not None:
+            resumen = dict(datos, escritura=None)
+            if estadisticas:
+                medicion.iniciar_etapa('estadisticas')
+                resumen['estadisticas'] = estadisticas_archivo(ruta_amenaza, estadisticas)
+            return _terminar_amenaza(resumen, ruta_amenaza, ruta_clases, modo, cache, grafo, medicion)
+
+        _avisar(progreso, 'alineacion')
+        if modo == 'directo':
+            # Rejilla de unión calculada a partir de los límites de las capas vectoriales
+            max_crs, dst_transform, dst_shape = rejilla_union_vectorial(list(capas_vectoriales.values()),
+                                                                        TAMANO_PIXEL_SUSCEPTIBILIDAD)
+            alineacion = {}
+        else:
+            # Unión de las fuentes en la retícula de la más fina; las alineadas se leen sin reproyectar
+            max_crs, dst_transform, dst_shape = calcular_rejilla_referencia(rasters_disponibles)
+            alineacion = plan_alineacion(rasters_disponibles, max_crs, dst_transform)
+
+        logger.info(f"CRS de referencia: {max_crs}")
+        logger.info(f"Forma de referencia: {dst_shape}")
+
+        pesos = {nombre: pesos[nombre] for nombre in (capas_vectoriales or rasters_disponibles)}
+
+        if modo in ('bloques', 'paralelo'):
+            # Recorrer la rejilla por ventanas y escribir directamente en el GeoTIFF en teselas
+            trabajadores = max(int(num_trabajadores or 1), 1) if modo == 'paralelo' else 1
+            _avisar(progreso, 'superposicion', 0)
+            resumen = superponer_por_bloques(rasters_disponibles, pesos, max_crs, dst_transform, dst_shape,
+                                             ruta_amenaza, ruta_clases=ruta_clases,
+                                             num_trabajadores=trabajadores, tipo_pool=tipo_pool or 'hilos',
+                                             progreso=lambda f: _avisar(progreso, 'superposicion', f),
+                                             estadisticas=estadisticas, compresion=compresion)
+        else:
+            if modo == 'directo':
+                clave = cache.clave(list(capas_vectoriales.values()), modo='directo', campo=campo_cobertura,
+                                    esquemas=esquemas_calificacion, crs=max_crs.to_wkt(),
+                                    transform=list(dst_transform)[:6], forma=dst_shape)
+                ruta_pila = os.path.join(ruta_resultados, 'pila_directa')
+                pila = PilaBandas.abrir(ruta_pila, clave)
+                if pila is None:
+                    _avisar(progreso, 'rasterizado')
+                    pila = PilaBandas.crear_desde_vectores(ruta_pila, clave,
+                                                           cargadores_vectoriales(capas_vectoriales, campo_cobertura),
+                                                           max_crs, dst_transform, dst_shape,
+                                                           ruta_intermedios=carpeta_salida if guardar_intermedios else None)
+                else:
+                    logger.info(f"Pila rasterizada reutilizada: {pila.ruta}")
+                _avisar(progreso, 'superposicion')
+                amenaza = pila.combinar(pesos)
+            elif modo == 'pila':
+                pila = abrir_pila_alineada(rasters_disponibles, max_crs, dst_transform, dst_shape,
+                                           ruta_resultados, cache, progreso)
+                _avisar(progreso, 'superposicion')
+                amenaza = pila.combinar(pesos)
+            elif modo == 'compacto':
+                # Calificaciones uint8 y pesos en punto fijo: un byte por variable y píxel
+                amenaza = superponer_compacto(rasters_disponibles, pesos, max_crs, dst_transform, dst_shape,
+                                              progreso=lambda f: _avisar(progreso, 'alineacion', f) if f < 1
+                                              else _avisar(progreso, 'superposicion', 0))
+            else:
+                # La alineación y la superposición se hacen juntas, variable por variable
+                amenaza = superponer_en_memoria(rasters_disponibles, pesos, max_crs, dst_transform, dst_shape,
+                                                progreso=lambda f: _avisar(progreso, 'alineacion', f) if f < 1
+                                                else _avisar(progreso, 'superposicion', 0))
+
+            # Reclasificar la amenaza en 5 categorías (0 = sin datos)
+            amenaza_reclasificada = reclasificar(amenaza)
+
+            # Usamos la misma transformación y CRS que usamos para alinear los rasters
+            _avisar(progreso, 'escritura')
+            resumen = {'escritura': [
+                escribir_raster(ruta_amenaza, amenaza, max_crs, dst_transform, compresion=compresion),
+                escribir_clases(ruta_clases, amenaza_reclasificada, max_crs, dst_transform, compresion=compresion)
+            ]}
+            if estadisticas:
+                medicion.iniciar_etapa('estadisticas')
+                resumen['estadisticas'] = estadisticas_raster(amenaza, estadisticas, clases=amenaza_reclasificada)
+
+        logger.info(f"Raster de amenaza guardado en: {ruta_amenaza}")
+
+        datos = {'forma': list(dst_shape), 'alineacion': alineacion, 'variables': sorted(pesos)}
+        grafo.registrar('amenaza', entradas, parametros, [ruta_amenaza, ruta_clases], datos)
+        resumen.update(datos)
+        return _terminar_amenaza(resumen, ruta_amenaza, ruta_clases, modo, cache, grafo, medicion)
+
+    finally:
+        for src in rasters_disponibles.values():
+            src.close()
+
+def _terminar_amenaza(resumen, ruta_amenaza, ruta_clases, modo, cache, grafo, medicion):
+    """Completa el resumen de la amenaza con las rutas, la caché, el grafo y la instrumentación."""
+    resumen.update(ruta=ruta_amenaza, ruta_clases=ruta_clases, modo=modo, cache=cache.resumen(),
+                   grafo=grafo.resumen())
+    logger.info(f"Etapas reutilizadas: {', '.join(grafo.reutilizadas) or 'ninguna'}; "
+                f"reconstruidas: {', '.join(grafo.reconstruidas) or 'ninguna'}")
+    resumen['instrumentacion'] = medicion.terminar(ruta=ruta_amenaza, modo=modo, forma=resumen['forma'])
+    registrar_en_archivo(resumen['instrumentacion'])
+    return resumen
+
+def calcular_escenarios(ruta_cobertura, ruta_shps_amenaza, escenarios=None, monte_carlo=None,
+                        ruta_resultados=None, progreso=None, compresion=None):
+    """
+    Sensibilidad de la amenaza a los pesos. escenarios es una lista de juegos de pesos
+    (diccionarios variable -> peso); monte_carlo es un diccionario con num_escenarios y,
+    opcionalmente, sigma y semilla para perturbar los pesos (base, por defecto
+    PESOS_POR_DEFECTO). Todos los escenarios se evalúan por bloques sobre la pila alineada
+    (la misma del modo 'pila') y se guardan los rasters de resumen escenarios_*.tif (ver
+    escenarios.RESUMENES_ESCENARIOS). Devuelve un resumen con las rutas, el rendimiento en
+    escenarios-píxel por segundo y la instrumentación por etapa.
+    Lanza ValueError si no se da ni escenarios ni monte_carlo, o si hay menos de dos
+    variables disponibles.
+    """
+    if not escenarios and not monte_carlo:
+        raise ValueError("Indique una lista de escenarios de pesos o una especificación de Monte Carlo.")
+
+    medicion = Instrumentacion('escenarios')
+    progreso = medicion.envolver(progreso)
+    ruta_resultados = ruta_resultados or carpeta_resultados(ruta_cobertura)
+    os.makedirs(ruta_resultados, exist_ok=True)
+    variables = {'susceptibilidad': os.path.join(ruta_resultados, 'susceptibilidad.tif')}
+    for nombre in VARIABLES_AMENAZA:
+        variables[nombre] = os.path.join(ruta_shps_amenaza, f'{nombre}.shp')
+    cache = CacheRasters(os.path.join(ruta_resultados, 'cache'))
+
+    rasters_disponibles = {}
+    try:
+        _avisar(progreso, 'lectura')
+        rasters_disponibles = rasterizar_variables(variables, ruta_resultados, cache, progreso=progreso,
+                                                   compresion=compresion)
+        if len(rasters_disponibles) < 2:
+            raise ValueError("No hay suficientes variables disponibles para calcular la amenaza.")
+        _avisar(progreso, 'alineacion')
+        max_crs, dst_transform, dst_shape = calcular_rejilla_referencia(rasters_disponibles)
+        pila = abrir_pila_alineada(rasters_disponibles, max_crs, dst_transform, dst_shape,
+                                   ruta_resultados, cache, progreso)
+    finally:
+        for src in rasters_disponibles.values():
+            src.close()
+
+    nombres = [nombre for nombre in pila.nombres if nombre in PESOS_POR_DEFECTO]
+    matriz = matriz_pesos(escenarios, nombres) if escenarios else None
+    if monte_carlo:
+        base = dict(PESOS_POR_DEFECTO, **(monte_carlo.get('pesos') or {}))
+        aleatorios = pesos_monte_carlo(base, nombres, int(monte_carlo['num_escenarios']),
+                                       float(monte_carlo.get('sigma', 0.2)), monte_carlo.get('semilla', 0))
+        matriz = aleatorios if matriz is None else np.vstack([matriz, aleatorios])
+
+    _avisar(progreso, 'superposicion', 0)
+    resumen = evaluar_escenarios(pila, matriz, nombres, ruta_resultados, compresion=compresion,
+                                 progreso=lambda f: _avisar(progreso, 'superposicion', f))
+    resumen['forma'] = list(dst_shape)
+    resumen['instrumentacion'] = medicion.terminar(ruta=ruta_resultados, escenarios=len(matriz),
+                                                   forma=list(dst_shape))
+    registrar_en_archivo(resumen['instrumentacion'])
+    return resumen
+
+def calcular_temporada(ruta_cobertura, ruta_shps_amenaza, fechas, pesos=None, ruta_resultados=None,
+                       variables_dinamicas=VARIABLES_DINAMICAS, progreso=None, compresion=None):
+    """
+    Amenaza de una serie de fechas en un solo trabajo. La suma ponderada de las variables
+    estáticas (todas menos variables_dinamicas) se calcula una vez sobre la rejilla de un
+    cálculo completo con las capas de ruta_shps_amenaza y se guarda en resultados/temporada
+    (ver temporada.ParteEstatica); se reutiliza mientras esas capas, sus pesos y la rejilla
+    no cambien. Para cada fecha solo se rasterizan y alinean las variables dinámicas (ver
+    temporada.entradas_fechas; las que falten en una fecha se toman de ruta_shps_amenaza) y
+    se guardan amenaza_<fecha>.tif y amenaza_clases_<fecha>.tif.
+    Devuelve un resumen con las rutas y los segundos de cada fecha.
+    """
+    medicion = Instrumentacion('temporada')
+    progreso = medicion.envolver(progreso)
+    pesos = dict(PESOS_POR_DEFECTO, **(pesos or {}))
+    ruta_resultados = ruta_resultados or carpeta_resultados(ruta_cobertura)
+    ruta_temporada = os.path.join(ruta_resultados, 'temporada')
+    os.makedirs(ruta_temporada, exist_ok=True)
+    cache = CacheRasters(os.path.join(ruta_resultados, 'cache'))
+
+    variables = {'susceptibilidad': os.path.join(ruta_resultados, 'susceptibilidad.tif')}
+    for nombre in VARIABLES_AMENAZA:
+        variables[nombre] = os.path.join(ruta_shps_amenaza, f'{nombre}.shp')
+    # Las variables dinámicas que falten en una fecha se toman de las capas de ruta_shps_amenaza
+    fechas = entradas_fechas(fechas, variables_dinamicas, base=variables)
+
+    rasters_disponibles = {}
+    try:
+        _avisar(progreso, 'lectura')
+        rasters_disponibles = rasterizar_variables(variables, ruta_resultados, cache, progreso=progreso,
+                                                   compresion=compresion)
+        _avisar(progreso, 'alineacion')
+        max_crs, dst_transform, dst_shape = calcular_rejilla_referencia(rasters_disponibles)
+        estaticas = {nombre: src for nombre, src in rasters_disponibles.items() if nombre not in variables_dinamicas}
+        if not estaticas:
+            raise ValueError("No hay variables estáticas disponibles.")
+        hashes = {nombre: cache.hash_contenido([src.name]) for nombre, src in estaticas.items()}
+        clave = clave_estatica(hashes, pesos, max_crs, dst_transform, dst_shape)
+        parte = ParteEstatica.abrir(ruta_temporada, clave)
+        reutilizada = parte is not None
+        if parte is None:
+            parte = ParteEstatica.crear(ruta_temporada, clave, estaticas, pesos, max_crs, dst_transform, dst_shape,
+                                        compresion=compresion)
+        else:
+            logger.info(f"Parte estática reutilizada: {parte.rutas[0]}")
+    finally:
+        for src in rasters_disponibles.values():
+            src.close()
+
+    suma_estatica, peso_estatico = parte.leer()
+    resumen = {'ruta': ruta_temporada, 'forma': list(dst_shape), 'fechas': {},
+               'estatica': {'rutas': list(parte.rutas), 'variables': parte.nombres, 'reutilizada': reutilizada}}
+    for i, (fecha, entradas) in enumerate(fechas.items()):
+        _avisar(progreso, 'superposicion', i / len(fechas))
+        inicio = time.perf_counter()
+        # Las capas vectoriales se califican y rasterizan (con la caché); los GeoTIFF ya están calificados
+        vectoriales = {nombre: ruta for nombre, ruta in entradas.items() if ruta.lower().endswith('.shp')}
+        carpeta_fecha = os.path.join(ruta_temporada, fecha)
+        os.makedirs(carpeta_fecha, exist_ok=True)
+        fuentes = {}
+        try:
+            fuentes = rasterizar_variables(vectoriales, carpeta_fecha, cache, compresion=compresion)
+            for nombre, ruta in entradas.items():
+                if nombre not in vectoriales:
+                    fuentes[nombre] = rasterio.open(ruta)
+            amenaza = parte.completar(fuentes, pesos, suma_estatica, peso_estatico)
+        finally:
+            for src in fuentes.values():
+                src.close()
+
+        ruta_amenaza = os.path.join(ruta_temporada, f'amenaza_{fecha}.tif')
+        ruta_clases = os.path.join(ruta_temporada, f'amenaza_clases_{fecha}.tif')
+        escribir_raster(ruta_amenaza, amenaza, max_crs, dst_transform, compresion=compresion)
+        escribir_clases(ruta_clases, reclasificar(amenaza), max_crs, dst_transform, compresion=compresion)
+        resumen['fechas'][fecha] = {'ruta': ruta_amenaza, 'ruta_clases': ruta_clases, 'variables': sorted(fuentes),
+                                    'segundos': round(time.perf_counter() - inicio, 3)}
+        logger.info(f"Amenaza de {fecha} guardada en {ruta_amenaza} "
+                    f"({resumen['fechas'][fecha]['segundos']:.2f} s, variables: {', '.join(sorted(fuentes))})")
+
+    logger.info(cache.resumen())
+    resumen['cache'] = cache.resumen()
+    resumen['instrumentacion'] = medicion.terminar(ruta=ruta_temporada, fechas=len(fechas), forma=list(dst_shape))
+    registrar_en_archivo(resumen['instrumentacion'])
+    return resumen
+
+def calcular_estadisticas_zonales(ruta_zonas, campo_zona, ruta_resultados, percentiles=PERCENTILES_ZONALES,
+                                  ruta_amenaza=None, ruta_salida=None, progreso=None):
+    """
+    Área de cada clase de amenaza, media y percentiles por zona (municipio, vereda, área
+    protegida...) a partir de ruta_amenaza (por defecto amenaza.tif de la carpeta de
+    resultados). El raster de zonas se guarda en la carpeta 'zonas' y se reutiliza en los
+    cálculos siguientes. La tabla se guarda como CSV (zonal_<capa>_<campo>.csv) en
+    ruta_salida o en la carpeta de resultados; devuelve un resumen con su ruta y la
+    instrumentación por etapa. Si se da progreso, se llama como en calcular_amenaza (las
+    estadísticas se informan como la etapa de superposición).
+    """
+    ruta_amenaza = ruta_amenaza or os.path.join(ruta_resultados, 'amenaza.tif')
+    if not os.path.exists(ruta_amenaza):
+        raise ValueError(f"No existe el raster de amenaza {ruta_amenaza}; calcule primero la amenaza.")
+    medicion = Instrumentacion('zonal')
+    _avisar(progreso, 'lectura')
+    with rasterio.open(ruta_amenaza) as src:
+        crs, transform, forma = src.crs, src.transform, src.shape
+
+    _avisar(progreso, 'rasterizado')
+    with medicion.etapa('rasterizado'):
+        ruta_etiquetas, nombres = rasterizar_zonas(ruta_zonas, campo_zona, crs, transform, forma,
+                                                   os.path.join(ruta_resultados, 'zonas'))
+    _avisar(progreso, 'superposicion')
+    with medicion.etapa('estadisticas'):
+        tabla = estadisticas_zonales(ruta_amenaza, ruta_etiquetas, nombres, percentiles)
+
+    _avisar(progreso, 'escritura')
+    capa = os.path.splitext(os.path.basename(ruta_zonas))[0]
+    ruta_csv = os.path.join(ruta_salida or ruta_resultados, f'zonal_{nombre_archivo(capa)}_{nombre_archivo(campo_zona)}.csv')
+    tabla.to_csv(ruta_csv, index=False, float_format='%.4f')
+    logger.info(f"Estadísticas zonales guardadas en: {ruta_csv}")
+
+    resumen = {'ruta': ruta_csv, 'zonas': len(nombres), 'ruta_etiquetas': ruta_etiquetas}
+    resumen['instrumentacion'] = medicion.terminar(ruta=ruta_csv, zonas=len(nombres), forma=list(forma))
+    registrar_en_archivo(resumen['instrumentacion'])
+    return resumen
+
+def procesar_area(ruta_cobertura, campo_cobertura, ruta_shps_amenaza, pesos=None, modo='memoria',
+                  ruta_resultados=None, num_trabajadores=1, tipo_pool='hilos', estadisticas=None,
+                  compresion=None):
+    """
+    Calcula la susceptibilidad y la amenaza de un área de estudio. Devuelve un resumen con
+    los resultados de cada etapa y su duración en segundos.
+    """
+    tiempos = {}
+    inicio = time.perf_counter()
+    susceptibilidad = calcular_susceptibilidad(ruta_cobertura, campo_cobertura, ruta_resultados,
+                                               num_trabajadores=num_trabajadores, estadisticas=estadisticas,
+                                               compresion=compresion)
+    tiempos['susceptibilidad'] = round(time.perf_counter() - inicio, 3)
+
+    inicio_amenaza = time.perf_counter()
+    amenaza = calcular_amenaza(ruta_cobertura, ruta_shps_amenaza, pesos, modo=modo, ruta_resultados=ruta_resultados,
+                               campo_cobertura=campo_cobertura, num_trabajadores=num_trabajadores,
+                               tipo_pool=tipo_pool, estadisticas=estadisticas, compresion=compresion)
+    tiempos['amenaza'] = round(time.perf_counter() - inicio_amenaza, 3)
+    tiempos['total'] = round(time.perf_counter() - inicio, 3)
+    return {'susceptibilidad': susceptibilidad, 'amenaza': amenaza, 'segundos': tiempos}
@@ -0,0 +1,86 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from rasterio import windows
+from rasterio.features import rasterize
+from shapely.geometry import box
+
+logger = logging.getLogger(__name__)
+
+# Tamaño (en píxeles) de las ventanas que se rasterizan por separado; múltiplo de 16
+TAMANO_TESELA = 1024
+
+def eliminar_repetidas(gdf, columna):
+    """
+    Elimina las geometrías repetidas con el mismo valor. De cada grupo de repetidas se
+    conserva la última, que es la que determina el resultado porque rasterize quema las
+    geometrías en orden y las posteriores sobrescriben a las anteriores.
+    """
+    claves = pd.DataFrame({'geometria': gdf.geometry.to_wkb().values, 'valor': gdf[columna].values})
+    repetidas = claves.duplicated(keep='last').values
+    if repetidas.any():
+        logger.info(f"{int(repetidas.sum())} geometrías repetidas con el mismo valor se omiten")
+        gdf = gdf[~repetidas]
+    return gdf
+
+def _rasterizar_ventana(geometrias, valores, indice, ventana, transform):
+    """
+    Rasteriza en una ventana solo las geometrías cuyo rectángulo envolvente la toca,
+    en el orden original, y devuelve la ventana como uint8 (0 = sin geometría).
+    """
+    limites = windows.bounds(ventana, transform)
+    # La consulta devuelve posiciones sin orden: ordenarlas mantiene el orden de quemado
+    seleccion = np.sort(indice.query(box(*limites)))
+    forma = (int(ventana.height), int(ventana.width))
+    if len(seleccion) == 0:
+        return np.zeros(forma, dtype=np.uint8)
+
+    datos = rasterize(zip(geometrias[seleccion], valores[seleccion]), out_shape=forma,
+                      transform=windows.transform(ventana, transform), fill=np.nan,
+                      all_touched=True, dtype=np.float32)
+    return np.where(np.isnan(datos), 0, np.round(datos)).astype(np.uint8)
+
+def rasterizar_por_teselas(gdf, columna, dst, tamano_tesela=TAMANO_TESELA, num_trabajadores=1):
+    """
+    Rasteriza una columna en el dataset abierto dst ventana por ventana, usando el índice
+    espacial del GeoDataFrame para quemar en cada ventana solo las geometrías que la tocan.
+
+    Cada ventana usa la transformación de la rejilla completa desplazada un número entero de
+    píxeles, por lo que el resultado es el mismo que rasterizar todo de una vez (valores
+    redondeados a uint8, 0 = sin geometría). Con num_trabajadores > 1 las ventanas se
+    rasterizan en un pool de hilos; la escritura se hace en orden.
+    """
+    inicio = time.perf_counter()
+    gdf = eliminar_repetidas(gdf, columna)
+    geometrias, valores = gdf.geometry.values, gdf[columna].values
+    # Las consultas al índice devuelven posiciones en gdf, que coinciden con las de geometrias
+    indice = gdf.sindex
+    ventanas = [ventana for fila in range(0, dst.height, tamano_tesela)
+                for ventana in (windows.Window(col, fila, min(tamano_tesela, dst.width - col),
+                                               min(tamano_tesela, dst.height - fila))
+                                for col in range(0, dst.width, tamano_tesela))]
+
+    def rasterizar(ventana):
+        return _rasterizar_ventana(geometrias, valores, indice, ventana, dst.transform)
+
+    if num_trabajadores <= 1:
+        for ventana in ventanas:
+            dst.write(rasterizar(ventana), 1, window=ventana)
+    else:
+        # Como mucho 2 ventanas por trabajador en vuelo, para acotar la memoria
+        with ThreadPoolExecutor(max_workers=num_trabajadores) as pool:
+            en_vuelo = deque()
+            for ventana in ventanas:
+                if len(en_vuelo) >= 2 * num_trabajadores:
+                    anterior, futuro = en_vuelo.popleft()
+                    dst.write(futuro.result(), 1, window=anterior)
+                en_vuelo.append((ventana, pool.submit(rasterizar, ventana)))
+            while en_vuelo:
+                anterior, futuro = en_vuelo.popleft()
+                dst.write(futuro.result(), 1, window=anterior)
+
+    logger.info(f"Rasterizadas {len(geometrias)} geometrías en {len(ventanas)} ventanas de {tamano_tesela} px "
+                f"con {num_trabajadores} trabajador(es) ({time.perf_counter() - inicio:.2f} s)")
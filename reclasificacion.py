@@ -0,0 +1,80 @@
+import functools
+import numpy as np
+
+# Esquema de clases del protocolo: 0 = sin datos, <=1 muy baja, <=2 baja, <=3 moderada, <=4 alta, >4 muy alta
+CORTES_CLASES = (1, 2, 3, 4)
+VALORES_CLASES = (1, 2, 3, 4, 5)
+CLASE_CERO = 0
+
+def _reclasificar_flotante(datos, cortes, clases, clase_cero, out):
+    """
+    Reclasifica un array de valores continuos con operaciones nativas de NumPy.
+    """
+    indice = np.zeros(datos.shape, dtype=np.uint8)
+    mascara = np.empty(datos.shape, dtype=bool)
+    for corte in cortes:
+        # ~(x <= corte) en lugar de x > corte para que los NaN caigan en la última clase,
+        # igual que en la reclasificación por píxel original
+        np.less_equal(datos, corte, out=mascara)
+        np.logical_not(mascara, out=mascara)
+        np.add(indice, mascara, out=indice, casting='unsafe')
+
+    tabla = np.asarray(clases, dtype=np.uint8)
+    if np.array_equal(tabla, np.arange(len(tabla))):
+        np.copyto(out, indice)
+    else:
+        np.take(tabla, indice, out=out)
+
+    if clase_cero is not None:
+        np.equal(datos, 0, out=mascara)
+        np.copyto(out, np.uint8(clase_cero), where=mascara)
+    return out
+
+@functools.lru_cache(maxsize=32)
+def tabla_uint8(cortes=CORTES_CLASES, clases=VALORES_CLASES, clase_cero=CLASE_CERO):
+    """
+    Construye la tabla de consulta de 256 entradas para reclasificar rasters uint8.
+    """
+    valores = np.arange(256, dtype=np.float64)
+    tabla = np.empty(256, dtype=np.uint8)
+    _reclasificar_flotante(valores, cortes, clases, clase_cero, tabla)
+    tabla.setflags(write=False)
+    return tabla
+
+def reclasificar(datos, cortes=CORTES_CLASES, clases=VALORES_CLASES, clase_cero=CLASE_CERO, out=None):
+    """
+    Reclasifica un raster en clases uint8 según puntos de corte cerrados por la derecha.
+
+    Los valores iguales a 0 reciben clase_cero (None para desactivarlo); el resto recibe
+    clases[i] donde i es el número de cortes superados. Los rasters uint8 se reclasifican
+    con una tabla de 256 entradas. Si se da out, el resultado se escribe en ese buffer.
+    """
+    cortes = tuple(cortes)
+    clases = tuple(clases)
+    if len(clases) != len(cortes) + 1:
+        raise ValueError(f"Se esperaban {len(cortes) + 1} clases para {len(cortes)} cortes, se recibieron {len(clases)}")
+
+    datos = np.asarray(datos)
+    if out is None:
+        out = np.empty(datos.shape, dtype=np.uint8)
+    elif out.shape != datos.shape or out.dtype != np.uint8:
+        raise ValueError(f"El buffer de salida debe ser uint8 con forma {datos.shape}")
+
+    if datos.dtype == np.uint8:
+        return np.take(tabla_uint8(cortes, clases, clase_cero), datos, out=out)
+    return _reclasificar_flotante(datos, cortes, clases, clase_cero, out)
+
+def reclasificar_raster(ruta_entrada, ruta_salida, banda=1, compresion=None, **kwargs):
+    """
+    Reclasifica un GeoTIFF bloque por bloque y guarda las clases como COG uint8 con la
+    paleta de clases y 0 como nodata (ver escritura.py).
+    """
+    import rasterio
+    from escritura import salida_clases
+
+    with rasterio.open(ruta_entrada) as src:
+        salida = salida_clases(ruta_salida, src.shape, src.crs, src.transform, compresion=compresion)
+        with salida as dst:
+            for _, ventana in src.block_windows(banda):
+                dst.write(reclasificar(src.read(banda, window=ventana), **kwargs), 1, window=ventana)
+    return ruta_salida
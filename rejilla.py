@@ -0,0 +1,138 @@
+import math
+import logging
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+
+logger = logging.getLogger(__name__)
+
+# Diferencia máxima (en fracción de píxel) para considerar que dos rejillas coinciden
+TOLERANCIA_ALINEACION = 1e-6
+
+def limites_capa(ruta):
+    """
+    Devuelve (crs, (minx, miny, maxx, maxy)) de una capa vectorial. Si pyogrio está
+    disponible se leen solo los metadatos, sin cargar las geometrías.
+    """
+    try:
+        import pyogrio
+        info = pyogrio.read_info(ruta, force_total_bounds=True)
+        return CRS.from_user_input(info['crs']), tuple(info['total_bounds'])
+    except ImportError:
+        gdf = gpd.read_file(ruta)
+        return CRS.from_user_input(gdf.crs), tuple(gdf.total_bounds)
+
+def rejilla_union(limites, crs, resolucion, anclaje=None):
+    """
+    Calcula la rejilla que cubre la unión de varios límites (ya expresados en crs), con
+    píxeles de tamaño resolucion (un número o (x, y)). Sin anclaje el origen es la esquina
+    superior izquierda de la unión; con anclaje = (x, y) los bordes de los píxeles caen
+    sobre la retícula que pasa por ese punto, de modo que el raster de ese origen queda
+    alineado con la rejilla. Devuelve (crs, transform, (alto, ancho)).
+    """
+    res_x, res_y = resolucion if isinstance(resolucion, (tuple, list)) else (resolucion, resolucion)
+    minx = min(b[0] for b in limites)
+    miny = min(b[1] for b in limites)
+    maxx = max(b[2] for b in limites)
+    maxy = max(b[3] for b in limites)
+    if anclaje is not None:
+        minx = anclaje[0] + math.floor((minx - anclaje[0]) / res_x + TOLERANCIA_ALINEACION) * res_x
+        maxy = anclaje[1] + math.ceil((maxy - anclaje[1]) / res_y - TOLERANCIA_ALINEACION) * res_y
+    ancho = max(int(math.ceil((maxx - minx) / res_x - TOLERANCIA_ALINEACION)), 1)
+    alto = max(int(math.ceil((maxy - miny) / res_y - TOLERANCIA_ALINEACION)), 1)
+    transform = rasterio.transform.from_origin(minx, maxy, res_x, res_y)
+    return crs, transform, (alto, ancho)
+
+def rejilla_union_vectorial(rutas, resolucion, crs=None):
+    """
+    Calcula la rejilla de unión a partir de los límites de varias capas vectoriales.
+    Los límites se transforman al CRS indicado o, si no se da, al de la primera capa.
+    """
+    limites = []
+    for ruta in rutas:
+        crs_capa, bounds = limites_capa(ruta)
+        if crs is None:
+            crs = crs_capa
+        if crs_capa != crs:
+            bounds = transform_bounds(crs_capa, crs, *bounds)
+        limites.append(bounds)
+    crs, transform, forma = rejilla_union(limites, crs, resolucion)
+    logger.info(f"Rejilla de unión: {forma[1]} x {forma[0]} píxeles de {resolucion} unidades")
+    return crs, transform, forma
+
+def rejilla_fuentes(fuentes):
+    """
+    Calcula la rejilla común de varios rasters abiertos (diccionario nombre -> dataset):
+    cubre la unión de todos sus límites y usa el CRS, la resolución y la retícula de
+    píxeles de la fuente más fina (a igual resolución, la primera por nombre), de modo
+    que esa fuente y las que comparten su retícula se leen sin reproyectar. El resultado
+    no depende del orden de las fuentes. Devuelve (crs, transform, (alto, ancho)).
+    """
+    nombre, referencia = min(fuentes.items(), key=lambda f: (abs(f[1].res[0] * f[1].res[1]), f[0]))
+    crs = referencia.crs
+    limites = [src.bounds if src.crs == crs else transform_bounds(src.crs, crs, *src.bounds)
+               for src in fuentes.values()]
+    crs, transform, forma = rejilla_union(limites, crs, referencia.res,
+                                          anclaje=(referencia.transform.c, referencia.transform.f))
+    logger.info(f"Rejilla común: {forma[1]} x {forma[0]} píxeles de {referencia.res[0]:g} unidades "
+                f"(retícula de {nombre})")
+    return crs, transform, forma
+
+def desplazamiento_alineado(src, dst_crs, dst_transform):
+    """
+    Si el raster src tiene el mismo CRS, la misma resolución y la misma retícula de
+    píxeles que la rejilla de destino, devuelve (columna, fila) del origen de la rejilla
+    en píxeles de src (enteros, pueden ser negativos); si no, devuelve None.
+    """
+    a = src.transform
+    if src.crs != dst_crs or a.b != 0 or a.d != 0 or dst_transform.b != 0 or dst_transform.d != 0:
+        return None
+    if (abs(a.a - dst_transform.a) > TOLERANCIA_ALINEACION * abs(a.a) or
+            abs(a.e - dst_transform.e) > TOLERANCIA_ALINEACION * abs(a.e)):
+        return None
+    columna = (dst_transform.c - a.c) / a.a
+    fila = (dst_transform.f - a.f) / a.e
+    if abs(columna - round(columna)) > TOLERANCIA_ALINEACION or abs(fila - round(fila)) > TOLERANCIA_ALINEACION:
+        return None
+    return int(round(columna)), int(round(fila))
+
+def leer_ventana_alineada(src, desplazamiento, dst_shape, out=None, banda=1, nodata=None):
+    """
+    Lee de un raster alineado (ver desplazamiento_alineado) la ventana que corresponde a
+    la rejilla de destino, sin remuestrear. Los píxeles fuera del raster quedan con su
+    valor nodata o, si no tiene, con 0 (igual que al reproyectar). Con nodata, los
+    píxeles fuera del raster y los nodata del raster toman ese valor.
+    """
+    if out is None:
+        out = np.empty(dst_shape, dtype=np.float32)
+    if nodata is not None:
+        out.fill(nodata)
+    else:
+        out.fill(src.nodata if src.nodata is not None else 0)
+    columna, fila = desplazamiento
+    col_ini, col_fin = max(columna, 0), min(columna + dst_shape[1], src.width)
+    fila_ini, fila_fin = max(fila, 0), min(fila + dst_shape[0], src.height)
+    if col_ini < col_fin and fila_ini < fila_fin:
+        ventana = Window(col_ini, fila_ini, col_fin - col_ini, fila_fin - fila_ini)
+        destino = out[fila_ini - fila:fila_fin - fila, col_ini - columna:col_fin - columna]
+        destino[...] = src.read(banda, window=ventana)
+        if nodata is not None and src.nodata is not None:
+            destino[destino == src.nodata] = nodata
+    return out
+
+def plan_alineacion(fuentes, dst_crs, dst_transform):
+    """
+    Indica para cada fuente si se lee por ventana ('ventana', ya alineada con la rejilla)
+    o si hay que reproyectarla ('vecino', por vecino más cercano), y lo registra.
+    """
+    plan = {nombre: 'ventana' if desplazamiento_alineado(src, dst_crs, dst_transform) is not None else 'vecino'
+            for nombre, src in fuentes.items()}
+    alineadas = sorted(nombre for nombre, modo in plan.items() if modo == 'ventana')
+    reproyectadas = sorted(nombre for nombre, modo in plan.items() if modo == 'vecino')
+    logger.info(f"Alineación: {len(alineadas)} de {len(plan)} fuentes ya alineadas, se leen por ventana sin "
+                f"reproyectar ({', '.join(alineadas) or '-'}); se reproyectan por vecino más cercano: "
+                f"{', '.join(reproyectadas) or '-'}")
+    return plan
@@ -0,0 +1,430 @@
+import contextlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import reproject
+from rasterio.windows import Window
+from rasterio import windows
+
+from escritura import SalidaRaster, salida_clases
+from instrumentacion import AcumuladorEstadisticas, PASO_MUESTRA, conteo_clases
+from reclasificacion import reclasificar
+from rejilla import desplazamiento_alineado, leer_ventana_alineada, rejilla_fuentes
+
+logger = logging.getLogger(__name__)
+
+# Tamaño de bloque (en píxeles) para el modo por bloques; múltiplo de 16 para GeoTIFF en teselas
+TAMANO_BLOQUE = 512
+
+# Modo compacto: valor uint8 que marca sin datos, escala de los pesos en punto fijo y
+# calificación máxima, de la que depende el tamaño de los acumuladores
+SIN_DATOS_COMPACTO = 255
+ESCALA_PESOS = 1000
+CALIFICACION_MAXIMA = 5
+
+# Píxeles por franja en los núcleos de superposición: los búferes de una franja caben en caché
+PIXELES_FRANJA = 65536
+
+# Hasta este número de variables el peso total se toma de una tabla de 2^n combinaciones
+MAX_VARIABLES_TABLA = 12
+
+def reproyectar_y_alinear(src, dst_crs, dst_transform, dst_shape, out=None, nodata=np.nan):
+    """
+    Lleva un raster a un CRS, transformación y forma de destino. Si ya comparte el CRS, la
+    resolución y la retícula de la rejilla, se lee la ventana correspondiente sin
+    remuestrear; si no, se reproyecta por vecino más cercano (las calificaciones son
+    categorías: no se interpolan). Los píxeles fuera del raster y los nodata del raster
+    quedan en nodata: NaN, que combinar_ponderado trata como sin datos en todos los modos.
+    """
+    desplazamiento = desplazamiento_alineado(src, dst_crs, dst_transform)
+    if desplazamiento is not None:
+        return leer_ventana_alineada(src, desplazamiento, dst_shape, out=out, nodata=nodata)
+    if out is None:
+        out = np.full(dst_shape, nodata, dtype=rasterio.float32)
+    else:
+        out.fill(nodata)
+    reproject(
+        source=rasterio.band(src, 1),
+        destination=out,
+        src_transform=src.transform,
+        src_crs=src.crs,
+        dst_transform=dst_transform,
+        dst_crs=dst_crs,
+        dst_nodata=nodata,
+        resampling=Resampling.nearest
+    )
+    return out
+
+def calcular_rejilla_referencia(fuentes):
+    """
+    Calcula el CRS, la transformación y la forma de la rejilla de referencia a partir de
+    los rasters abiertos (diccionario nombre -> dataset). Ver rejilla.rejilla_fuentes.
+    """
+    return rejilla_fuentes(fuentes)
+
+def _franjas(forma, pixeles=None):
+    """Divide las filas de la rejilla en franjas de unos PIXELES_FRANJA píxeles (slices de filas)."""
+    filas = max(1, (pixeles or PIXELES_FRANJA) // max(1, int(np.prod(forma[1:]))))
+    return [slice(inicio, min(inicio + filas, forma[0])) for inicio in range(0, forma[0], filas)]
+
+def _tabla_pesos(pesos):
+    """
+    Peso total para cada combinación de variables válidas (bit i = variable i), sumado en
+    el mismo orden y con la misma precisión que el bucle por variable original.
+    """
+    bits = np.arange(2 ** len(pesos))
+    tabla = np.zeros(len(bits), dtype=np.float32)
+    for i, peso in enumerate(pesos):
+        tabla += np.where(bits >> i & 1, peso, 0)
+    return tabla
+
+def combinar_ponderado(datos_raster, pesos, out=None):
+    """
+    Calcula el promedio ponderado de las variables alineadas, ignorando los NaN.
+    Los píxeles sin peso reciben 0.
+
+    La rejilla se recorre en franjas de PIXELES_FRANJA píxeles y, en cada franja, se
+    acumulan todas las variables antes de pasar a la siguiente: los acumuladores y los
+    búferes de la franja caben en caché, así que cada variable se lee de memoria una sola
+    vez y no se crean temporales del tamaño de la rejilla. Con hasta MAX_VARIABLES_TABLA
+    variables, en lugar de sumar pesos se guarda qué variables son válidas en cada píxel
+    y el peso total se toma de una tabla. Para entradas finitas el resultado es idéntico
+    al de la implementación anterior.
+    """
+    nombres = list(datos_raster)
+    forma = datos_raster[nombres[0]].shape
+    amenaza = np.empty(forma, dtype=np.float32) if out is None else out
+    pesos = [float(pesos[nombre]) for nombre in nombres]
+    tabla = _tabla_pesos(pesos) if len(nombres) <= MAX_VARIABLES_TABLA else None
+
+    franjas = _franjas(forma)
+    filas = franjas[0].stop - franjas[0].start
+    forma_franja = (filas,) + forma[1:]
+    peso_total_buf = np.empty(forma_franja, dtype=np.float32)
+    producto_buf = np.empty(forma_franja, dtype=np.float32)
+    validos_buf = np.empty(forma_franja, dtype=bool)
+    if tabla is not None:
+        mascara_buf = np.empty(forma_franja, dtype=np.uint16)
+        bit_buf = np.empty(forma_franja, dtype=np.uint16)
+    else:
+        peso_buf = np.empty(forma_franja, dtype=np.float64)
+
+    for franja in franjas:
+        n = franja.stop - franja.start
+        suma, peso_total = amenaza[franja], peso_total_buf[:n]
+        producto, validos = producto_buf[:n], validos_buf[:n]
+        suma.fill(0)
+        if tabla is not None:
+            mascara, bit = mascara_buf[:n], bit_buf[:n]
+            mascara.fill(0)
+        else:
+            peso_total.fill(0)
+        for i, (nombre, peso) in enumerate(zip(nombres, pesos)):
+            trozo = datos_raster[nombre][franja]
+            np.multiply(trozo, peso, out=producto)
+            np.add(suma, np.nan_to_num(producto, copy=False), out=suma)
+            # NaN != NaN: la máscara de válidos sale de una sola comparación
+            np.equal(trozo, trozo, out=validos)
+            if tabla is not None:
+                np.multiply(validos, np.uint16(1 << i), out=bit)
+                np.bitwise_or(mascara, bit, out=mascara)
+            else:
+                # El peso se suma en float64 y se redondea a float32, como en la versión anterior
+                np.multiply(validos, peso, out=peso_buf[:n])
+                np.add(peso_total, peso_buf[:n], out=peso_total, casting='same_kind')
+        if tabla is not None:
+            np.take(tabla, mascara, out=peso_total)
+
+        # Dividir solo donde hay peso; el resto queda en 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(suma, peso_total, out=suma)
+        np.less_equal(peso_total, 0, out=validos)
+        np.copyto(suma, 0, where=validos)
+        np.nan_to_num(suma, nan=0, copy=False)
+    return amenaza
+
+def cuantizar_calificaciones(datos, out=None):
+    """
+    Convierte calificaciones (0-5, con NaN para sin datos) a uint8 para el modo compacto:
+    los valores se redondean y los no finitos se marcan con SIN_DATOS_COMPACTO. Lanza
+    ValueError si alguna calificación queda fuera de 0-CALIFICACION_MAXIMA al redondearla.
+    """
+    if out is None:
+        out = np.empty(datos.shape, dtype=np.uint8)
+    finitos = np.isfinite(datos)
+    with np.errstate(invalid='ignore'):
+        fuera = np.count_nonzero(finitos & ((datos < -0.5) | (datos >= CALIFICACION_MAXIMA + 0.5)))
+    if fuera:
+        raise ValueError(f"{fuera} calificaciones fuera del rango 0-{CALIFICACION_MAXIMA} para el modo compacto")
+    np.rint(datos, out=out, casting='unsafe', where=finitos)
+    np.copyto(out, SIN_DATOS_COMPACTO, where=~finitos)
+    return out
+
+def pesos_punto_fijo(pesos, escala=ESCALA_PESOS):
+    """Pesos en punto fijo: enteros redondeados de peso * escala."""
+    return {nombre: int(round(peso * escala)) for nombre, peso in pesos.items()}
+
+def combinar_ponderado_compacto(datos_raster, pesos, out=None, escala=ESCALA_PESOS):
+    """
+    Versión compacta de combinar_ponderado para calificaciones enteras: las variables son
+    uint8 (SIN_DATOS_COMPACTO = sin datos), los pesos se redondean a punto fijo (peso *
+    escala) y la suma ponderada y el peso total se acumulan en enteros de 16 bits, o de
+    32 si la suma máxima posible no cabe en 16. Se recorre por franjas igual que
+    combinar_ponderado. El resultado (float32) difiere del cálculo en coma flotante solo
+    por el redondeo de los pesos: cada peso tiene un error relativo de hasta
+    0.5 / (peso * escala), que crece para pesos muy pequeños. Las calificaciones válidas
+    mayores que CALIFICACION_MAXIMA se recortan a ella antes de acumular, para que la
+    suma no desborde el tipo elegido.
+    """
+    nombres = list(datos_raster)
+    enteros = pesos_punto_fijo({nombre: pesos[nombre] for nombre in nombres}, escala)
+    if any(peso < 0 for peso in enteros.values()):
+        raise ValueError("El modo compacto no admite pesos negativos")
+    suma_maxima = CALIFICACION_MAXIMA * sum(enteros.values())
+    tipo = np.uint16 if suma_maxima <= np.iinfo(np.uint16).max else np.uint32
+    variables = [(datos_raster[nombre], tipo(enteros[nombre])) for nombre in nombres]
+
+    forma = datos_raster[nombres[0]].shape
+    amenaza = np.empty(forma, dtype=np.float32) if out is None else out
+    franjas = _franjas(forma)
+    filas = franjas[0].stop - franjas[0].start
+    suma_buf = np.empty((filas,) + forma[1:], dtype=tipo)
+    peso_total_buf = np.empty_like(suma_buf)
+    producto_buf = np.empty_like(suma_buf)
+    validos_buf = np.empty(suma_buf.shape, dtype=bool)
+    calificacion_buf = np.empty(suma_buf.shape, dtype=np.uint8)
+
+    for franja in franjas:
+        n = franja.stop - franja.start
+        suma, peso_total = suma_buf[:n], peso_total_buf[:n]
+        producto, validos, calificacion = producto_buf[:n], validos_buf[:n], calificacion_buf[:n]
+        suma.fill(0)
+        peso_total.fill(0)
+        for datos, peso in variables:
+            trozo = datos[franja]
+            np.not_equal(trozo, SIN_DATOS_COMPACTO, out=validos)
+            # Los píxeles sin datos cuentan como 0 en la suma y no aportan peso
+            np.multiply(trozo, validos, out=calificacion)
+            np.minimum(calificacion, CALIFICACION_MAXIMA, out=calificacion)
+            np.multiply(calificacion, peso, out=producto)
+            np.add(suma, producto, out=suma)
+            np.multiply(validos, peso, out=producto)
+            np.add(peso_total, producto, out=peso_total)
+
+        # Donde no hay peso la suma también es 0, así que dividir entre 1 deja un 0
+        np.maximum(peso_total, 1, out=peso_total)
+        np.divide(suma, peso_total, out=amenaza[franja], casting='unsafe')
+    return amenaza
+
+def superponer_en_memoria(fuentes, pesos, dst_crs, dst_transform, dst_shape, progreso=None):
+    """
+    Alinea todas las variables sobre la rejilla completa y calcula la amenaza en memoria.
+    Los píxeles fuera de un raster o sin datos no aportan peso. Si se da progreso, se llama con la fracción de variables alineadas (1 al terminar la
+    alineación, antes de combinar).
+    """
+    datos_raster = {}
+    for i, (nombre, src) in enumerate(fuentes.items()):
+        if progreso is not None:
+            progreso(i / len(fuentes))
+        datos = reproyectar_y_alinear(src, dst_crs, dst_transform, dst_shape)
+        datos_raster[nombre] = datos
+        logger.info(f"Raster {nombre} alineado. Forma: {datos.shape}")
+
+    if progreso is not None:
+        progreso(1.0)
+    for nombre in datos_raster:
+        logger.info(f"Procesando {nombre} con peso {pesos[nombre]}")
+
+    return combinar_ponderado(datos_raster, pesos)
+
+def superponer_compacto(fuentes, pesos, dst_crs, dst_transform, dst_shape, progreso=None):
+    """
+    Como superponer_en_memoria, pero cada variable alineada se guarda como calificaciones
+    uint8 (ver cuantizar_calificaciones) y se combina con combinar_ponderado_compacto: la
+    rejilla completa ocupa un byte por variable y píxel en lugar de cuatro. Los píxeles
+    fuera de un raster o sin datos no aportan peso.
+    """
+    datos_raster = {}
+    alineados = np.empty(dst_shape, dtype=np.float32)
+    for i, (nombre, src) in enumerate(fuentes.items()):
+        if progreso is not None:
+            progreso(i / len(fuentes))
+        reproyectar_y_alinear(src, dst_crs, dst_transform, dst_shape, out=alineados)
+        datos_raster[nombre] = cuantizar_calificaciones(alineados)
+        logger.info(f"Raster {nombre} alineado y cuantizado. Forma: {alineados.shape}")
+    del alineados
+
+    if progreso is not None:
+        progreso(1.0)
+    return combinar_ponderado_compacto(datos_raster, pesos)
+
+def ventanas_bloques(dst_shape, tamano_bloque=TAMANO_BLOQUE):
+    """Recorre la rejilla de destino en ventanas de tamano_bloque x tamano_bloque, por filas."""
+    alto, ancho = dst_shape
+    for fila in range(0, alto, tamano_bloque):
+        for col in range(0, ancho, tamano_bloque):
+            yield Window(col, fila, min(tamano_bloque, ancho - col), min(tamano_bloque, alto - fila))
+
+_locales = threading.local()
+
+def _fuentes_locales(rutas):
+    """
+    Abre (una sola vez por hilo o proceso) los rasters de entrada. Los datasets de GDAL
+    no se pueden compartir entre hilos, así que cada trabajador mantiene los suyos.
+    """
+    clave = tuple(sorted(rutas.items()))
+    if getattr(_locales, 'clave', None) != clave:
+        for src in getattr(_locales, 'fuentes', {}).values():
+            src.close()
+        _locales.fuentes = {nombre: rasterio.open(ruta) for nombre, ruta in rutas.items()}
+        _locales.clave = clave
+    return _locales.fuentes
+
+def _calcular_bloque(fuentes, pesos, dst_crs, dst_transform, ventana):
+    """Calcula la amenaza y su clase para una ventana de la rejilla de destino."""
+    transform_ventana = windows.transform(ventana, dst_transform)
+    forma_ventana = (int(ventana.height), int(ventana.width))
+    datos_raster = {
+        nombre: reproyectar_y_alinear(src, dst_crs, transform_ventana, forma_ventana)
+        for nombre, src in fuentes.items()
+    }
+    amenaza = combinar_ponderado(datos_raster, pesos).astype(np.float32, copy=False)
+    return amenaza, reclasificar(amenaza)
+
+def _calcular_bloque_trabajador(rutas, pesos, dst_crs, dst_transform, ventana):
+    """Punto de entrada de los trabajadores del pool: abre sus propias fuentes."""
+    return _calcular_bloque(_fuentes_locales(rutas), pesos, dst_crs, dst_transform, ventana)
+
+def _resultados_ordenados(fuentes, pesos, dst_crs, dst_transform, ventanas, num_trabajadores, tipo_pool):
+    """
+    Genera (ventana, amenaza, clases) en el orden de las ventanas. Con más de un trabajador
+    los bloques se calculan en un pool de hilos o procesos, con un número acotado de
+    bloques en vuelo para que la memoria no crezca si la escritura es más lenta.
+    """
+    if num_trabajadores <= 1:
+        for ventana in ventanas:
+            yield (ventana,) + _calcular_bloque(fuentes, pesos, dst_crs, dst_transform, ventana)
+        return
+
+    if tipo_pool not in ('hilos', 'procesos'):
+        raise ValueError(f"Tipo de pool desconocido: {tipo_pool}")
+    rutas = {nombre: src.name for nombre, src in fuentes.items()}
+    Pool = ThreadPoolExecutor if tipo_pool == 'hilos' else ProcessPoolExecutor
+    with Pool(max_workers=num_trabajadores) as pool:
+        en_vuelo = deque()
+        for ventana in ventanas:
+            en_vuelo.append((ventana, pool.submit(_calcular_bloque_trabajador, rutas, pesos,
+                                                  dst_crs, dst_transform, ventana)))
+            if len(en_vuelo) >= 2 * num_trabajadores:
+                ventana_lista, futuro = en_vuelo.popleft()
+                yield (ventana_lista,) + futuro.result()
+        while en_vuelo:
+            ventana_lista, futuro = en_vuelo.popleft()
+            yield (ventana_lista,) + futuro.result()
+
+def superponer_por_bloques(fuentes, pesos, dst_crs, dst_transform, dst_shape, ruta_salida,
+                           ruta_clases=None, tamano_bloque=TAMANO_BLOQUE,
+                           num_trabajadores=1, tipo_pool='hilos', progreso=None, estadisticas=None,
+                           compresion=None):
+    """
+    Calcula la amenaza recorriendo la rejilla de destino por ventanas.
+
+    Para cada ventana se reproyecta solo la porción correspondiente de cada variable, se
+    calcula el promedio ponderado y la clase, y se escribe directamente en un GeoTIFF en
+    teselas, que al final se convierte en COG (ver escritura.py). La memoria máxima depende
+    del tamaño de bloque, no del área de estudio.
+    Con num_trabajadores > 1 las teselas se calculan en paralelo en un pool de 'hilos' o
+    'procesos'; la escritura se hace siempre en orden, por lo que el resultado es el mismo.
+    Si se da progreso, se llama con la fracción de bloques escritos después de cada bloque.
+    Devuelve un resumen con el número de bloques, la duración del cálculo y los informes de
+    escritura de los rasters; con estadisticas
+    ('completas' o 'muestra') incluye también las de la amenaza y el conteo de clases,
+    calculadas sobre cada bloque mientras está en memoria.
+    """
+    resumen = {'bloques': 0}
+    if estadisticas:
+        # Con bloques de tamaño múltiplo del paso, la muestra coincide con la de la rejilla completa
+        paso = PASO_MUESTRA if estadisticas == 'muestra' else 1
+        acumulador = AcumuladorEstadisticas()
+        clases_total = np.zeros(6, dtype=np.int64)
+    inicio = time.perf_counter()
+    ventanas = list(ventanas_bloques(dst_shape, tamano_bloque))
+    salida = SalidaRaster(ruta_salida, dst_shape, np.float32, dst_crs, dst_transform,
+                          compresion=compresion, tamano_bloque=tamano_bloque)
+    salida_cls = (salida_clases(ruta_clases, dst_shape, dst_crs, dst_transform, compresion=compresion)
+                  if ruta_clases else None)
+    with salida as dst, (salida_cls or contextlib.nullcontext()) as dst_clases:
+        resultados = _resultados_ordenados(fuentes, pesos, dst_crs, dst_transform,
+                                           ventanas,
+                                           num_trabajadores, tipo_pool)
+        for ventana, amenaza, clases in resultados:
+            dst.write(amenaza, 1, window=ventana)
+            if dst_clases is not None:
+                dst_clases.write(clases, 1, window=ventana)
+
+            if estadisticas:
+                acumulador.agregar(amenaza[::paso, ::paso])
+                clases_total += conteo_clases(clases[::paso, ::paso])
+            resumen['bloques'] += 1
+            if progreso is not None:
+                progreso(resumen['bloques'] / len(ventanas))
+        # La conversión a COG (al cerrar) se mide aparte, en los informes de escritura
+        resumen['segundos'] = time.perf_counter() - inicio
+
+    resumen['escritura'] = [s.informe for s in (salida, salida_cls) if s is not None]
+    if estadisticas:
+        resumen['estadisticas'] = dict(acumulador.resultado(), modo=estadisticas, paso_muestra=paso,
+                                       clases=clases_total.tolist())
+    logger.info(f"Amenaza por bloques: {resumen['bloques']} bloques de {tamano_bloque} px escritos en "
+                f"{ruta_salida} con {num_trabajadores} trabajador(es) ({resumen['segundos']:.2f} s)")
+    return resumen
+
+def medir_escalamiento(fuentes, pesos, dst_crs, dst_transform, dst_shape, trabajadores=(1, 2, 4, 8),
+                       tipo_pool='hilos', tamano_bloque=TAMANO_BLOQUE):
+    """
+    Mide el rendimiento (teselas por segundo) del modo por bloques para distintos números
+    de trabajadores. Los resultados se escriben en un directorio temporal y se descartan.
+    """
+    informe = []
+    with tempfile.TemporaryDirectory() as directorio:
+        ruta_salida = os.path.join(directorio, 'amenaza.tif')
+        for n in trabajadores:
+            resumen = superponer_por_bloques(fuentes, pesos, dst_crs, dst_transform, dst_shape, ruta_salida,
+                                             tamano_bloque=tamano_bloque, num_trabajadores=n, tipo_pool=tipo_pool)
+            informe.append({'trabajadores': n, 'tipo_pool': tipo_pool, 'teselas': resumen['bloques'],
+                            'segundos': round(resumen['segundos'], 3),
+                            'teselas_por_segundo': round(resumen['bloques'] / resumen['segundos'], 2)})
+    base = informe[0]['teselas_por_segundo'] if informe else 0
+    for fila in informe:
+        fila['aceleracion'] = round(fila['teselas_por_segundo'] / base, 2) if base else None
+    return informe
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Informe de escalamiento de la superposición de amenaza por teselas.")
+    parser.add_argument('rasters', nargs='+', help="Rasters de entrada (se ponderan por igual)")
+    parser.add_argument('--trabajadores', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--pool', choices=['hilos', 'procesos'], default='hilos')
+    parser.add_argument('--tamano-bloque', type=int, default=TAMANO_BLOQUE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    fuentes = {os.path.splitext(os.path.basename(ruta))[0]: rasterio.open(ruta) for ruta in args.rasters}
+    try:
+        pesos = {nombre: 1.0 for nombre in fuentes}
+        dst_crs, dst_transform, dst_shape = calcular_rejilla_referencia(fuentes)
+        informe = medir_escalamiento(fuentes, pesos, dst_crs, dst_transform, dst_shape,
+                                     args.trabajadores, args.pool, args.tamano_bloque)
+        print(json.dumps(informe, indent=2))
+    finally:
+        for src in fuentes.values():
+            src.close()
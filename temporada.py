@@ -0,0 +1,196 @@
+"""
+Amenaza diaria en temporada seca: las variables que no cambian de un día a otro
+(susceptibilidad, pendiente, accesibilidad, frecuencia, radiación solar) se combinan una
+sola vez en una suma ponderada parcial; cada fecha solo alinea las variables dinámicas
+(precipitación, temperatura, vientos) y completa el promedio ponderado.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+
+from escritura import escribir_raster
+from superposicion import reproyectar_y_alinear
+
+logger = logging.getLogger(__name__)
+
+# Variables que cambian de una fecha a otra durante la temporada
+VARIABLES_DINAMICAS = ('precipitacion', 'temperatura', 'vientos')
+
+# Formatos de las capas dinámicas de cada fecha: shapefile (se califica y rasteriza) o
+# GeoTIFF ya calificado (1-5)
+EXTENSIONES_DINAMICAS = ('.shp', '.tif')
+
+def clave_estatica(hashes_fuentes, pesos, dst_crs, dst_transform, dst_shape):
+    """Clave de la parte estática: contenido y peso de cada variable estática y la rejilla."""
+    descripcion = {
+        'fuentes': sorted(hashes_fuentes.items()),
+        'pesos': sorted((nombre, float(pesos[nombre])) for nombre in hashes_fuentes),
+        'crs': dst_crs.to_wkt(),
+        'transform': list(dst_transform)[:6],
+        'forma': list(dst_shape),
+        'remuestreo': 'vecino',
+        'sin_datos': 'nan'
+    }
+    return hashlib.sha256(json.dumps(descripcion, sort_keys=True).encode()).hexdigest()
+
+def entradas_fechas(fechas, variables_dinamicas=VARIABLES_DINAMICAS, base=None):
+    """
+    Normaliza las entradas de la serie de fechas a un diccionario ordenado
+    fecha -> {variable: ruta}. fechas puede ser una carpeta con una subcarpeta por fecha,
+    un diccionario fecha -> carpeta o un diccionario fecha -> {variable: ruta}. En cada
+    carpeta se buscan <variable>.shp o <variable>.tif. Una variable dinámica que falte en
+    una fecha se toma de base (variable -> ruta de la capa de toda la temporada) con un
+    aviso; si tampoco está en base, se lanza ValueError, para que la fecha no se calcule
+    con un promedio de otras variables.
+    """
+    if isinstance(fechas, str):
+        fechas = {nombre: os.path.join(fechas, nombre) for nombre in sorted(os.listdir(fechas))
+                  if os.path.isdir(os.path.join(fechas, nombre))}
+    normalizadas = {}
+    for fecha, entradas in sorted(fechas.items()):
+        if isinstance(entradas, str):
+            carpeta, entradas = entradas, {}
+            for nombre in variables_dinamicas:
+                for extension in EXTENSIONES_DINAMICAS:
+                    ruta = os.path.join(carpeta, f'{nombre}{extension}')
+                    if os.path.exists(ruta):
+                        entradas[nombre] = ruta
+                        break
+        desconocidas = set(entradas) - set(variables_dinamicas)
+        if desconocidas:
+            raise ValueError(f"Variables no dinámicas en la fecha {fecha}: {', '.join(sorted(desconocidas))}")
+        entradas = dict(entradas)
+        for nombre in variables_dinamicas:
+            if nombre in entradas:
+                continue
+            ruta_base = (base or {}).get(nombre)
+            if not ruta_base or not os.path.exists(ruta_base):
+                raise ValueError(f"Falta la variable {nombre} en la fecha {fecha} y no hay capa base para ella")
+            logger.warning(f"Falta la variable {nombre} en la fecha {fecha}: se usa la capa base {ruta_base}")
+            entradas[nombre] = ruta_base
+        normalizadas[str(fecha)] = entradas
+    if not normalizadas:
+        raise ValueError("No hay fechas que calcular.")
+    return normalizadas
+
+class ParteEstatica:
+    """
+    Suma ponderada parcial de las variables estáticas sobre la rejilla común, guardada
+    como dos rasters compactos: la suma (float32) y una máscara uint8 con un bit por
+    variable estática válida en cada píxel, de la que sale el peso total con una tabla.
+    Un archivo JSON junto a ellos describe las variables, sus pesos y la rejilla.
+    """
+
+    def __init__(self, base, nombres, pesos, crs, transform, forma):
+        self.base = base
+        self.nombres = list(nombres)
+        self.pesos = dict(pesos)
+        self.crs = crs
+        self.transform = transform
+        self.forma = tuple(forma)
+
+    @staticmethod
+    def _rutas(directorio, clave):
+        base = os.path.join(directorio, f'estatica_{clave[:16]}')
+        return base + '_suma.tif', base + '_mascara.tif', base + '.json'
+
+    @classmethod
+    def abrir(cls, directorio, clave):
+        """Abre la parte estática con la clave dada, o devuelve None si no existe."""
+        ruta_suma, ruta_mascara, ruta_meta = cls._rutas(directorio, clave)
+        if not all(os.path.exists(ruta) for ruta in (ruta_suma, ruta_mascara, ruta_meta)):
+            return None
+        with open(ruta_meta, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('clave') != clave:
+            return None
+        return cls(ruta_meta[:-len('.json')], meta['nombres'], meta['pesos'], CRS.from_wkt(meta['crs']),
+                   Affine(*meta['transform']), meta['forma'])
+
+    @classmethod
+    def crear(cls, directorio, clave, fuentes, pesos, dst_crs, dst_transform, dst_shape, compresion=None):
+        """
+        Alinea las variables estáticas de fuentes (nombre -> dataset) de una en una y
+        acumula su suma ponderada y la máscara de variables válidas. Los píxeles fuera de
+        una variable o nodata en ella se alinean como NaN y no cuentan, como en
+        combinar_ponderado. Hasta 8 variables estáticas.
+        """
+        nombres = list(fuentes)
+        if len(nombres) > 8:
+            raise ValueError("La máscara de la parte estática admite hasta 8 variables")
+        inicio = time.perf_counter()
+        os.makedirs(directorio, exist_ok=True)
+        suma = np.zeros(dst_shape, dtype=np.float32)
+        mascara = np.zeros(dst_shape, dtype=np.uint8)
+        datos = np.empty(dst_shape, dtype=np.float32)
+        for i, nombre in enumerate(nombres):
+            reproyectar_y_alinear(fuentes[nombre], dst_crs, dst_transform, dst_shape, out=datos, nodata=np.nan)
+            validos = datos == datos
+            mascara |= validos.astype(np.uint8) << i
+            np.multiply(datos, np.float32(pesos[nombre]), out=datos)
+            suma += np.nan_to_num(datos, copy=False)
+            logger.info(f"Variable estática {nombre} acumulada con peso {pesos[nombre]}")
+
+        # Solo se reemplazan los archivos de esta clave: otros procesos pueden estar leyendo
+        # las partes estáticas de otras rejillas. La descripción se escribe la última, de una
+        # vez, y abrir no acepta la parte hasta que existe
+        ruta_suma, ruta_mascara, ruta_meta = cls._rutas(directorio, clave)
+        try:
+            os.remove(ruta_meta)
+        except FileNotFoundError:
+            pass
+        escribir_raster(ruta_suma, suma, dst_crs, dst_transform, compresion=compresion)
+        escribir_raster(ruta_mascara, mascara, dst_crs, dst_transform, compresion=compresion)
+        pesos = {nombre: float(pesos[nombre]) for nombre in nombres}
+        temporal_meta = f'{ruta_meta}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(temporal_meta, 'w', encoding='utf-8') as f:
+            json.dump({'clave': clave, 'nombres': nombres, 'pesos': pesos, 'crs': dst_crs.to_wkt(),
+                       'transform': list(dst_transform)[:6], 'forma': list(dst_shape)}, f)
+        os.replace(temporal_meta, ruta_meta)
+        logger.info(f"Parte estática de {len(nombres)} variables creada en {time.perf_counter() - inicio:.2f} s: "
+                    f"{ruta_suma}")
+        return cls(ruta_meta[:-len('.json')], nombres, pesos, dst_crs, dst_transform, dst_shape)
+
+    @property
+    def rutas(self):
+        return self.base + '_suma.tif', self.base + '_mascara.tif'
+
+    def leer(self):
+        """Devuelve la suma ponderada parcial y el peso total de las variables estáticas (float32)."""
+        ruta_suma, ruta_mascara = self.rutas
+        with rasterio.open(ruta_suma) as src:
+            suma = src.read(1)
+        with rasterio.open(ruta_mascara) as src:
+            mascara = src.read(1)
+        bits = np.arange(256)
+        tabla = np.zeros(256, dtype=np.float32)
+        for i, nombre in enumerate(self.nombres):
+            tabla += np.where(bits >> i & 1, self.pesos[nombre], 0).astype(np.float32)
+        return suma, tabla[mascara]
+
+    def completar(self, fuentes, pesos, suma_estatica, peso_estatico):
+        """
+        Completa la amenaza de una fecha: alinea las variables dinámicas de fuentes
+        (nombre -> dataset), las suma a la parte estática y divide por el peso total.
+        Los píxeles fuera de una variable dinámica o nodata en ella no aportan peso; los
+        píxeles sin peso reciben 0.
+        """
+        suma = suma_estatica.copy()
+        peso_total = peso_estatico.copy()
+        datos = np.empty(self.forma, dtype=np.float32)
+        for nombre, src in fuentes.items():
+            reproyectar_y_alinear(src, self.crs, self.transform, self.forma, out=datos, nodata=np.nan)
+            peso_total += np.where(datos == datos, np.float32(pesos[nombre]), np.float32(0))
+            np.multiply(datos, np.float32(pesos[nombre]), out=datos)
+            suma += np.nan_to_num(datos, copy=False)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(suma, peso_total, out=suma)
+        suma[peso_total <= 0] = 0
+        return np.nan_to_num(suma, nan=0, copy=False)
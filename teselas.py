@@ -0,0 +1,268 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+import numpy as np
+import plotly.graph_objects as go
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject, transform_bounds
+
+from reclasificacion import reclasificar
+from visualizacion import codificar_png
+
+logger = logging.getLogger(__name__)
+
+try:
+    import PIL  # noqa: F401 (necesario para codificar las teselas)
+    TESELAS_DISPONIBLES = True
+except ImportError:
+    TESELAS_DISPONIBLES = False
+
+# Tamaño de las teselas XYZ en píxeles
+TAMANO_TESELA = 256
+
+# Número máximo de teselas codificadas que se guardan en memoria
+MAX_TESELAS_CACHE = 4096
+
+# Semiperímetro de la Tierra en Web Mercator (EPSG:3857), en metros
+ORIGEN_MERCATOR = math.pi * 6378137.0
+
+CRS_MERCATOR = 'EPSG:3857'
+
+def limites_tesela(z, x, y):
+    """Límites (minx, miny, maxx, maxy) de la tesela XYZ en Web Mercator."""
+    lado = 2 * ORIGEN_MERCATOR / (2 ** z)
+    minx = -ORIGEN_MERCATOR + x * lado
+    maxy = ORIGEN_MERCATOR - y * lado
+    return minx, maxy - lado, minx + lado, maxy
+
+class CacheTeselas:
+    """
+    Caché LRU en memoria de teselas PNG ya codificadas, con contadores de aciertos y de
+    latencia de generación para informar del rendimiento del servidor de teselas.
+    """
+
+    def __init__(self, max_teselas=MAX_TESELAS_CACHE):
+        self.max_teselas = max_teselas
+        self._teselas = OrderedDict()
+        self._bloqueo = threading.Lock()
+        self._latencias = deque(maxlen=1000)
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave):
+        with self._bloqueo:
+            png = self._teselas.get(clave)
+            if png is None:
+                self.fallos += 1
+                return None
+            self._teselas.move_to_end(clave)
+            self.aciertos += 1
+            return png
+
+    def guardar(self, clave, png, segundos):
+        with self._bloqueo:
+            self._teselas[clave] = png
+            self._teselas.move_to_end(clave)
+            while len(self._teselas) > self.max_teselas:
+                self._teselas.popitem(last=False)
+            self._latencias.append(segundos)
+
+    def descartar_capa(self, nombre):
+        """Elimina las teselas de una capa (por ejemplo, cuando se recalcula)."""
+        with self._bloqueo:
+            for clave in [c for c in self._teselas if c[0] == nombre]:
+                del self._teselas[clave]
+
+    def estadisticas(self):
+        """Aciertos, tasa de aciertos y latencia de generación (media y p95, en ms)."""
+        with self._bloqueo:
+            latencias = np.array(self._latencias) * 1000
+            total = self.aciertos + self.fallos
+            return {
+                'teselas_en_cache': len(self._teselas),
+                'solicitudes': total,
+                'aciertos': self.aciertos,
+                'fallos': self.fallos,
+                'tasa_aciertos': round(self.aciertos / total, 3) if total else None,
+                'latencia_media_ms': round(float(latencias.mean()), 1) if len(latencias) else None,
+                'latencia_p95_ms': round(float(np.percentile(latencias, 95)), 1) if len(latencias) else None
+            }
+
+# Capas publicadas: nombre -> {'ruta': ..., 'version': ...}
+_capas = {}
+# Funciones nombre -> ruta (o None) para las capas que este proceso no ha registrado
+_resolutores = []
+_cache = CacheTeselas()
+# Datasets abiertos por hilo del servidor, indexados por (ruta, versión, nivel de vista)
+_locales = threading.local()
+
+def registrar_capa(nombre, ruta):
+    """
+    Publica un raster como capa de teselas. La versión (fecha de modificación) forma
+    parte de la URL, de modo que al recalcular el navegador no reutiliza teselas antiguas.
+    """
+    version = os.stat(ruta).st_mtime_ns
+    anterior = _capas.get(nombre)
+    if anterior and anterior['version'] != version:
+        _cache.descartar_capa(nombre)
+    _capas[nombre] = {'ruta': ruta, 'version': version}
+    return version
+
+def registrar_resolutor(resolutor):
+    """
+    Añade una función que, dado el nombre de una capa no registrada en este proceso,
+    devuelve la ruta de su raster o None. Así cualquier proceso del servidor puede servir
+    las capas publicadas por otro (por ejemplo, resultados del almacén compartido).
+    """
+    _resolutores.append(resolutor)
+
+def _capa(nombre):
+    capa = _capas.get(nombre)
+    if capa is not None:
+        return capa
+    for resolutor in _resolutores:
+        ruta = resolutor(nombre)
+        if ruta is not None:
+            registrar_capa(nombre, ruta)
+            return _capas[nombre]
+    return None
+
+def estadisticas_teselas():
+    return _cache.estadisticas()
+
+def resumen_teselas():
+    """Texto con la tasa de aciertos y la latencia del servidor de teselas."""
+    e = _cache.estadisticas()
+    if not e['solicitudes']:
+        return "Servidor de teselas: sin solicitudes todavía"
+    return (f"Servidor de teselas: {e['solicitudes']} solicitudes, {e['tasa_aciertos']:.0%} aciertos de caché, "
+            f"latencia media {e['latencia_media_ms']} ms (p95 {e['latencia_p95_ms']} ms)")
+
+def _abrir(ruta, version, nivel):
+    """Abre (una vez por hilo) el raster o una de sus vistas generales."""
+    abiertos = getattr(_locales, 'abiertos', None)
+    if abiertos is None:
+        abiertos = _locales.abiertos = {}
+    clave = (ruta, version, nivel)
+    src = abiertos.get(clave)
+    if src is None:
+        # Cerrar las versiones anteriores del mismo archivo
+        for anterior in [c for c in abiertos if c[0] == ruta and c[1] != version]:
+            abiertos.pop(anterior).close()
+        src = rasterio.open(ruta) if nivel is None else rasterio.open(ruta, overview_level=nivel)
+        abiertos[clave] = src
+    return src
+
+def _nivel_vista(src, resolucion_tesela):
+    """
+    Elige la vista general más reducida cuya resolución sigue siendo igual o más fina que
+    la de la tesela. Devuelve None para leer la resolución completa.
+    """
+    resolucion = max(abs(src.res[0]), abs(src.res[1]))
+    nivel = None
+    for i, factor in enumerate(src.overviews(1)):
+        if resolucion * factor <= resolucion_tesela:
+            nivel = i
+    return nivel
+
+def generar_tesela(nombre, z, x, y):
+    """
+    Genera la tesela PNG (z, x, y) de una capa: lee solo la ventana necesaria de la vista
+    general adecuada, la reproyecta a Web Mercator, la reclasifica y la codifica con la
+    paleta de clases (la clase 0 y las zonas sin datos quedan transparentes).
+    Devuelve None si la capa no está registrada ni la encuentra ningún resolutor.
+    """
+    capa = _capa(nombre)
+    if capa is None:
+        return None
+    clave = (nombre, capa['version'], z, x, y)
+    png = _cache.obtener(clave)
+    if png is not None:
+        return png
+
+    inicio = time.perf_counter()
+    limites = limites_tesela(z, x, y)
+    src = _abrir(capa['ruta'], capa['version'], None)
+    limites_src = transform_bounds(CRS_MERCATOR, src.crs, *limites)
+    datos = np.full((TAMANO_TESELA, TAMANO_TESELA), np.nan, dtype=np.float32)
+    fuera = (limites_src[0] >= src.bounds.right or limites_src[2] <= src.bounds.left or
+             limites_src[1] >= src.bounds.top or limites_src[3] <= src.bounds.bottom)
+    if not fuera:
+        nivel = _nivel_vista(src, (limites_src[2] - limites_src[0]) / TAMANO_TESELA)
+        if nivel is not None:
+            src = _abrir(capa['ruta'], capa['version'], nivel)
+        reproject(source=rasterio.band(src, 1), destination=datos,
+                  src_nodata=src.nodata, dst_nodata=np.nan,
+                  dst_transform=from_bounds(*limites, TAMANO_TESELA, TAMANO_TESELA),
+                  dst_crs=CRS_MERCATOR, resampling=Resampling.nearest)
+
+    validos = np.isfinite(datos)
+    clases = reclasificar(np.where(validos, datos, 0))
+    clases[~validos] = 0
+    png = codificar_png(clases, transparente=0, optimizar=False)
+    _cache.guardar(clave, png, time.perf_counter() - inicio)
+
+    if (_cache.aciertos + _cache.fallos) % 200 == 0:
+        logger.info(resumen_teselas())
+    return png
+
+def registrar_rutas(servidor):
+    """
+    Añade al servidor Flask de la aplicación las rutas /tiles/<capa>/<z>/<x>/<y>.png y
+    /tiles/estadisticas.
+    """
+    import flask
+
+    def tesela(capa, z, x, y):
+        png = generar_tesela(capa, z, x, y)
+        if png is None:
+            flask.abort(404)
+        respuesta = flask.Response(png, mimetype='image/png')
+        # La URL incluye la versión de la capa, así que el navegador puede guardar la tesela
+        respuesta.headers['Cache-Control'] = 'public, max-age=86400'
+        return respuesta
+
+    def estadisticas():
+        return flask.jsonify(estadisticas_teselas())
+
+    servidor.add_url_rule('/tiles/<capa>/<int:z>/<int:x>/<int:y>.png', 'tesela', tesela)
+    servidor.add_url_rule('/tiles/estadisticas', 'estadisticas_teselas', estadisticas)
+
+def url_teselas(nombre):
+    """Plantilla de URL XYZ de una capa registrada, absoluta si hay una solicitud en curso."""
+    import flask
+
+    base = flask.request.host_url if flask.has_request_context() else '/'
+    return f"{base}tiles/{nombre}/{{z}}/{{x}}/{{y}}.png?v={_capas[nombre]['version']}"
+
+def figura_teselas(nombre, titulo, ancho=800, alto=600):
+    """
+    Crea un mapa con la capa de teselas sobre un mapa base. Solo se piden al servidor las
+    teselas visibles, de modo que se puede acercar hasta la resolución completa del raster.
+    """
+    with rasterio.open(_capas[nombre]['ruta']) as src:
+        oeste, sur, este, norte = transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+        minx, miny, maxx, maxy = transform_bounds(src.crs, CRS_MERCATOR, *src.bounds)
+
+    # Zoom que encaja la extensión en la vista (en el nivel z el mundo mide 256 * 2^z píxeles)
+    escala = min(ancho / max(maxx - minx, 1e-9), alto / max(maxy - miny, 1e-9))
+    zoom = max(0.0, math.log2(escala * 2 * ORIGEN_MERCATOR / TAMANO_TESELA))
+
+    fig = go.Figure(go.Scattermap(lat=[], lon=[], mode='markers', hoverinfo='skip'))
+    fig.update_layout(
+        title=titulo,
+        height=alto, width=ancho,
+        margin=dict(l=0, r=0, t=40, b=0),
+        map=dict(
+            style='open-street-map',
+            center=dict(lat=(sur + norte) / 2, lon=(oeste + este) / 2),
+            zoom=zoom,
+            layers=[dict(sourcetype='raster', source=[url_teselas(nombre)], below='traces')]
+        )
+    )
+    return fig
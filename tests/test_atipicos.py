@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from atipicos import recortar_raster
+
+def _raster_uint8(ruta):
+    datos = np.full((64, 64), 100, dtype=np.uint8)
+    datos[:, :32] = np.arange(32, dtype=np.uint8) + 90
+    datos[0, :4] = [0, 1, 254, 255]
+    with rasterio.open(ruta, 'w', driver='GTiff', width=64, height=64, count=1, dtype='uint8',
+                       crs='EPSG:3116', transform=from_origin(0, 640, 10, 10)) as dst:
+        dst.write(datos, 1)
+    return datos
+
+@pytest.mark.parametrize('salida', [None, 'recortado.tif'])
+def test_limitar_raster_entero(tmp_path, salida):
+    ruta = str(tmp_path / 'entero.tif')
+    original = _raster_uint8(ruta)
+    ruta_salida = str(tmp_path / salida) if salida else None
+
+    resumen = recortar_raster(ruta, ruta_salida, percentil_bajo=1, percentil_alto=99, limitar=True)
+
+    with rasterio.open(resumen['ruta']) as src:
+        assert src.dtypes[0] == 'uint8'
+        datos = src.read(1)
+    assert resumen['recortados'] > 0
+    assert datos.min() >= np.ceil(resumen['bajo']) and datos.max() <= np.floor(resumen['alto'])
+    dentro = (original >= resumen['bajo']) & (original <= resumen['alto'])
+    assert np.array_equal(datos[dentro], original[dentro])
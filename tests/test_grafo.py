@@ -0,0 +1,38 @@
+import shutil
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from pipeline import calcular_amenaza
+
+def test_etapas_reutilizadas_entre_carpetas_de_salida(tmp_path):
+    # Cada trabajo del almacén escribe en una carpeta nueva: el registro vive en la de resultados
+    ruta_susceptibilidad = str(tmp_path / 'susceptibilidad.tif')
+    with rasterio.open(ruta_susceptibilidad, 'w', driver='GTiff', width=200, height=150, count=1,
+                       dtype='float32', crs='EPSG:3116', transform=from_origin(0, 4500, 30, 30)) as dst:
+        dst.write(np.random.default_rng(0).integers(1, 6, (150, 200)).astype(np.float32), 1)
+    (tmp_path / 'shp').mkdir()
+    gpd.GeoDataFrame({'gridcode': [1, 4]}, geometry=[box(0, 0, 3000, 4500), box(3000, 0, 6000, 4500)],
+                     crs='EPSG:3116').to_file(tmp_path / 'shp' / 'precipitacion.shp')
+
+    def calcular(carpeta):
+        (tmp_path / carpeta).mkdir()
+        return calcular_amenaza(str(tmp_path / 'cobertura.shp'), str(tmp_path / 'shp'),
+                                ruta_resultados=str(tmp_path / 'resultados'),
+                                ruta_susceptibilidad=ruta_susceptibilidad, ruta_salida=str(tmp_path / carpeta))
+
+    primero = calcular('trabajo_1')
+    assert primero['grafo']['reutilizadas'] == []
+    with rasterio.open(primero['ruta']) as src:
+        esperada = src.read(1)
+    shutil.rmtree(tmp_path / 'trabajo_1')
+
+    segundo = calcular('trabajo_2')
+    assert segundo['grafo']['reconstruidas'] == []
+    assert sorted(segundo['grafo']['reutilizadas']) == ['amenaza', 'raster_precipitacion']
+    with rasterio.open(segundo['ruta']) as src:
+        np.testing.assert_array_equal(src.read(1), esperada)
+    assert (tmp_path / 'trabajo_2' / 'amenaza_clases.tif').exists()
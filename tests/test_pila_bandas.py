@@ -0,0 +1,44 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from pila_bandas import PilaBandas
+from superposicion import calcular_rejilla_referencia, superponer_en_memoria, superponer_por_bloques
+
+def _raster(ruta, origen, tamano_pixel, forma, semilla, nodata=None):
+    datos = np.random.default_rng(semilla).integers(1, 6, forma).astype(np.float32)
+    if nodata is not None:
+        datos[:5] = nodata
+    with rasterio.open(ruta, 'w', driver='GTiff', width=forma[1], height=forma[0], count=1, dtype='float32',
+                       crs='EPSG:3116', transform=from_origin(*origen, tamano_pixel, tamano_pixel),
+                       nodata=nodata) as dst:
+        dst.write(datos, 1)
+    return str(ruta)
+
+def _fuentes(carpeta):
+    """Tres rasters con extensiones distintas; uno con otra resolución y uno con nodata."""
+    rutas = {
+        'a': _raster(carpeta / 'a.tif', (0, 3000), 30, (100, 100), 0),
+        'b': _raster(carpeta / 'b.tif', (900, 2400), 30, (60, 120), 1, nodata=-9999),
+        'c': _raster(carpeta / 'c.tif', (300, 3300), 60, (40, 40), 2),
+    }
+    return {nombre: rasterio.open(ruta) for nombre, ruta in rutas.items()}
+
+def test_pila_y_bloques_iguales_a_memoria_con_extensiones_distintas(tmp_path):
+    fuentes = _fuentes(tmp_path)
+    pesos = {'a': 0.5, 'b': 0.3, 'c': 0.2}
+    try:
+        crs, transform, forma = calcular_rejilla_referencia(fuentes)
+        memoria = superponer_en_memoria(fuentes, pesos, crs, transform, forma)
+        pila = PilaBandas.crear(str(tmp_path / 'pila'), 'prueba', fuentes, crs, transform, forma)
+        ruta_bloques = str(tmp_path / 'bloques.tif')
+        superponer_por_bloques(fuentes, pesos, crs, transform, forma, ruta_bloques, tamano_bloque=64)
+    finally:
+        for src in fuentes.values():
+            src.close()
+
+    # Los píxeles fuera de una variable no cuentan en el promedio, en ningún modo
+    assert not np.isnan(memoria).any()
+    np.testing.assert_array_equal(pila.combinar(pesos), memoria)
+    with rasterio.open(ruta_bloques) as src:
+        np.testing.assert_array_equal(src.read(1), memoria)
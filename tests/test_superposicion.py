@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from superposicion import (CALIFICACION_MAXIMA, SIN_DATOS_COMPACTO, calcular_rejilla_referencia,
+                           combinar_ponderado, combinar_ponderado_compacto, cuantizar_calificaciones,
+                           superponer_compacto, superponer_en_memoria)
+
+def test_compacto_igual_a_coma_flotante():
+    rng = np.random.default_rng(0)
+    datos = {nombre: rng.integers(0, 6, (300, 200)).astype(np.float32) for nombre in 'abc'}
+    datos['a'][:10] = np.nan
+    pesos = {'a': 0.5, 'b': 0.3, 'c': 0.2}
+
+    compactos = {nombre: cuantizar_calificaciones(valores) for nombre, valores in datos.items()}
+    np.testing.assert_allclose(combinar_ponderado_compacto(compactos, pesos), combinar_ponderado(datos, pesos),
+                               atol=1e-5)
+
+def test_cuantizar_rechaza_calificaciones_fuera_de_rango():
+    with pytest.raises(ValueError):
+        cuantizar_calificaciones(np.array([1, CALIFICACION_MAXIMA + 1], dtype=np.float32))
+    with pytest.raises(ValueError):
+        cuantizar_calificaciones(np.array([-1, 2], dtype=np.float32))
+
+def test_compacto_recorta_calificaciones_mayores():
+    # Con pesos que llenan uint16, una calificación de 200 desbordaría la suma
+    datos = {'a': np.full((4, 4), 200, dtype=np.uint8), 'b': np.full((4, 4), 5, dtype=np.uint8)}
+    datos['b'][0, 0] = SIN_DATOS_COMPACTO
+    amenaza = combinar_ponderado_compacto(datos, {'a': 6, 'b': 7})
+    assert amenaza.max() <= CALIFICACION_MAXIMA
+    assert amenaza[0, 0] == CALIFICACION_MAXIMA
+
+def test_compacto_igual_a_memoria_con_extensiones_distintas(tmp_path):
+    # Los píxeles fuera de una variable no aportan peso en ninguno de los dos modos
+    fuentes = {}
+    for nombre, origen, tamano_pixel, forma in [('a', (0, 3000), 30, (100, 100)), ('b', (900, 2400), 30, (60, 120)),
+                                                ('c', (300, 3300), 60, (40, 40))]:
+        ruta = str(tmp_path / f'{nombre}.tif')
+        with rasterio.open(ruta, 'w', driver='GTiff', width=forma[1], height=forma[0], count=1, dtype='float32',
+                           crs='EPSG:3116', transform=from_origin(*origen, tamano_pixel, tamano_pixel),
+                           nodata=-9999) as dst:
+            datos = np.random.default_rng(len(fuentes)).integers(1, 6, forma).astype(np.float32)
+            datos[:5] = -9999
+            dst.write(datos, 1)
+        fuentes[nombre] = rasterio.open(ruta)
+    pesos = {'a': 0.5, 'b': 0.3, 'c': 0.2}
+    try:
+        crs, transform, forma = calcular_rejilla_referencia(fuentes)
+        memoria = superponer_en_memoria(fuentes, pesos, crs, transform, forma)
+        compacto = superponer_compacto(fuentes, pesos, crs, transform, forma)
+    finally:
+        for src in fuentes.values():
+            src.close()
+    np.testing.assert_allclose(compacto, memoria, atol=1e-5)
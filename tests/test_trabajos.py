@@ -0,0 +1,43 @@
+import time
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box
+
+from trabajos import ESTADOS_FINALES, TERMINADO, GestorTrabajos
+
+def _datos_amenaza(carpeta):
+    """Susceptibilidad sintética y una capa de precipitación de dos polígonos."""
+    ruta_susceptibilidad = str(carpeta / 'susceptibilidad.tif')
+    with rasterio.open(ruta_susceptibilidad, 'w', driver='GTiff', width=200, height=150, count=1,
+                       dtype='float32', crs='EPSG:3116', transform=from_origin(0, 4500, 30, 30)) as dst:
+        dst.write(np.random.default_rng(0).integers(1, 6, (150, 200)).astype(np.float32), 1)
+    carpeta_shp = carpeta / 'shp'
+    carpeta_shp.mkdir()
+    gpd.GeoDataFrame({'gridcode': [1, 4]}, geometry=[box(0, 0, 3000, 4500), box(3000, 0, 6000, 4500)],
+                     crs='EPSG:3116').to_file(carpeta_shp / 'precipitacion.shp')
+    return ruta_susceptibilidad, str(carpeta_shp)
+
+def test_paralelo_con_procesos_en_la_cola(tmp_path, monkeypatch):
+    # Los trabajadores de la cola crean el pool de procesos del modo paralelo
+    monkeypatch.setenv('VDOM_ALMACEN', str(tmp_path / 'almacen'))
+    ruta_susceptibilidad, ruta_shp = _datos_amenaza(tmp_path)
+    gestor = GestorTrabajos(str(tmp_path / 'cola.sqlite'), num_procesos=1)
+    try:
+        id_trabajo = gestor.encolar('amenaza', {
+            'ruta_cobertura': str(tmp_path / 'cobertura.shp'), 'ruta_shps_amenaza': ruta_shp,
+            'ruta_resultados': str(tmp_path / 'resultados'), 'ruta_susceptibilidad': ruta_susceptibilidad,
+            'modo': 'paralelo', 'tipo_pool': 'procesos', 'num_trabajadores': 2})
+        limite = time.monotonic() + 120
+        while gestor.obtener(id_trabajo)['estado'] not in ESTADOS_FINALES and time.monotonic() < limite:
+            time.sleep(0.2)
+    finally:
+        gestor.detener()
+
+    trabajo = gestor.obtener(id_trabajo)
+    assert trabajo['estado'] == TERMINADO, trabajo['error']
+    with rasterio.open(trabajo['resultado']['ruta']) as src:
+        assert src.shape == (150, 200)
+    assert not any(proceso.is_alive() for proceso in gestor.procesos)
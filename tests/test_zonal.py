@@ -0,0 +1,25 @@
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from zonal import estadisticas_zonales
+
+def _escribir(ruta, datos, nodata=None):
+    with rasterio.open(ruta, 'w', driver='GTiff', width=datos.shape[1], height=datos.shape[0], count=1,
+                       dtype=datos.dtype, crs='EPSG:3116', transform=from_origin(0, 400, 100, 100),
+                       nodata=nodata) as dst:
+        dst.write(datos, 1)
+
+def test_nan_cuenta_como_sin_datos(tmp_path):
+    amenaza = np.full((4, 4), 4.5, dtype=np.float32)
+    amenaza[0] = np.nan
+    ruta_amenaza, ruta_etiquetas = str(tmp_path / 'amenaza.tif'), str(tmp_path / 'zonas.tif')
+    _escribir(ruta_amenaza, amenaza)
+    _escribir(ruta_etiquetas, np.ones((4, 4), dtype=np.uint16), nodata=0)
+
+    fila = estadisticas_zonales(ruta_amenaza, ruta_etiquetas, ['zona']).iloc[0]
+
+    # Cada píxel mide 1 ha
+    assert fila['area_ha_sin_datos'] == 4
+    assert fila['area_ha_muy_alta'] == 12
+    assert abs(fila['media'] - 4.5) < 1e-6
@@ -0,0 +1,415 @@
+import atexit
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from almacen import AlmacenResultados
+from cache_rasters import CacheRasters
+
+logger = logging.getLogger(__name__)
+
+# Base de datos de la cola de trabajos (se puede cambiar con la variable de entorno VDOM_TRABAJOS)
+RUTA_BD_TRABAJOS = os.environ.get('VDOM_TRABAJOS',
+                                  os.path.join(os.path.expanduser('~'), '.vdom', 'trabajos.sqlite'))
+
+# Número de procesos trabajadores que atienden la cola
+NUM_PROCESOS = 2
+
+# Intervalo (segundos) con que los trabajadores consultan la cola cuando está vacía
+ESPERA_COLA = 0.5
+
+# Intervalo mínimo (segundos) entre dos actualizaciones de progreso en la base de datos
+INTERVALO_PROGRESO = 0.5
+
+# Tiempo (segundos) que se espera a que los trabajadores terminen su trabajo al detenerlos
+ESPERA_DETENER = 5
+
+# Estados de un trabajo
+PENDIENTE = 'pendiente'
+EJECUTANDO = 'ejecutando'
+TERMINADO = 'terminado'
+ERROR = 'error'
+CANCELADO = 'cancelado'
+ESTADOS_FINALES = (TERMINADO, ERROR, CANCELADO)
+
+# Peso aproximado de cada etapa en el avance total de un trabajo
+PESOS_ETAPAS = {'lectura': 0.1, 'rasterizado': 0.3, 'alineacion': 0.2, 'superposicion': 0.3, 'escritura': 0.1}
+
+# Parámetros que no cambian el resultado y por tanto no forman parte de la clave de un trabajo
+PARAMETROS_SIN_EFECTO = ('num_trabajadores', 'tipo_pool', 'guardar_intermedios', 'por_teselas', 'compresion')
+
+# Tipos de trabajo cuyos resultados se publican en el almacén compartido (ver almacen.py)
+TIPOS_ALMACEN = ('susceptibilidad', 'amenaza', 'zonal')
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS trabajos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    tipo TEXT NOT NULL,
+    clave TEXT NOT NULL,
+    parametros TEXT NOT NULL,
+    depende_de INTEGER,
+    estado TEXT NOT NULL,
+    etapa TEXT,
+    progreso REAL NOT NULL DEFAULT 0,
+    resultado TEXT,
+    error TEXT,
+    cancelar INTEGER NOT NULL DEFAULT 0,
+    intentos INTEGER NOT NULL DEFAULT 0,
+    pid INTEGER,
+    creado REAL NOT NULL,
+    iniciado REAL,
+    terminado REAL
+);
+CREATE INDEX IF NOT EXISTS trabajos_clave ON trabajos (clave);
+CREATE INDEX IF NOT EXISTS trabajos_estado ON trabajos (estado);
+"""
+
+class TrabajoCancelado(Exception):
+    """Se lanza dentro de un trabajo cuando se ha pedido su cancelación."""
+
+def _funcion_trabajo(tipo):
+    """Función del pipeline que ejecuta cada tipo de trabajo."""
+    from pipeline import calcular_susceptibilidad, calcular_amenaza, calcular_temporada, calcular_estadisticas_zonales
+    return {'susceptibilidad': calcular_susceptibilidad, 'amenaza': calcular_amenaza,
+            'temporada': calcular_temporada, 'zonal': calcular_estadisticas_zonales}[tipo]
+
+def rutas_entrada(tipo, parametros):
+    """Archivos de entrada de un trabajo, cuyo contenido forma parte de su clave."""
+    if tipo == 'zonal':
+        rutas = [parametros['ruta_zonas'],
+                 parametros.get('ruta_amenaza') or os.path.join(parametros['ruta_resultados'], 'amenaza.tif')]
+        return [ruta for ruta in rutas if os.path.exists(ruta)]
+    rutas = [parametros['ruta_cobertura']]
+    if tipo in ('amenaza', 'temporada'):
+        from pipeline import VARIABLES_AMENAZA
+        rutas += [os.path.join(parametros['ruta_shps_amenaza'], f'{nombre}.shp') for nombre in VARIABLES_AMENAZA]
+    if tipo == 'temporada':
+        from temporada import VARIABLES_DINAMICAS, entradas_fechas
+        base = {nombre: os.path.join(parametros['ruta_shps_amenaza'], f'{nombre}.shp') for nombre in VARIABLES_DINAMICAS}
+        rutas += [ruta for entradas in entradas_fechas(parametros['fechas'], base=base).values()
+                  for ruta in entradas.values() if ruta not in rutas]
+    return [ruta for ruta in rutas if os.path.exists(ruta)]
+
+def clave_trabajo(tipo, parametros):
+    """
+    Clave de deduplicación: el tipo, los parámetros y el contenido de los archivos de
+    entrada. La susceptibilidad depende solo de las coberturas y del campo, así que para
+    la amenaza basta con el contenido de las capas vectoriales.
+    """
+    from pipeline import carpeta_resultados
+
+    # La caché de rasters recuerda el hash de los archivos que no han cambiado
+    ruta_resultados = parametros.get('ruta_resultados') or carpeta_resultados(parametros['ruta_cobertura'])
+    contenido = CacheRasters(os.path.join(ruta_resultados, 'cache')).hash_contenido(rutas_entrada(tipo, parametros))
+    parametros = {k: v for k, v in parametros.items() if k not in PARAMETROS_SIN_EFECTO}
+    h = hashlib.sha256()
+    h.update(json.dumps({'tipo': tipo, 'parametros': parametros}, sort_keys=True, default=str).encode())
+    h.update(contenido.encode())
+    return h.hexdigest()
+
+def _firma_archivo(ruta):
+    estado = os.stat(ruta)
+    return [estado.st_size, estado.st_mtime_ns]
+
+def resultado_vigente(resultado):
+    """Indica si los archivos de un resultado siguen siendo los que escribió el trabajo."""
+    return all(os.path.exists(ruta) and _firma_archivo(ruta) == firma
+               for ruta, firma in resultado.get('archivos', {}).items())
+
+class ColaTrabajos:
+    """
+    Cola de trabajos persistente en SQLite, compartida entre la aplicación (que encola y
+    consulta) y los procesos trabajadores (que ejecutan). Cada operación abre su propia
+    conexión, así que se puede usar desde varios hilos y procesos.
+    """
+
+    def __init__(self, ruta=RUTA_BD_TRABAJOS):
+        self.ruta = ruta
+        os.makedirs(os.path.dirname(os.path.abspath(ruta)), exist_ok=True)
+        with self._conexion() as con:
+            con.executescript(ESQUEMA)
+
+    @contextmanager
+    def _conexion(self):
+        con = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        try:
+            con.execute('PRAGMA journal_mode=WAL')
+            yield con
+        finally:
+            con.close()
+
+    @staticmethod
+    def _a_dict(fila):
+        if fila is None:
+            return None
+        trabajo = dict(fila)
+        for campo in ('parametros', 'resultado'):
+            if trabajo[campo] is not None:
+                trabajo[campo] = json.loads(trabajo[campo])
+        return trabajo
+
+    def encolar(self, tipo, parametros, depende_de=None):
+        """
+        Encola un trabajo y devuelve su id. Si ya hay un trabajo con las mismas entradas
+        pendiente, en ejecución o terminado con resultados vigentes, se devuelve ese.
+        """
+        clave = clave_trabajo(tipo, parametros)
+        with self._conexion() as con:
+            # La búsqueda y la inserción van en una transacción de escritura: dos procesos que
+            # encolan el mismo trabajo a la vez no pueden insertarlo los dos
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                filas = con.execute("SELECT * FROM trabajos WHERE clave = ? AND estado IN (?, ?, ?) ORDER BY id DESC",
+                                    (clave, PENDIENTE, EJECUTANDO, TERMINADO)).fetchall()
+                for fila in filas:
+                    trabajo = self._a_dict(fila)
+                    if trabajo['estado'] != TERMINADO or resultado_vigente(trabajo['resultado']):
+                        con.execute('COMMIT')
+                        logger.info(f"Trabajo de {tipo} reutilizado: {trabajo['id']} ({trabajo['estado']})")
+                        return trabajo['id']
+                cursor = con.execute(
+                    "INSERT INTO trabajos (tipo, clave, parametros, depende_de, estado, creado) VALUES (?, ?, ?, ?, ?, ?)",
+                    (tipo, clave, json.dumps(parametros), depende_de, PENDIENTE, time.time()))
+                con.execute('COMMIT')
+            except Exception:
+                con.execute('ROLLBACK')
+                raise
+        logger.info(f"Trabajo de {tipo} encolado: {cursor.lastrowid}")
+        return cursor.lastrowid
+
+    def obtener(self, id_trabajo):
+        with self._conexion() as con:
+            return self._a_dict(con.execute("SELECT * FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone())
+
+    def cancelar(self, id_trabajo):
+        """
+        Cancela un trabajo: si está pendiente se marca como cancelado; si está en ejecución
+        se le avisa y se detiene en el siguiente punto de control.
+        """
+        with self._conexion() as con:
+            con.execute("UPDATE trabajos SET estado = ?, terminado = ? WHERE id = ? AND estado = ?",
+                        (CANCELADO, time.time(), id_trabajo, PENDIENTE))
+            con.execute("UPDATE trabajos SET cancelar = 1 WHERE id = ? AND estado = ?", (id_trabajo, EJECUTANDO))
+
+    def reintentar(self, id_trabajo):
+        """Vuelve a encolar un trabajo con error o cancelado. Devuelve True si se reencoló."""
+        with self._conexion() as con:
+            cursor = con.execute(
+                "UPDATE trabajos SET estado = ?, etapa = NULL, progreso = 0, error = NULL, cancelar = 0, "
+                "pid = NULL, iniciado = NULL, terminado = NULL WHERE id = ? AND estado IN (?, ?)",
+                (PENDIENTE, id_trabajo, ERROR, CANCELADO))
+            return cursor.rowcount > 0
+
+    def tomar(self):
+        """
+        Toma el siguiente trabajo pendiente cuyas dependencias hayan terminado y lo marca
+        como en ejecución por este proceso. Devuelve None si no hay ninguno.
+        """
+        with self._conexion() as con:
+            con.execute('BEGIN IMMEDIATE')
+            try:
+                # Los trabajos cuya dependencia falló o se canceló no se pueden ejecutar
+                con.execute(
+                    "UPDATE trabajos SET estado = ?, error = 'La etapa anterior no terminó', terminado = ? "
+                    "WHERE estado = ? AND depende_de IN (SELECT id FROM trabajos WHERE estado IN (?, ?))",
+                    (ERROR, time.time(), PENDIENTE, ERROR, CANCELADO))
+                fila = con.execute(
+                    "SELECT * FROM trabajos t WHERE estado = ? AND (depende_de IS NULL OR "
+                    "(SELECT estado FROM trabajos WHERE id = t.depende_de) = ?) ORDER BY id LIMIT 1",
+                    (PENDIENTE, TERMINADO)).fetchone()
+                if fila is not None:
+                    con.execute("UPDATE trabajos SET estado = ?, pid = ?, iniciado = ?, intentos = intentos + 1 "
+                                "WHERE id = ?", (EJECUTANDO, os.getpid(), time.time(), fila['id']))
+                con.execute('COMMIT')
+            except Exception:
+                con.execute('ROLLBACK')
+                raise
+        return self._a_dict(fila)
+
+    def actualizar_progreso(self, id_trabajo, etapa, progreso):
+        """Guarda el avance de un trabajo y devuelve True si se ha pedido su cancelación."""
+        with self._conexion() as con:
+            con.execute("UPDATE trabajos SET etapa = ?, progreso = ? WHERE id = ?", (etapa, progreso, id_trabajo))
+            return bool(con.execute("SELECT cancelar FROM trabajos WHERE id = ?", (id_trabajo,)).fetchone()[0])
+
+    def finalizar(self, id_trabajo, estado, resultado=None, error=None):
+        with self._conexion() as con:
+            con.execute("UPDATE trabajos SET estado = ?, resultado = ?, error = ?, terminado = ?, "
+                        "progreso = CASE WHEN ? = ? THEN 1 ELSE progreso END WHERE id = ?",
+                        (estado, json.dumps(resultado) if resultado is not None else None, error,
+                         time.time(), estado, TERMINADO, id_trabajo))
+
+    def recuperar_interrumpidos(self):
+        """Marca con error los trabajos en ejecución cuyo proceso ya no existe."""
+        with self._conexion() as con:
+            filas = con.execute("SELECT id, pid FROM trabajos WHERE estado = ?", (EJECUTANDO,)).fetchall()
+        for fila in filas:
+            if not _proceso_vivo(fila['pid']):
+                self.finalizar(fila['id'], ERROR, error="Trabajo interrumpido (el proceso trabajador terminó)")
+                logger.warning(f"Trabajo {fila['id']} interrumpido")
+
+def _proceso_vivo(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+def ejecutar_trabajo(cola, trabajo, almacen=None):
+    """
+    Ejecuta un trabajo ya tomado, informando su progreso y atendiendo la cancelación.
+    Los resultados de TIPOS_ALMACEN se escriben en una carpeta temporal del almacén y se
+    publican al terminar; si el almacén ya tiene el resultado de la misma clave (calculado
+    por cualquier usuario), se reutiliza sin calcular.
+    """
+    ultimo = {'momento': 0.0, 'etapa': None}
+    etapas = list(PESOS_ETAPAS)
+
+    def progreso(etapa, fraccion=None):
+        # Avance total: etapas anteriores completas más la fracción de la etapa actual
+        indice = etapas.index(etapa)
+        total = sum(PESOS_ETAPAS[e] for e in etapas[:indice]) + PESOS_ETAPAS[etapa] * (fraccion or 0)
+        ahora = time.monotonic()
+        if etapa == ultimo['etapa'] and ahora - ultimo['momento'] < INTERVALO_PROGRESO:
+            return
+        ultimo.update(momento=ahora, etapa=etapa)
+        if cola.actualizar_progreso(trabajo['id'], etapa, round(total, 3)):
+            raise TrabajoCancelado()
+
+    inicio = time.perf_counter()
+    parametros = dict(trabajo['parametros'])
+    publicado = carpeta = None
+    if trabajo['tipo'] in TIPOS_ALMACEN:
+        almacen = almacen or AlmacenResultados()
+        publicado = almacen.obtener(trabajo['clave'])
+        if publicado is None:
+            carpeta = parametros['ruta_salida'] = almacen.reservar(trabajo['clave'])
+    try:
+        if publicado is not None:
+            logger.info(f"Trabajo {trabajo['id']}: resultado ya publicado en el almacén, se reutiliza")
+            resultado = dict(publicado['resultado'], almacen='reutilizado')
+        else:
+            resultado = _funcion_trabajo(trabajo['tipo'])(progreso=progreso, **parametros)
+    except TrabajoCancelado:
+        if carpeta:
+            almacen.descartar(carpeta)
+        cola.finalizar(trabajo['id'], CANCELADO)
+        logger.info(f"Trabajo {trabajo['id']} cancelado")
+        return
+    except Exception as e:
+        if carpeta:
+            almacen.descartar(carpeta)
+        cola.finalizar(trabajo['id'], ERROR, error=f"{type(e).__name__}: {e}")
+        logger.error(f"Trabajo {trabajo['id']} con error: {e}\n{traceback.format_exc()}")
+        return
+
+    resultado['segundos'] = round(time.perf_counter() - inicio, 3)
+    if carpeta:
+        resultado['almacen'] = 'publicado'
+        resultado = almacen.publicar(trabajo['clave'], carpeta, resultado, trabajo['tipo'])['resultado']
+    # Firma de los archivos escritos, para saber si un resultado se puede reutilizar
+    rutas = [fecha['ruta'] for fecha in resultado['fechas'].values()] if 'fechas' in resultado else [resultado['ruta']]
+    resultado['archivos'] = {ruta: _firma_archivo(ruta) for ruta in rutas}
+    cola.finalizar(trabajo['id'], TERMINADO, resultado=resultado)
+    logger.info(f"Trabajo {trabajo['id']} terminado en {resultado['segundos']:.1f} s")
+
+def bucle_trabajador(ruta_bd, parar=None):
+    """
+    Bucle de un proceso trabajador: toma y ejecuta trabajos de la cola hasta que se active
+    el evento parar (indefinidamente si no se da). Se comprueba entre un trabajo y otro.
+    """
+    logging.basicConfig(level=logging.INFO)
+    cola = ColaTrabajos(ruta_bd)
+    almacen = AlmacenResultados()
+    while parar is None or not parar.is_set():
+        trabajo = cola.tomar()
+        if trabajo is None:
+            time.sleep(ESPERA_COLA)
+            continue
+        logger.info(f"Ejecutando trabajo {trabajo['id']} ({trabajo['tipo']})")
+        ejecutar_trabajo(cola, trabajo, almacen)
+
+class GestorTrabajos:
+    """
+    Cola de trabajos más los procesos trabajadores que la atienden. Los procesos se
+    inician la primera vez que se encola un trabajo y se detienen con detener (también al
+    salir del intérprete). No son procesos daemon: el modo paralelo con pool de
+    'procesos' necesita crear procesos hijos dentro del trabajador.
+    """
+
+    def __init__(self, ruta_bd=RUTA_BD_TRABAJOS, num_procesos=NUM_PROCESOS):
+        self.cola = ColaTrabajos(ruta_bd)
+        self.num_procesos = num_procesos
+        self.procesos = []
+        self._bloqueo = threading.Lock()
+        self._contexto = multiprocessing.get_context('spawn')
+        self._parar = None
+        self._registrado = False
+
+    def iniciar(self):
+        """Inicia (o reinicia, si alguno terminó) los procesos trabajadores."""
+        with self._bloqueo:
+            self.procesos = [p for p in self.procesos if p.is_alive()]
+            if len(self.procesos) == self.num_procesos:
+                return
+            self.cola.recuperar_interrumpidos()
+            if self._parar is None or self._parar.is_set():
+                self._parar = self._contexto.Event()
+            while len(self.procesos) < self.num_procesos:
+                proceso = self._contexto.Process(target=bucle_trabajador, args=(self.cola.ruta, self._parar),
+                                                 name=f'trabajador-{len(self.procesos) + 1}')
+                proceso.start()
+                self.procesos.append(proceso)
+            if not self._registrado:
+                # Se registra tras iniciar el primer proceso, así corre antes de que
+                # multiprocessing espere a sus hijos al salir
+                atexit.register(self.detener)
+                self._registrado = True
+            logger.info(f"{self.num_procesos} procesos trabajadores activos")
+
+    def detener(self, espera=ESPERA_DETENER):
+        """
+        Detiene los procesos trabajadores: terminan el trabajo en curso si lo hacen en
+        espera segundos; si no, se interrumpen (el trabajo queda con error al reiniciar).
+        """
+        with self._bloqueo:
+            if self._parar is not None:
+                self._parar.set()
+            limite = time.monotonic() + espera
+            for proceso in self.procesos:
+                proceso.join(max(limite - time.monotonic(), 0))
+            for proceso in self.procesos:
+                if proceso.is_alive():
+                    proceso.terminate()
+                    proceso.join()
+            if self.procesos:
+                logger.info(f"{len(self.procesos)} procesos trabajadores detenidos")
+            self.procesos = []
+
+    def encolar(self, tipo, parametros, depende_de=None):
+        self.iniciar()
+        return self.cola.encolar(tipo, parametros, depende_de)
+
+    def reintentar(self, id_trabajo):
+        self.iniciar()
+        return self.cola.reintentar(id_trabajo)
+
+    def cancelar(self, id_trabajo):
+        self.cola.cancelar(id_trabajo)
+
+    def obtener(self, id_trabajo):
+        return self.cola.obtener(id_trabajo)
@@ -0,0 +1,93 @@
+import base64
+import io
+import logging
+import math
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+logger = logging.getLogger(__name__)
+
+# Paleta fija de las seis clases (0 = sin datos/sin riesgo ... 5 = muy alta)
+COLORES_CLASES = ["white", "green", "yellow", "orange", "red", "darkred"]
+PALETA_CLASES = [
+    (255, 255, 255),  # Sin datos / sin riesgo
+    (0, 128, 0),      # Muy baja
+    (255, 255, 0),    # Baja
+    (255, 165, 0),    # Moderada
+    (255, 0, 0),      # Alta
+    (139, 0, 0)       # Muy alta
+]
+
+# Lado máximo (en píxeles) de la imagen enviada al navegador; acota el tamaño del mensaje
+LADO_MAXIMO = 1200
+
+def paso_reduccion(forma, lado_maximo=LADO_MAXIMO):
+    """Factor de submuestreo entero para que ningún lado supere lado_maximo."""
+    return max(1, int(math.ceil(max(forma) / lado_maximo)))
+
+def reducir_clases(clases, lado_maximo=LADO_MAXIMO):
+    """
+    Reduce un raster de clases al tamaño de la vista tomando un píxel de cada paso
+    (vecino más cercano, sin mezclar clases). Devuelve una vista, sin copiar.
+    """
+    paso = paso_reduccion(clases.shape, lado_maximo)
+    return clases[::paso, ::paso]
+
+def leer_banda_reducida(ruta, lado_maximo=LADO_MAXIMO):
+    """
+    Lee la banda 1 de un raster directamente al tamaño de la vista (GDAL usa las vistas
+    generales si existen), sin cargar la resolución completa.
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+
+    with rasterio.open(ruta) as src:
+        paso = paso_reduccion(src.shape, lado_maximo)
+        forma = (max(1, src.height // paso), max(1, src.width // paso))
+        return src.read(1, out_shape=forma, resampling=Resampling.nearest)
+
+def codificar_png(clases, transparente=None, optimizar=True):
+    """
+    Codifica un raster de clases uint8 como PNG con la paleta de clases. Si se indica
+    transparente, esa clase queda transparente; optimizar=False reduce el tiempo de
+    codificación a costa de un archivo algo mayor. Devuelve los bytes del PNG.
+    """
+    from PIL import Image
+
+    # putpalette convierte la imagen en escala de grises ('L') a modo con paleta ('P')
+    imagen = Image.fromarray(np.ascontiguousarray(clases, dtype=np.uint8))
+    paleta = [canal for color in PALETA_CLASES for canal in color]
+    imagen.putpalette(paleta + [0] * (768 - len(paleta)))
+    opciones = {} if transparente is None else {'transparency': transparente}
+    buffer = io.BytesIO()
+    imagen.save(buffer, format='PNG', optimize=optimizar, **opciones)
+    return buffer.getvalue()
+
+def png_clases(clases):
+    """Codifica un raster de clases uint8 como PNG con paleta y lo devuelve como URI de datos."""
+    return "data:image/png;base64," + base64.b64encode(codificar_png(clases)).decode('ascii')
+
+def figura_clases(clases, titulo, lado_maximo=LADO_MAXIMO):
+    """
+    Crea la figura de un mapa de clases como una sola imagen PNG reducida al tamaño de la
+    vista, de modo que el mensaje enviado al navegador no depende del tamaño del raster.
+    Si Pillow no está instalado se usa un mapa de calor sobre el raster reducido.
+    """
+    reducido = reducir_clases(clases, lado_maximo)
+    try:
+        fuente = png_clases(reducido)
+    except ImportError:
+        logger.warning("Pillow no está instalado; se usa un mapa de calor para la vista reducida.")
+        fig = px.imshow(reducido,
+                        color_continuous_scale=[(i / 5, color) for i, color in enumerate(COLORES_CLASES)],
+                        title=titulo, zmin=0, zmax=5)
+        fig.update_coloraxes(showscale=False)
+    else:
+        logger.info(f"Mapa '{titulo}': imagen de {reducido.shape[1]}x{reducido.shape[0]} px, {len(fuente) / 1024:.0f} KB")
+        fig = go.Figure(go.Image(source=fuente, hoverinfo='skip'))
+        fig.update_layout(title=titulo)
+        fig.update_xaxes(showticklabels=False)
+        fig.update_yaxes(showticklabels=False)
+    fig.update_layout(height=600, width=800)
+    return fig
@@ -0,0 +1,190 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio import windows
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from shapely.geometry import box
+
+from carga import campos_capa, firma_capa, leer_capa
+from escritura import SalidaRaster, TAMANO_BLOQUE_COG
+from instrumentacion import RANGO_HISTOGRAMA
+from reclasificacion import reclasificar
+
+logger = logging.getLogger(__name__)
+
+# Nombre de las clases de amenaza en las columnas de área (0 = sin datos)
+NOMBRES_CLASES = ('sin_datos', 'muy_baja', 'baja', 'moderada', 'alta', 'muy_alta')
+
+# Percentiles de la amenaza que se calculan por zona
+PERCENTILES_ZONALES = (10, 50, 90)
+
+# Intervalos del histograma por zona del que se estiman los percentiles: en el rango de
+# las calificaciones (0-5) cada intervalo mide 0.005, que es el error máximo del percentil
+INTERVALOS_ZONALES = 1000
+
+# Filas de la rejilla que se procesan a la vez (múltiplo de las teselas de los COG)
+FILAS_BLOQUE_ZONAL = TAMANO_BLOQUE_COG
+
+def nombre_archivo(texto):
+    """
+    Versión de texto (nombre de capa o de campo) que se puede usar en un nombre de archivo:
+    los caracteres que no son letras, dígitos, '.', '_' o '-' se cambian por '_'.
+    """
+    return re.sub(r'[^\w.-]+', '_', str(texto)).strip('._') or 'sin_nombre'
+
+def _clave_zonas(ruta_zonas, campo, crs, transform, forma):
+    """Clave del raster de etiquetas: la capa (por su firma), el campo y la rejilla."""
+    descripcion = {
+        'capa': os.path.abspath(ruta_zonas),
+        'firma': firma_capa(ruta_zonas),
+        'campo': campo,
+        'crs': crs.to_wkt(),
+        'transform': list(transform)[:6],
+        'forma': list(forma)
+    }
+    return hashlib.sha256(json.dumps(descripcion, sort_keys=True).encode()).hexdigest()[:16]
+
+def rasterizar_zonas(ruta_zonas, campo, crs, transform, forma, carpeta):
+    """
+    Rasteriza una capa de zonas (municipios, veredas, áreas protegidas...) sobre la
+    rejilla de la amenaza: cada píxel recibe la etiqueta de su zona (1..n, 0 = fuera de
+    todas). Los polígonos con el mismo valor de campo forman una sola zona; si se
+    superponen, gana el último. El raster se guarda en carpeta y se reutiliza mientras
+    la capa y la rejilla no cambien. Devuelve (ruta del raster, nombres de las zonas).
+    """
+    base = f"{nombre_archivo(os.path.splitext(os.path.basename(ruta_zonas))[0])}-{nombre_archivo(campo)}"
+    clave = _clave_zonas(ruta_zonas, campo, crs, transform, forma)
+    ruta_etiquetas = os.path.join(carpeta, f"{base}-{clave}.tif")
+    ruta_nombres = os.path.join(carpeta, f"{base}-{clave}.json")
+    if os.path.exists(ruta_etiquetas) and os.path.exists(ruta_nombres):
+        with open(ruta_nombres, encoding='utf-8') as f:
+            nombres = json.load(f)
+        logger.info(f"Raster de zonas reutilizado: {ruta_etiquetas} ({len(nombres)} zonas)")
+        return ruta_etiquetas, nombres
+
+    if campo not in campos_capa(ruta_zonas):
+        raise ValueError(f"El campo '{campo}' no existe en {os.path.basename(ruta_zonas)}")
+    inicio = time.perf_counter()
+    gdf = leer_capa(ruta_zonas, [campo])
+    if gdf.crs is not None and CRS.from_user_input(gdf.crs) != crs:
+        gdf = gdf.to_crs(crs)
+    gdf = gdf[gdf[campo].notna() & gdf.geometry.notna() & ~gdf.geometry.is_empty]
+    codigos, valores = pd.factorize(gdf[campo], sort=True)
+    nombres = [str(valor) for valor in valores]
+    etiquetas = codigos + 1
+    dtype = np.uint16 if len(nombres) < np.iinfo(np.uint16).max else np.uint32
+
+    os.makedirs(carpeta, exist_ok=True)
+    geometrias = gdf.geometry.values
+    indice = gdf.sindex
+    salida = SalidaRaster(ruta_etiquetas, forma, dtype, crs, transform, nodata=0, vistas=False)
+    with salida as dst:
+        # Por franjas: en cada una solo se queman las zonas que la tocan (consulta al índice)
+        for fila in range(0, forma[0], FILAS_BLOQUE_ZONAL):
+            ventana = windows.Window(0, fila, forma[1], min(FILAS_BLOQUE_ZONAL, forma[0] - fila))
+            seleccion = np.sort(indice.query(box(*windows.bounds(ventana, transform))))
+            franja = np.zeros((int(ventana.height), int(ventana.width)), dtype=dtype)
+            if len(seleccion):
+                rasterize(zip(geometrias[seleccion], etiquetas[seleccion]), out=franja,
+                          transform=windows.transform(ventana, transform))
+            dst.write(franja, 1, window=ventana)
+    with open(ruta_nombres, 'w', encoding='utf-8') as f:
+        json.dump(nombres, f, ensure_ascii=False)
+
+    # Las etiquetas de versiones anteriores de la misma capa ya no sirven
+    for anterior in glob.glob(os.path.join(carpeta, f"{glob.escape(base)}-*")):
+        if os.path.splitext(anterior)[0] != os.path.splitext(ruta_etiquetas)[0]:
+            os.remove(anterior)
+    logger.info(f"Raster de {len(nombres)} zonas creado en {time.perf_counter() - inicio:.2f} s: {ruta_etiquetas}")
+    return ruta_etiquetas, nombres
+
+def hectareas_por_pixel(crs, transform):
+    """Área de un píxel en hectáreas. La rejilla debe estar en un CRS proyectado en metros."""
+    if not crs.is_projected or (crs.linear_units or '').lower() not in ('metre', 'meter', 'm'):
+        raise ValueError(f"Las áreas requieren un CRS proyectado en metros; la rejilla usa {crs}")
+    return abs(transform.a * transform.e) / 10000.0
+
+def _percentiles_histograma(histograma, percentiles, rango):
+    """
+    Percentiles de cada fila de un histograma (zonas x intervalos), interpolando dentro
+    del intervalo. NaN para las filas sin valores.
+    """
+    ancho = (rango[1] - rango[0]) / histograma.shape[1]
+    acumulado = np.cumsum(histograma, axis=1)
+    total = acumulado[:, -1]
+    resultado = {}
+    for p in percentiles:
+        objetivo = p / 100.0 * total
+        intervalo = np.minimum((acumulado < objetivo[:, None]).sum(axis=1), histograma.shape[1] - 1)
+        filas = np.arange(len(total))
+        previo = np.where(intervalo > 0, acumulado[filas, np.maximum(intervalo - 1, 0)], 0)
+        dentro = histograma[filas, intervalo]
+        fraccion = np.divide(objetivo - previo, dentro, out=np.zeros(len(total)), where=dentro > 0)
+        valor = rango[0] + (intervalo + np.clip(fraccion, 0, 1)) * ancho
+        resultado[p] = np.where(total > 0, valor, np.nan)
+    return resultado
+
+def estadisticas_zonales(ruta_amenaza, ruta_etiquetas, nombres, percentiles=PERCENTILES_ZONALES,
+                         intervalos=INTERVALOS_ZONALES, filas_bloque=FILAS_BLOQUE_ZONAL):
+    """
+    Calcula para todas las zonas a la vez, en una sola lectura por franjas de la amenaza y
+    del raster de etiquetas, el área de cada clase, la media y los percentiles de la
+    amenaza. Las sumas por zona se acumulan con bincount, sin recorrer las zonas una por
+    una. La media y los percentiles solo usan los píxeles con datos (clase 1-5);
+    los percentiles salen de un histograma por zona y su error es como mucho el ancho de un
+    intervalo. Devuelve un DataFrame con una fila por zona.
+    """
+    inicio = time.perf_counter()
+    num_clases = len(NOMBRES_CLASES)
+    n = len(nombres) + 1
+    conteos = np.zeros(n * num_clases, dtype=np.int64)
+    validos = np.zeros(n, dtype=np.int64)
+    suma = np.zeros(n, dtype=np.float64)
+    histograma = np.zeros(n * intervalos, dtype=np.int64)
+    escala = intervalos / (RANGO_HISTOGRAMA[1] - RANGO_HISTOGRAMA[0])
+
+    with rasterio.open(ruta_amenaza) as src, rasterio.open(ruta_etiquetas) as etiquetas:
+        if src.shape != etiquetas.shape or not src.transform.almost_equals(etiquetas.transform):
+            raise ValueError("El raster de zonas no está en la rejilla de la amenaza")
+        hectareas = hectareas_por_pixel(src.crs, src.transform)
+        for fila in range(0, src.height, filas_bloque):
+            ventana = windows.Window(0, fila, src.width, min(filas_bloque, src.height - fila))
+            zona = etiquetas.read(1, window=ventana).ravel().astype(np.intp)
+            amenaza = src.read(1, window=ventana).ravel()
+            # Los NaN y el nodata del raster se enmascaran antes de clasificar: reclasificar
+            # llevaría los NaN a la clase más alta, y aquí cuentan como sin datos (clase 0)
+            sin_datos = ~np.isfinite(amenaza)
+            if src.nodata is not None:
+                sin_datos |= amenaza == src.nodata
+            clase = reclasificar(np.where(sin_datos, 0, amenaza))
+            conteos += np.bincount(zona * num_clases + clase, minlength=n * num_clases)
+
+            con_datos = (clase > 0) & ~sin_datos
+            zona, amenaza = zona[con_datos], amenaza[con_datos]
+            validos += np.bincount(zona, minlength=n)
+            suma += np.bincount(zona, weights=amenaza, minlength=n)
+            indices = ((amenaza - RANGO_HISTOGRAMA[0]) * escala).astype(np.intp)
+            np.clip(indices, 0, intervalos - 1, out=indices)
+            histograma += np.bincount(zona * intervalos + indices, minlength=n * intervalos)
+
+    # La etiqueta 0 (fuera de todas las zonas) no forma parte de la tabla
+    conteos = conteos.reshape(n, num_clases)[1:]
+    validos, suma = validos[1:], suma[1:]
+    tabla = pd.DataFrame({'zona': nombres, 'pixeles': conteos.sum(axis=1)})
+    tabla['area_ha'] = tabla['pixeles'] * hectareas
+    for i, nombre in enumerate(NOMBRES_CLASES):
+        tabla[f'area_ha_{nombre}'] = conteos[:, i] * hectareas
+    tabla['media'] = np.divide(suma, validos, out=np.full(len(validos), np.nan), where=validos > 0)
+    for p, valores in _percentiles_histograma(histograma.reshape(n, intervalos)[1:], percentiles,
+                                               RANGO_HISTOGRAMA).items():
+        tabla[f'p{p:g}'] = valores
+    logger.info(f"Estadísticas zonales de {len(nombres)} zonas en {time.perf_counter() - inicio:.2f} s")
+    return tabla